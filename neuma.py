@@ -1,13 +1,17 @@
 import os  # For IO
-from io import BytesIO
+import random  # For backoff jitter
 import base64
+import hashlib  # For cache keys
+import zlib  # For sharding
 import sys  # For IO
 import shutil  # For IO
+import tempfile  # For IO
 import subprocess  # For IO
 # import openai
 from openai import OpenAI  # The good stuff
-from openai import audio as openai_audio  # For audio
-# import time  # For logging
+from openai import APIConnectionError, APIStatusError  # For retries
+import httpx  # For connection pooling
+import time  # For timing
 from datetime import datetime
 from time import sleep  # Zzz
 import toml  # For parsing settings
@@ -15,44 +19,64 @@ import logging  # For logging
 from rich.logging import RichHandler  # For logging
 
 import json  # For parsing JSON
+import csv  # For writing rows
+import shlex  # For the pager command
+from collections import OrderedDict  # For LRU caches
+import sqlite3  # For local caches
 import pyperclip  # For copying to clipboard
 import re  # For regex
+import math  # For scoring
+import heapq  # For top-k selection
 import requests  # For accessing the web
+import urllib.parse  # For crawling
+import urllib.robotparser
+from xml.etree import ElementTree  # For sitemaps
 from bs4 import BeautifulSoup  # For parsing HTML
 # import readline
 import argparse  # For parsing command line arguments
 
 # Audio
 import threading
-import speech_recognition
-import pyaudio
-import sounddevice
-
-# Document loaders
-from langchain_community.document_loaders import DirectoryLoader
-# from langchain.document_loaders import DirectoryLoader
+import asyncio  # For the async API
+import select  # For file watching
+import struct  # For file watching
+import ctypes  # For file watching
+import ctypes.util
+import mmap  # For reading large files
+import io  # For in-memory audio
+import wave  # For in-memory audio
+import glob  # For file patterns
+from concurrent.futures import ThreadPoolExecutor
+import functools  # For command handlers and the tokenizer
+import contextlib  # For usage attribution
+import importlib  # For command plugins
+import importlib.metadata
+import atexit  # For flushing caches
+# speech_recognition, pyaudio and sounddevice are imported when audio is used
+
+# Document loaders are imported when documents are loaded
 
 # Text splitter
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.text_splitter import RecursiveCharacterTextSplitter, Language
 
 # Schema
 from langchain.schema import Document
 
 # Embeddings
-from langchain_openai.embeddings import OpenAIEmbeddings
+from langchain_core.embeddings import Embeddings
 
 # Vector stores
-from langchain.vectorstores.chroma import Chroma
+from langchain_core.vectorstores import VectorStore
+import numpy as np
+
 
-# Image
-from PIL import Image
-from slugify import slugify
+# Tokenizer used by the OpenAI embedding models, loaded on first use (it may be downloaded)
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    import tiktoken  # For counting tokens
 
-# Chat models
-from langchain_openai import ChatOpenAI
+    return tiktoken.get_encoding("cl100k_base")
 
-# LLM
-from langchain_community.callbacks import get_openai_callback
 
 # Formatting
 from rich.console import Console
@@ -62,20 +86,3539 @@ from rich.padding import Padding
 from rich.table import Table
 from rich import box
 from rich.syntax import Syntax
+from rich.markup import escape
+
+
+class TokenBucket:
+    """Token bucket class, refills continuously up to a per minute capacity"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until the amount is available, then take it
+    def acquire(self, amount: float = 1) -> None:
+        if self.capacity <= 0:  # Unlimited
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            sleep(wait)
+
+
+class BudgetExceededError(Exception):
+    """Raised when a call would go over a usage budget"""
+
+
+class UsageLedger:
+    """Usage ledger class, records the usage of every API call and enforces the budgets"""
+
+    PERIODS = {"daily": "%Y-%m-%d", "monthly": "%Y-%m"}
+    DIMENSIONS = ["persona", "mode", "model", "vector_db", "endpoint"]
+
+    def __init__(self, config: dict, logger: logging.Logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Attribution of the calls of each thread
+        self.connection = None
+        self.totals = {}  # Running tokens and cost of the current day and month, by period
+        self.unpriced = set()  # Models already warned about
+        self.configure(config)
+
+    # Apply the usage settings, and open the ledger file
+    def configure(self, config: dict) -> None:
+        usage_config = config.get("usage", {})
+        self.enabled = usage_config.get("enabled", True)
+        self.budgets = {
+            period: {
+                "tokens": usage_config.get("{}_tokens".format(period), 0),
+                "cost": usage_config.get("{}_cost".format(period), 0),
+            }
+            for period in self.PERIODS
+        }
+        self.throttle_at = usage_config.get("throttle_at", 0.8)
+        self.throttle_delay = usage_config.get("throttle_delay", 5.0)
+        self.downgrade_model = usage_config.get("downgrade_model", "")
+        self.prices = usage_config.get("prices", {})
+        ledger_file = os.path.expanduser(usage_config.get("ledger_file", "~/.config/neuma/usage.sqlite"))
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.totals = {}
+            os.makedirs(os.path.dirname(ledger_file), exist_ok=True)
+            self.connection = sqlite3.connect(ledger_file, check_same_thread=False)
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS usage (
+                    time REAL,
+                    day TEXT,
+                    month TEXT,
+                    endpoint TEXT,
+                    model TEXT,
+                    persona TEXT,
+                    mode TEXT,
+                    vector_db TEXT,
+                    batch INTEGER,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    units REAL,
+                    cost REAL,
+                    estimated INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS usage_day ON usage (day);
+                CREATE INDEX IF NOT EXISTS usage_month ON usage (month);
+                """
+            )
+
+    # Attribute the calls made in this block (and in threads started with bind) to a persona, mode, vector db...
+    # The returned tally adds up their usage
+    @contextlib.contextmanager
+    def attribute(self, **attribution):
+        previous = getattr(self.local, "context", {"tallies": []})
+        tally = {"prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+        self.local.context = dict(previous, **attribution, tallies=previous["tallies"] + [tally])
+        try:
+            yield tally
+        finally:
+            self.local.context = previous
+
+    # Wrap a function so that it runs with the attribution of the current thread
+    def bind(self, function):
+        context = getattr(self.local, "context", {"tallies": []})
+
+        def run(*args, **kwargs):
+            previous = getattr(self.local, "context", {"tallies": []})
+            self.local.context = context
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.context = previous
+
+        return run
+
+    # Get the attribution of the current thread
+    def get_context(self) -> dict:
+        return getattr(self.local, "context", {"tallies": []})
+
+    # Get the price of a model, the longest matching name wins (gpt-4o-2024-05-13 is priced as gpt-4o)
+    def get_price(self, model: str) -> dict:
+        names = [name for name in self.prices if model.startswith(name)]
+        return self.prices[max(names, key=len)] if names else {}
+
+    # Check if a cost budget is set
+    def has_cost_budget(self) -> bool:
+        return any(budget["cost"] for budget in self.budgets.values())
+
+    # Get the cost of a call, in the currency of the prices
+    def get_cost(self, model: str, prompt_tokens: int, completion_tokens: int, units: float) -> float:
+        price = self.get_price(model)
+        if not price and model and model not in self.unpriced:
+            self.unpriced.add(model)
+            self.logger.warning("No price for {} in [usage.prices], its calls are recorded at no cost".format(model))
+        return (
+            prompt_tokens * price.get("input", 0) / 1e6
+            + completion_tokens * price.get("output", 0) / 1e6
+            + units * price.get("unit", 0)
+        )
+
+    # Get a value of the usage reported by the API, an object or a dict (in streamed chunks)
+    @staticmethod
+    def get_usage_value(usage, name: str) -> int:
+        if isinstance(usage, dict):
+            return usage.get(name) or 0
+        return getattr(usage, name, 0) or 0
+
+    # Record the usage of a call, estimated from the request when the API doesn't report it
+    def record(self, endpoint: str, model: str, usage=None, estimate: int = 0, units: float = 0) -> None:
+        if not self.enabled:
+            return
+        estimated = usage is None and estimate > 0
+        if usage is not None:
+            prompt_tokens = self.get_usage_value(usage, "prompt_tokens")
+            completion_tokens = self.get_usage_value(usage, "completion_tokens")
+        else:
+            prompt_tokens, completion_tokens = estimate, 0
+        cost = self.get_cost(model, prompt_tokens, completion_tokens, units)
+        context = self.get_context()
+        now = datetime.now()
+        keys = {period: now.strftime(period_format) for period, period_format in self.PERIODS.items()}
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    keys["daily"],
+                    keys["monthly"],
+                    endpoint,
+                    model,
+                    context.get("persona", ""),
+                    context.get("mode", ""),
+                    context.get("vector_db", ""),
+                    int(context.get("batch", False)),
+                    prompt_tokens,
+                    completion_tokens,
+                    units,
+                    cost,
+                    int(estimated),
+                ),
+            )
+            self.connection.commit()
+            # Running totals of a past period are loaded again for the new one
+            for period, key in keys.items():
+                totals = self.totals.get(period)
+                if totals is not None and totals["key"] == key:
+                    totals["tokens"] += prompt_tokens + completion_tokens
+                    totals["cost"] += cost
+        for tally in context["tallies"]:
+            tally["prompt_tokens"] += prompt_tokens
+            tally["completion_tokens"] += completion_tokens
+            tally["cost"] += cost
+
+    # Get the tokens and cost spent in the current day or month, summed from the ledger once per period
+    def get_spent(self, period: str) -> dict:
+        column = "day" if period == "daily" else "month"
+        key = datetime.now().strftime(self.PERIODS[period])
+        with self.lock:
+            totals = self.totals.get(period)
+            if totals is None or totals["key"] != key:
+                tokens, cost = self.connection.execute(
+                    "SELECT SUM(prompt_tokens + completion_tokens), SUM(cost) FROM usage WHERE {} = ?".format(column),
+                    (key,),
+                ).fetchone()
+                totals = self.totals[period] = {"key": key, "tokens": tokens or 0, "cost": cost or 0.0}
+            return {"tokens": totals["tokens"], "cost": totals["cost"]}
+
+    # Get the most used share of a budget, with its name
+    def get_level(self) -> tuple[float, str]:
+        level, name = 0.0, ""
+        for period, budget in self.budgets.items():
+            spent = None
+            for kind, limit in budget.items():
+                if limit:
+                    spent = spent or self.get_spent(period)
+                    if spent[kind] / limit > level:
+                        level, name = spent[kind] / limit, "{} {}".format(period, kind)
+        return level, name
+
+    # Check a call against the budgets: refused over a budget, batch jobs are slowed down near it
+    def check(self, endpoint: str, model: str = "") -> None:
+        if not self.enabled or endpoint == "models":
+            return
+        # A cost budget can't be enforced on calls that have no price
+        if model and self.has_cost_budget() and not self.get_price(model):
+            raise ValueError("No price for {} in [usage.prices], needed by the cost budgets".format(model))
+        level, name = self.get_level()
+        if level >= 1:
+            raise BudgetExceededError("{} budget reached ({:.0%})".format(name, level))
+        if level >= self.throttle_at and self.get_context().get("batch"):
+            self.logger.info("{} budget at {:.0%}, throttling batch calls".format(name, level))
+            sleep(self.throttle_delay)
+
+    # Get the model of a chat request, downgraded near a budget
+    def downgrade(self, model: str) -> str:
+        if not self.enabled or not self.downgrade_model or model == self.downgrade_model:
+            return model
+        level, name = self.get_level()
+        if level >= self.throttle_at:
+            self.logger.info("{} budget at {:.0%}, {} downgraded to {}".format(name, level, model, self.downgrade_model))
+            return self.downgrade_model
+        return model
+
+    # Get the usage of the current day and month, against the budgets, and the monthly usage by dimension
+    def get_report(self) -> dict:
+        report = {"budgets": {}, "breakdown": {}}
+        for period, budget in self.budgets.items():
+            spent = self.get_spent(period)
+            report["budgets"][period] = {
+                "tokens": spent["tokens"],
+                "cost": round(spent["cost"], 4),
+                "token_budget": budget["tokens"],
+                "cost_budget": budget["cost"],
+            }
+        month = datetime.now().strftime(self.PERIODS["monthly"])
+        with self.lock:
+            for dimension in self.DIMENSIONS:
+                rows = self.connection.execute(
+                    "SELECT {0}, SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), COUNT(*) FROM usage "
+                    "WHERE month = ? GROUP BY {0} ORDER BY SUM(cost) DESC, SUM(prompt_tokens + completion_tokens) DESC".format(dimension),
+                    (month,),
+                ).fetchall()
+                report["breakdown"][dimension] = [
+                    {"name": name, "prompt_tokens": prompt, "completion_tokens": completion, "cost": round(cost, 4), "calls": calls}
+                    for name, prompt, completion, cost, calls in rows
+                ]
+        return report
+
+
+class MeteredStream:
+    """Metered stream class, records the usage sent with the last chunk of a streamed chat completion,
+    and holds its endpoint slot until the stream ends"""
+
+    def __init__(self, stream, record=None, release=None):
+        self.stream = stream
+        self.record = record  # Called once, with the reported usage or None
+        self.release = release  # Called once, when the stream ends or is closed
+        self.recorded = record is None
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            for chunk in self.stream:
+                usage = getattr(chunk, "usage", None)
+                if usage and not self.recorded:
+                    self.recorded = True
+                    self.record(usage)
+                yield chunk
+        finally:
+            # Also when the stream fails or its consumer drops it
+            self.finish()
+
+    # Record an estimate if the stream ended or was cancelled without usage, and free its slot
+    def finish(self) -> None:
+        with self.lock:
+            record = not self.recorded
+            self.recorded = True
+            release, self.release = self.release, None
+        try:
+            if record:
+                self.record(None)
+        finally:
+            if release is not None:
+                release()
+
+    def close(self) -> None:
+        self.finish()
+        self.stream.close()
+
+
+class ApiClient:
+    """API client class, every OpenAI call goes through here"""
+
+    ENDPOINTS = ["chat", "embeddings", "audio", "images", "models"]
+    RETRY_STATUS = [408, 409, 429, 500, 502, 503, 504]
+
+    def __init__(self, config: dict, logger: logging.Logger, ledger: UsageLedger | None = None):
+        self.logger = logger
+        self.ledger = ledger  # Records the usage of every call
+        self.configure(config)
+
+        # Shared keep-alive connection pool
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=self.api_config.get("max_connections", 20),
+                max_keepalive_connections=self.api_config.get("max_keepalive_connections", 10),
+                keepalive_expiry=self.api_config.get("keepalive_expiry", 60),
+            ),
+            timeout=self.api_config.get("timeout", 120),
+        )
+        self.client = self.make_client()
+
+    # Apply the retry, rate limit and concurrency settings
+    def configure(self, config: dict) -> None:
+        self.api_config = config.get("api", {})
+        self.max_retries = self.api_config.get("max_retries", 5)
+        self.backoff_base = self.api_config.get("backoff_base", 0.5)
+        self.backoff_max = self.api_config.get("backoff_max", 30)
+
+        # Rate limits, 0 means unlimited
+        self.request_bucket = TokenBucket(self.api_config.get("rpm", 0))
+        self.token_bucket = TokenBucket(self.api_config.get("tpm", 0))
+
+        # Concurrency caps per endpoint
+        concurrency = self.api_config.get("concurrency", {})
+        self.semaphores = {
+            endpoint: threading.BoundedSemaphore(concurrency.get(endpoint, 4))
+            for endpoint in self.ENDPOINTS
+        }
+
+    # Create an OpenAI client sharing the connection pool
+    def make_client(self, base_url: str | None = None, api_key: str | None = None) -> OpenAI:
+        # Retries are handled by call()
+        return OpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=self.http_client,
+            max_retries=0,
+        )
+
+    # Check if an error is worth retrying
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, APIConnectionError):
+            return True
+        if isinstance(error, APIStatusError):
+            return error.status_code in self.RETRY_STATUS
+        return False
+
+    # Get the number of seconds to wait before the next attempt
+    def get_backoff(self, attempt: int, error: Exception) -> float:
+        if isinstance(error, APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # Call an API function with budgets, rate limiting, concurrency caps and retries
+    # (units are what audio and images are billed by: seconds, characters or images)
+    def call(self, endpoint: str, function, *args, tokens: int = 0, units: float = 0, **kwargs):
+        if self.ledger is not None:
+            self.ledger.check(endpoint, kwargs.get("model", ""))
+            if kwargs.get("stream") and endpoint == "chat":
+                # The usage comes with the last chunk (stream_options isn't a parameter of this SDK version)
+                kwargs["extra_body"] = dict(kwargs.get("extra_body") or {}, stream_options={"include_usage": True})
+        for attempt in range(self.max_retries + 1):
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(tokens)
+            try:
+                stream = kwargs.get("stream", False)
+                semaphore = self.semaphores[endpoint]
+                semaphore.acquire()
+                try:
+                    response = function(*args, **kwargs)
+                except Exception:
+                    semaphore.release()
+                    raise
+                if not stream:
+                    semaphore.release()
+                # A stream holds its slot until it is exhausted or closed
+                return self.meter(
+                    endpoint, kwargs.get("model", ""), response, tokens, units, stream, semaphore.release if stream else None
+                )
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e):
+                    raise
+                backoff = self.get_backoff(attempt, e)
+                self.logger.info(
+                    "{} call failed ({}), retrying in {:.1f}s".format(endpoint, e, backoff)
+                )
+                sleep(backoff)
+
+    # Wrap a function run in another thread, so that its calls keep the usage attribution of this one
+    def bind(self, function):
+        return self.ledger.bind(function) if self.ledger is not None else function
+
+    # Record the usage of a response, streams when they end (releasing their slot)
+    def meter(self, endpoint: str, model: str, response, tokens: int, units: float, stream: bool = False, release=None):
+        if stream:
+            record = None
+            if self.ledger is not None:
+                record = self.ledger.bind(lambda usage: self.ledger.record(endpoint, model, usage, tokens, units))
+            return MeteredStream(response, record, release)
+        if self.ledger is None or endpoint == "models":
+            return response
+        self.ledger.record(endpoint, model, getattr(response, "usage", None), tokens if not units else 0, units)
+        return response
+
+    # Estimate the number of tokens in a text
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        return len(text) // 4 + 1
+
+
+class EmbeddingCache:
+    """Embedding cache class, content-addressed and shared by all vector dbs"""
+
+    def __init__(self, config: dict, logger: logging.Logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.connection = None
+        self.configure(config)
+
+    # Apply the cache settings, and open the cache file
+    def configure(self, config: dict) -> None:
+        embeddings_config = config.get("embeddings", {})
+        self.enabled = embeddings_config.get("cache", True)
+        self.max_size = embeddings_config.get("cache_max_size", 512) * 1024 * 1024
+        cache_file = os.path.expanduser(
+            embeddings_config.get("cache_file", "~/.config/neuma/embeddings.sqlite")
+        )
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT,
+                    hash TEXT,
+                    vector BLOB,
+                    last_used REAL,
+                    PRIMARY KEY (model, hash)
+                );
+                CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+                CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+                """
+            )
+            # The size of the vectors is kept with the stats, summed once for caches that predate it
+            self.connection.execute(
+                "INSERT OR IGNORE INTO stats (name, value) SELECT 'size', COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            )
+            self.connection.commit()
+
+    # Get the hash of a text
+    @staticmethod
+    def get_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    # Get cached vectors, by hash
+    def get_many(self, model: str, hashes: list[str]) -> dict:
+        vectors = {}
+        with self.lock:
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                rows = self.connection.execute(
+                    "SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({})".format(
+                        ",".join("?" * len(batch))
+                    ),
+                    [model] + batch,
+                ).fetchall()
+                for text_hash, vector in rows:
+                    vectors[text_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+            if vectors:
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(time.time(), model, text_hash) for text_hash in vectors],
+                )
+                self.connection.commit()
+        return vectors
+
+    # Store vectors, by hash, and add to the counters, in one transaction
+    def put_many(self, model: str, vectors: dict, counters: dict | None = None) -> None:
+        counters = dict(counters or {})
+        with self.lock:
+            added = 0
+            for text_hash, vector in vectors.items():
+                vector = np.asarray(vector, dtype=np.float32).tobytes()
+                # A vector stored meanwhile by another thread is the same vector
+                if self.connection.execute(
+                    "INSERT OR IGNORE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                    (model, text_hash, vector, time.time()),
+                ).rowcount:
+                    added += len(vector)
+            counters["size"] = added
+            self.add_counters(counters)
+            self.connection.commit()
+            if added:
+                self.evict()
+
+    # Get the size of the cached vectors, in bytes
+    def get_size(self) -> int:
+        with self.lock:
+            return self.get_counter("size")
+
+    # Get a counter, with the lock held
+    def get_counter(self, name: str) -> int:
+        row = self.connection.execute("SELECT value FROM stats WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    # Drop the least recently used vectors until the cache fits its size limit, with the lock held
+    def evict(self) -> None:
+        size = self.get_counter("size")
+        while size > self.max_size:
+            rows = self.connection.execute(
+                "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for rowid, row_size in rows:
+                if size <= self.max_size:
+                    break
+                evicted.append((rowid,))
+                size -= row_size
+            self.connection.executemany("DELETE FROM embeddings WHERE rowid = ?", evicted)
+            self.add_counters({"evicted": len(evicted), "size": size - self.get_counter("size")})
+            self.connection.commit()
+
+    # Add to counters, with the lock held (committed by the caller)
+    def add_counters(self, counters: dict) -> None:
+        self.connection.executemany(
+            "INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+            [(name, value, value) for name, value in counters.items() if value],
+        )
+
+    # Get the cache stats
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.connection.execute("SELECT name, value FROM stats").fetchall())
+            entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        stats["entries"] = entries
+        stats["size"] = str(int(stats.get("size", 0) / 1024)) + "K"
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        if lookups:
+            stats["hit_rate"] = "{:.1%}".format(stats.get("hits", 0) / lookups)
+        return stats
+
+
+class ApiEmbeddings(Embeddings):
+    """Embeddings class, sends langchain embedding calls through the API client"""
+
+    def __init__(self, api: ApiClient, model: str, batch_size: int = 256, cache: EmbeddingCache | None = None):
+        self.api = api
+        self.model = model
+        self.batch_size = batch_size
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed(texts)
+
+    # Embed texts through the cache, queries aren't counted in the cache stats
+    def embed(self, texts: list[str], record: bool = True) -> list[list[float]]:
+        hashes = [EmbeddingCache.get_hash(text) for text in texts]
+        use_cache = self.cache is not None and self.cache.enabled
+        vectors = self.cache.get_many(self.model, list(set(hashes))) if use_cache else {}
+
+        # Embed each missing text once
+        missing = {}
+        for text_hash, text in zip(hashes, texts):
+            if text_hash not in vectors:
+                missing[text_hash] = text
+        missing_hashes = list(missing)
+        new_vectors = {}
+        for i in range(0, len(missing_hashes), self.batch_size):
+            batch = [missing[text_hash] for text_hash in missing_hashes[i:i + self.batch_size]]
+            response = self.api.call(
+                "embeddings",
+                self.api.client.embeddings.create,
+                model=self.model,
+                input=batch,
+                tokens=sum(self.api.count_tokens(text) for text in batch),
+            )
+            for text_hash, item in zip(missing_hashes[i:i + self.batch_size], response.data):
+                new_vectors[text_hash] = item.embedding
+
+        if use_cache and (new_vectors or record):
+            counters = {}
+            if record:
+                hits = [text for text_hash, text in zip(hashes, texts) if text_hash in vectors]
+                counters = {
+                    "hits": len(hits),
+                    "misses": len(new_vectors),
+                    "tokens_saved": sum(self.api.count_tokens(text) for text in hits),
+                }
+            self.cache.put_many(self.model, new_vectors, counters)
+
+        vectors.update(new_vectors)
+        return [vectors[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed([text], record=False)[0]
+
+    # Wrap a function run in another thread, so that its calls keep the usage attribution of this one
+    def bind(self, function):
+        return self.api.bind(function)
+
+
+class ModelRouter:
+    """Model router class, picks a model per request and caches model metadata"""
+
+    # Rough context windows, used when the API doesn't report one
+    CONTEXT_WINDOWS = {
+        "gpt-4o": 128000,
+        "gpt-4-turbo": 128000,
+        "gpt-4-0125": 128000,
+        "gpt-4-1106": 128000,
+        "gpt-4-32k": 32768,
+        "gpt-4": 8192,
+        "gpt-3.5-turbo-16k": 16385,
+        "gpt-3.5-turbo-instruct": 4096,
+        "gpt-3.5-turbo": 16385,
+    }
+
+    def __init__(self, config: dict, logger: logging.Logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.dirty = False  # Latencies recorded since the last save
+        self.saved = time.time()
+        self.configure(config)
+        atexit.register(self.flush)
+
+    # Apply the router settings
+    def configure(self, config: dict) -> None:
+        if self.dirty:
+            self.flush()
+        self.config = config
+        self.router_config = config.get("router", {})
+        self.cache_file = os.path.expanduser(
+            self.router_config.get("cache_file", "~/.config/neuma/models.json")
+        )
+        self.cache_ttl = self.router_config.get("cache_ttl", 86400)
+        self.save_interval = self.router_config.get("save_interval", 60)
+        self.cache = self.load_cache()
+
+    # Load the model metadata cache from disk
+    def load_cache(self) -> dict:
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except Exception:
+            return {"fetched": 0, "models": {}}
+
+    # Write the model metadata cache to disk
+    def save_cache(self) -> None:
+        with self.lock:
+            data = json.dumps(self.cache)
+            self.dirty = False
+            self.saved = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, "w") as f:
+                f.write(data)
+        except Exception as e:
+            self.logger.exception(e)
+
+    # Write the recorded latencies to disk, if any
+    def flush(self) -> None:
+        if self.dirty:
+            self.save_cache()
+
+    # Check if the cached model list is still fresh
+    def is_fresh(self) -> bool:
+        return time.time() - self.cache.get("fetched", 0) < self.cache_ttl
+
+    # Refresh the model list from the API
+    def refresh(self, api: ApiClient) -> None:
+        models = api.call("models", api.client.models.list)
+        context_windows = {model.id: self.get_context_window(model.id) for model in models}
+        with self.lock:
+            cached_models = self.cache.setdefault("models", {})
+            for model in models:
+                metadata = cached_models.setdefault(model.id, {})
+                metadata["created"] = model.created
+                metadata["context_window"] = context_windows[model.id]
+            self.cache["fetched"] = time.time()
+        self.save_cache()
+
+    # List models, from cache if fresh
+    def list_models(self, api: ApiClient) -> list:
+        if not self.is_fresh() or not self.cache.get("models"):
+            self.logger.info("Model cache stale, refreshing")
+            self.refresh(api)
+        models = sorted(
+            self.cache["models"].items(),
+            key=lambda x: x[1].get("created", 0),
+            reverse=True,
+        )
+        return [model_id for model_id, _metadata in models]
+
+    # Get the context window of a model
+    def get_context_window(self, model: str) -> int:
+        cached = self.cache.get("models", {}).get(model, {})
+        if "context_window" in cached:
+            return cached["context_window"]
+        # Longest matching prefix wins
+        for prefix in sorted(self.CONTEXT_WINDOWS, key=len, reverse=True):
+            if model.startswith(prefix):
+                return self.CONTEXT_WINDOWS[prefix]
+        return 4096
+
+    # Get the observed latency of a model (in seconds)
+    def get_latency(self, model: str) -> float:
+        return self.cache.get("models", {}).get(model, {}).get("latency", float("inf"))
+
+    # Record an observed latency, as an exponential moving average (saved every save_interval seconds and at exit)
+    def record_latency(self, model: str, latency: float) -> None:
+        with self.lock:
+            metadata = self.cache.setdefault("models", {}).setdefault(model, {})
+            previous = metadata.get("latency")
+            if previous is None:
+                metadata["latency"] = latency
+            else:
+                metadata["latency"] = 0.8 * previous + 0.2 * latency
+            self.dirty = True
+            due = time.time() - self.saved >= self.save_interval
+        if due:
+            self.save_cache()
+
+    # Estimate the number of tokens in a list of messages
+    @staticmethod
+    def count_tokens(messages: list) -> int:
+        characters = sum(len(str(message.get("content", ""))) for message in messages)
+        return characters // 4 + 4 * len(messages)
+
+    # Check if a rule matches the request
+    def rule_matches(self, rule: dict, request: dict) -> bool:
+        modes = rule.get("mode")
+        if modes is not None:
+            if isinstance(modes, str):
+                modes = [modes]
+            if request["mode"] not in modes:
+                return False
+        personae = rule.get("persona")
+        if personae is not None:
+            if isinstance(personae, str):
+                personae = [personae]
+            if request["persona"] not in personae:
+                return False
+        if "rag" in rule and rule["rag"] != request["rag"]:
+            return False
+        if "max_prompt_tokens" in rule and request["tokens"] > rule["max_prompt_tokens"]:
+            return False
+        if "min_prompt_tokens" in rule and request["tokens"] < rule["min_prompt_tokens"]:
+            return False
+        return True
+
+    # Pick the fastest model that can hold the prompt
+    def fastest_model(self, candidates: list, tokens: int) -> str | None:
+        adequate = [
+            model for model in candidates
+            if self.get_context_window(model) > tokens
+        ]
+        if not adequate:
+            return None
+        # Keep the configured order for models with no recorded latency yet
+        return min(adequate, key=lambda model: (self.get_latency(model), adequate.index(model)))
+
+    # Route a request to a model
+    def route(
+            self,
+            messages: list,
+            mode: str,
+            persona: str,
+            rag: bool,
+            quick: bool = False,
+            model: str | None = None,
+    ) -> str:
+        # A model picked for the session replaces the configured one
+        default_model = model or self.config["openai"]["model"]
+        if not self.router_config.get("enabled", False):
+            return default_model
+
+        request = {
+            "mode": mode,
+            "persona": persona,
+            "rag": rag,
+            "tokens": self.count_tokens(messages),
+        }
+        self.logger.info("Routing request: {}".format(request))
+
+        for rule in self.router_config.get("rule", []):
+            if self.rule_matches(rule, request):
+                self.logger.info("Matched rule: {}".format(rule))
+                return rule["model"]
+
+        # Shell integration calls go to the fastest adequate model
+        if quick:
+            fast_model = self.fastest_model(
+                self.router_config.get("fast_models", []), request["tokens"]
+            )
+            if fast_model:
+                return fast_model
+
+        return default_model
+
+
+class RequestHedger:
+    """Request hedger class, races a duplicate request when the first token is late"""
+
+    def __init__(self, config: dict, logger: logging.Logger, api: ApiClient):
+        self.logger = logger
+        self.api = api
+        self.samples = {}  # Time to first token per model
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0}
+        self.lock = threading.Lock()
+        self.configure(config)
+
+    # Apply the hedging settings
+    def configure(self, config: dict) -> None:
+        self.hedging_config = config.get("hedging", {})
+        self.enabled = self.hedging_config.get("enabled", False)
+        self.percentile = self.hedging_config.get("percentile", 95)
+        self.min_delay = self.hedging_config.get("min_delay", 1.0)
+        self.min_samples = self.hedging_config.get("min_samples", 20)
+        self.fallback_model = self.hedging_config.get("fallback_model", "")
+
+        # Optional second OpenAI compatible endpoint
+        base_url = self.hedging_config.get("base_url", "")
+        if base_url:
+            self.hedge_client = self.api.make_client(
+                base_url=base_url,
+                api_key=self.hedging_config.get("api_key", os.environ.get("OPENAI_API_KEY")),
+            )
+        else:
+            self.hedge_client = None
+
+    # Record the time to first token of a model
+    def record(self, model: str, latency: float) -> None:
+        with self.lock:
+            samples = self.samples.setdefault(model, [])
+            samples.append(latency)
+            # Keep a bounded window of recent samples
+            if len(samples) > 500:
+                del samples[0]
+
+    # Get a percentile of the recorded latencies of a model
+    def get_percentile(self, model: str, percentile: float) -> float | None:
+        with self.lock:
+            samples = sorted(self.samples.get(model, []))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+    # Get the delay after which a duplicate request is fired
+    def get_delay(self, model: str) -> float:
+        if len(self.samples.get(model, [])) < self.min_samples:
+            return self.min_delay
+        return max(self.min_delay, self.get_percentile(model, self.percentile))
+
+    # Get hedging stats
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        if stats["requests"]:
+            stats["hedge_rate"] = "{:.1%}".format(stats["hedged"] / stats["requests"])
+        stats["latency"] = {}
+        for model in list(self.samples):
+            stats["latency"][model] = {
+                "samples": len(self.samples[model]),
+                "p50": round(self.get_percentile(model, 50), 3),
+                "p95": round(self.get_percentile(model, 95), 3),
+                "p99": round(self.get_percentile(model, 99), 3),
+                "delay": round(self.get_delay(model), 3),
+            }
+        return stats
+
+    # Generate a chat completion, hedging it if the first token is late
+    def create(self, model: str, messages: list, temperature: float) -> tuple[str, str]:
+        with self.lock:
+            self.stats["requests"] += 1
+        condition = threading.Condition()
+        state = {"winner": None}
+        attempts = []
+
+        def run(attempt: dict) -> None:
+            start_time = attempt["start_time"]
+            try:
+                stream = self.api.call(
+                    "chat",
+                    attempt["client"].chat.completions.create,
+                    model=attempt["model"],
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    tokens=ModelRouter.count_tokens(messages),
+                )
+                attempt["stream"] = stream
+                chunks = []
+                for chunk in stream:
+                    with condition:
+                        if state["winner"] is None:
+                            state["winner"] = attempt
+                            self.record(attempt["model"], time.time() - start_time)
+                            condition.notify_all()
+                        elif state["winner"] is not attempt:
+                            # Another attempt won, cancel this one
+                            stream.close()
+                            return
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                attempt["response"] = "".join(chunks)
+            except Exception as e:
+                attempt["error"] = e
+            finally:
+                with condition:
+                    attempt["done"] = True
+                    condition.notify_all()
+
+        def launch(attempt_client: OpenAI, attempt_model: str) -> None:
+            attempt = {"client": attempt_client, "model": attempt_model, "done": False, "start_time": time.time()}
+            attempts.append(attempt)
+            threading.Thread(target=self.api.bind(run), args=(attempt,), daemon=True).start()
+
+        def settled() -> bool:
+            return state["winner"] is not None or all(a["done"] for a in attempts)
+
+        launch(self.api.client, model)
+        delay = self.get_delay(model)
+        self.logger.info("Hedge delay for {}: {}s".format(model, delay))
+
+        with condition:
+            # Fire a duplicate request if the first token is late
+            if not condition.wait_for(settled, timeout=delay) or state["winner"] is None:
+                hedge_model = self.fallback_model or model
+                self.logger.info("Hedging request with {}".format(hedge_model))
+                with self.lock:
+                    self.stats["hedged"] += 1
+                launch(self.hedge_client or self.api.client, hedge_model)
+
+            # Wait for a winner, or for every attempt to fail
+            condition.wait_for(settled)
+            winner = state["winner"]
+
+        if winner is None:
+            raise attempts[0]["error"]
+
+        # Cancel the other attempts
+        for attempt in attempts:
+            if attempt is winner:
+                continue
+            # A cancelled attempt had no first token yet, its elapsed time is a lower bound of its latency
+            if not attempt["done"]:
+                self.record(attempt["model"], time.time() - attempt["start_time"])
+            if attempt.get("stream") is not None:
+                try:
+                    attempt["stream"].close()
+                except Exception:
+                    pass
+
+        if winner is not attempts[0]:
+            with self.lock:
+                self.stats["hedge_wins"] += 1
+
+        with condition:
+            condition.wait_for(lambda: winner["done"])
+        if "error" in winner:
+            raise winner["error"]
+        return winner["response"], winner["model"]
+
+
+class ImagePipeline:
+    """Image pipeline class, generates image variants in the background"""
+
+    def __init__(self, config: dict, logger: logging.Logger, api: ApiClient):
+        self.logger = logger
+        self.api = api
+        self.lock = threading.Lock()
+        self.configure(config)
+
+    # Apply the image settings
+    def configure(self, config: dict) -> None:
+        self.images_config = config["images"]
+        if hasattr(self, "executor"):
+            self.executor.shutdown(wait=False)
+        self.path = os.path.expanduser(self.images_config["path"])
+        self.variants = self.images_config.get("variants", 1)
+        self.index_file = os.path.join(self.path, "index.json")
+        self.executor = ThreadPoolExecutor(max_workers=self.images_config.get("workers", 4))
+        self.index = self.load_index()
+
+    # Load the prompt hash index from disk
+    def load_index(self) -> dict:
+        try:
+            with open(self.index_file, "r") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    # Write the prompt hash index to disk
+    def save_index(self) -> None:
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.index_file, "w") as f:
+                json.dump(self.index, f)
+
+    # Get the cache key of a prompt
+    def get_key(self, prompt: str) -> str:
+        key = [
+            self.images_config["model"],
+            self.images_config["size"],
+            self.images_config["quality"],
+            self.variants,
+            prompt.strip(),
+        ]
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    # Get cached images for a prompt
+    def get_cached(self, prompt: str) -> list | None:
+        paths = self.index.get(self.get_key(prompt))
+        if paths and all(os.path.isfile(path) for path in paths):
+            return paths
+        return None
+
+    # Generate one variant and write it to disk
+    def generate_variant(self, prompt: str, filename: str) -> str:
+        response = self.api.call(
+            "images",
+            self.api.client.images.generate,
+            model=self.images_config["model"],
+            prompt=prompt,
+            size=self.images_config["size"],
+            quality=self.images_config["quality"],
+            n=1,
+            response_format="b64_json",
+            units=1,
+        )
+        image_fullpath = os.path.join(self.path, filename)
+        with open(image_fullpath, "wb") as f:
+            f.write(base64.b64decode(response.data[0].b64_json))
+        return image_fullpath
+
+    # Generate all variants concurrently
+    def generate(self, prompt: str) -> list:
+        cached = self.get_cached(prompt)
+        if cached:
+            self.logger.info("Images found in cache: {}".format(cached))
+            return cached
+
+        from slugify import slugify  # Images are only loaded when used
+
+        os.makedirs(self.path, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        basename = slugify(prompt)[:100] + "-" + timestamp
+        futures = []
+        for i in range(self.variants):
+            suffix = "-{}".format(i + 1) if self.variants > 1 else ""
+            futures.append(
+                self.executor.submit(self.api.bind(self.generate_variant), prompt, basename + suffix + ".png")
+            )
+        paths = [future.result() for future in futures]
+
+        self.index[self.get_key(prompt)] = paths
+        self.save_index()
+        return paths
+
+    # Generate in a background thread, then call back with the paths or the error
+    def submit(self, prompt: str, callback) -> threading.Thread:
+        def run() -> None:
+            try:
+                paths = self.generate(prompt)
+                self.open(paths)
+                callback(paths)
+            except Exception as e:
+                self.logger.exception(e)
+                callback(e)
+
+        thread = threading.Thread(target=self.api.bind(run), daemon=True)
+        thread.start()
+        return thread
+
+    # Open images in the viewer, without waiting for it to close
+    def open(self, paths: list) -> None:
+        if not self.images_config["open"]:
+            return
+        try:
+            subprocess.Popen(
+                self.images_config["open_command"].split() + paths,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except Exception as e:
+            self.logger.exception(e)
+
+
+class FileWatcher:
+    """File watcher class, reports changed files under folders (with inotify on Linux, polling elsewhere)"""
+
+    # inotify flags and event masks
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, callback, poll_interval: float = 2.0):
+        self.callback = callback  # Called with each changed file
+        self.poll_interval = poll_interval
+        self.folders = []
+        self.watches = {}  # Watched folders, by inotify watch descriptor
+        self.mtimes = {}  # Modification times of the files, when polling
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.libc = None
+        self.fd = None
+        if sys.platform.startswith("linux"):
+            try:
+                self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+                self.fd = fd if fd >= 0 else None
+            except (OSError, AttributeError):
+                self.fd = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Skip hidden files and folders below the watched folder, and editor backups
+    @staticmethod
+    def is_ignored(path: str, root: str) -> bool:
+        relative = os.path.relpath(path, root)
+        return any(part.startswith(".") for part in relative.split(os.sep) if part not in ["", ".", ".."]) \
+            or path.endswith("~")
+
+    # Find the watched folder of a path
+    def get_root(self, path: str) -> str:
+        with self.lock:
+            roots = [folder for folder in self.folders if path.startswith(folder.rstrip(os.sep) + os.sep)]
+        return max(roots, key=len) if roots else os.path.dirname(path)
+
+    # Watch a folder and its subfolders
+    def add(self, folder: str) -> None:
+        with self.lock:
+            if folder not in self.folders:
+                self.folders.append(folder)
+            for path, folders, files in os.walk(folder):
+                folders[:] = [name for name in folders if not name.startswith(".")]
+                if self.fd is not None:
+                    wd = self.libc.inotify_add_watch(self.fd, path.encode(), self.WATCH_MASK)
+                    if wd >= 0:
+                        self.watches[wd] = path
+                else:
+                    for name in files:
+                        file_path = os.path.join(path, name)
+                        self.mtimes[file_path] = self.get_mtime(file_path)
+
+    # Stop watching a folder and its subfolders
+    def remove(self, folder: str) -> None:
+        with self.lock:
+            self.folders = [path for path in self.folders if path != folder]
+            inside = lambda path: path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+            for wd, path in list(self.watches.items()):
+                if inside(path):
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                    del self.watches[wd]
+            self.mtimes = {path: mtime for path, mtime in self.mtimes.items() if not inside(path)}
+
+    # Stop watching
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+
+    @staticmethod
+    def get_mtime(path: str) -> float | None:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    # Report a changed file
+    def report(self, path: str) -> None:
+        if not self.is_ignored(path, self.get_root(path)):
+            self.callback(path)
+
+    # Read inotify events
+    def read_events(self) -> None:
+        readable, _, _ = select.select([self.fd], [], [], self.poll_interval)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0").decode(errors="replace")
+            offset += 16 + length
+            with self.lock:
+                folder = self.watches.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, name)
+            if mask & self.IN_ISDIR:
+                # New folders are watched, and their files reported
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and not self.is_ignored(path, self.get_root(path)):
+                    self.add_subfolder(path)
+                continue
+            self.report(path)
+
+    # Watch a new subfolder, reporting the files it already has
+    def add_subfolder(self, folder: str) -> None:
+        with self.lock:
+            for path, folders, files in os.walk(folder):
+                folders[:] = [name for name in folders if not name.startswith(".")]
+                wd = self.libc.inotify_add_watch(self.fd, path.encode(), self.WATCH_MASK)
+                if wd >= 0:
+                    self.watches[wd] = path
+                paths = [os.path.join(path, name) for name in files]
+        for path in paths:
+            self.report(path)
+
+    # Compare modification times
+    def poll(self) -> None:
+        self.stopped.wait(self.poll_interval)
+        with self.lock:
+            mtimes = {}
+            for folder in self.folders:
+                for path, folders, files in os.walk(folder):
+                    folders[:] = [name for name in folders if not name.startswith(".")]
+                    for name in files:
+                        file_path = os.path.join(path, name)
+                        mtimes[file_path] = self.get_mtime(file_path)
+            changed = [path for path in set(mtimes) | set(self.mtimes) if mtimes.get(path) != self.mtimes.get(path)]
+            self.mtimes = mtimes
+        for path in changed:
+            self.report(path)
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                if self.fd is not None:
+                    self.read_events()
+                else:
+                    self.poll()
+            except Exception:
+                # A folder removed while walking it, picked up on the next round
+                self.stopped.wait(self.poll_interval)
+
+
+class AutoIngester:
+    """Auto ingester class, re-ingests the changed files of watched vector dbs in the background"""
+
+    def __init__(self, config: dict, logger: logging.Logger, ingest):
+        self.logger = logger
+        self.ingest = ingest  # Called with a vector db and a changed file
+        self.watchers = {}  # File watchers, by vector db
+        self.pending = {}  # (vector db, file) -> [first change, last change]
+        self.current = None  # (vector db, file, first change) being ingested
+        self.stats = {}  # Ingested files and errors, by vector db
+        self.condition = threading.Condition()
+        self.configure(config)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # Apply the [watch] section of the config
+    def configure(self, config: dict) -> None:
+        watch_config = config.get("watch", {})
+        self.debounce = watch_config.get("debounce", 2.0)
+        self.poll_interval = watch_config.get("poll_interval", 2.0)
+        self.hold_interval = config.get("usage", {}).get("hold_interval", 300)
+
+    # Watch a folder for a vector db
+    def watch(self, vector_db: str, folder: str) -> None:
+        folder = os.path.realpath(folder)
+        if vector_db not in self.watchers:
+            self.watchers[vector_db] = FileWatcher(
+                lambda path: self.enqueue(vector_db, path), self.poll_interval
+            )
+        self.watchers[vector_db].add(folder)
+        self.logger.info("Watching {} for {}".format(folder, vector_db))
+
+    # Stop watching the folders of a vector db, dropping its queued files
+    def unwatch(self, vector_db: str) -> None:
+        watcher = self.watchers.pop(vector_db, None)
+        if watcher is not None:
+            watcher.stop()
+        with self.condition:
+            self.pending = {key: times for key, times in self.pending.items() if key[0] != vector_db}
+
+    # Queue a changed file, bursts of changes are merged
+    def enqueue(self, vector_db: str, path: str) -> None:
+        now = time.time()
+        with self.condition:
+            self.pending.setdefault((vector_db, path), [now, now])[1] = now
+            self.condition.notify()
+
+    # Get the next file that has been quiet for the debounce delay
+    def next_file(self) -> tuple[str, str, float]:
+        with self.condition:
+            while True:
+                now = time.time()
+                ready = [key for key, (_first, last) in self.pending.items() if now - last >= self.debounce]
+                if ready:
+                    key = min(ready, key=lambda key: self.pending[key][0])
+                    first, _last = self.pending.pop(key)
+                    self.current = key + (first,)
+                    return self.current
+                self.condition.wait(self.debounce if not self.pending else self.debounce / 4)
+
+    def run(self) -> None:
+        while True:
+            vector_db, path, first = self.next_file()
+            stats = self.stats.setdefault(vector_db, {"ingested": 0, "errors": 0})
+            try:
+                chunks = self.ingest(vector_db, path)
+                stats["ingested"] += 1
+                stats.pop("held", None)
+                stats["last_lag"] = "{:.1f}s".format(time.time() - first)
+                self.logger.info("Re-ingested {} into {} ({} chunks)".format(path, vector_db, chunks))
+            except BudgetExceededError as e:
+                # Over budget, the file stays queued until the budget allows it
+                stats["held"] = str(e)
+                with self.condition:
+                    self.pending.setdefault((vector_db, path), [first, first])
+                    self.current = None
+                self.logger.info("Holding {} for {}s: {}".format(path, self.hold_interval, e))
+                sleep(self.hold_interval)
+                continue
+            except Exception as e:
+                stats["errors"] += 1
+                stats["last_error"] = "{}: {}".format(path, e)
+                self.logger.exception(e)
+            finally:
+                with self.condition:
+                    self.current = None
+
+    # Get the queue depth and lag of a vector db
+    def get_stats(self, vector_db: str) -> dict:
+        now = time.time()
+        with self.condition:
+            waiting = [first for (name, _path), (first, _last) in self.pending.items() if name == vector_db]
+            if self.current is not None and self.current[0] == vector_db:
+                waiting.append(self.current[2])
+        watcher = self.watchers.get(vector_db)
+        stats = {
+            "folders": watcher.folders if watcher else [],
+            "queue": len(waiting),
+            "lag": "{:.1f}s".format(now - min(waiting)) if waiting else "0.0s",
+        }
+        stats.update(self.stats.get(vector_db, {}))
+        return stats
+
+
+class WebCrawler:
+    """Web crawler class, fetches pages and sitemaps concurrently, politely and incrementally"""
+
+    def __init__(self, config: dict, logger: logging.Logger, compactor: "ContentCompactor"):
+        self.logger = logger
+        self.compactor = compactor  # Extracts the text of pages
+        self.configure(config)
+
+    # Apply the [crawl] section of the config
+    def configure(self, config: dict) -> None:
+        crawl_config = config.get("crawl", {})
+        self.max_depth = crawl_config.get("max_depth", 2)
+        self.max_pages = crawl_config.get("max_pages", 500)
+        self.concurrency = crawl_config.get("concurrency", 16)
+        self.per_host = crawl_config.get("per_host", 4)
+        self.timeout = crawl_config.get("timeout", 20)
+        self.user_agent = crawl_config.get("user_agent", "neuma")
+        self.robots = crawl_config.get("robots", True)
+
+    # Check if a URL points to a sitemap
+    @staticmethod
+    def is_sitemap(url: str) -> bool:
+        return urllib.parse.urlparse(url).path.endswith(".xml")
+
+    # Get the links of a page, without fragments
+    @staticmethod
+    def get_links(html: str, base_url: str) -> list[str]:
+        links = []
+        for anchor in BeautifulSoup(html, "html.parser").find_all("a", href=True):
+            link = urllib.parse.urldefrag(urllib.parse.urljoin(base_url, anchor["href"]))[0]
+            if urllib.parse.urlparse(link).scheme in ["http", "https"]:
+                links.append(link)
+        return list(dict.fromkeys(links))
+
+    # Fetch the robots.txt of a site, a missing one allows everything
+    async def get_robots(self, client, origin: str) -> urllib.robotparser.RobotFileParser:
+        robots = urllib.robotparser.RobotFileParser(origin + "/robots.txt")
+        try:
+            response = await client.get(origin + "/robots.txt")
+            if response.status_code in [401, 403]:
+                robots.disallow_all = True
+            elif response.status_code == 200:
+                robots.parse(response.text.splitlines())
+            else:
+                robots.allow_all = True
+        except Exception as e:
+            self.logger.info("No robots.txt for {}: {}".format(origin, e))
+            robots.allow_all = True
+        return robots
+
+    # Get the page URLs of a sitemap, following sitemap indexes
+    async def get_sitemap(self, client, url: str, depth: int = 0) -> list[str]:
+        response = await client.get(url)
+        response.raise_for_status()
+        root = ElementTree.fromstring(response.content)
+        locations = [element.text.strip() for element in root.iter() if element.tag.endswith("loc") and element.text]
+        if not root.tag.endswith("sitemapindex"):
+            return locations
+        urls = []
+        for location in locations if depth < 3 else []:
+            urls += await self.get_sitemap(client, location, depth + 1)
+        return urls
+
+    # Crawl from seed pages and sitemaps, calling back (in a thread) with the text of new and changed pages
+    # state holds the validators, content hash and links of the pages of a previous crawl, and is updated
+    async def crawl(self, seeds: list[str], state: dict, on_page) -> dict:
+        stats = {"pages": 0, "changed": 0, "unchanged": 0, "not_modified": 0, "removed": 0, "skipped": 0, "errors": 0}
+        queue = asyncio.Queue()
+        pages = asyncio.Queue(maxsize=self.concurrency)  # Changed pages, waiting to be ingested
+        seen = set()
+        fetched = set()  # Final urls of the fetched pages, after redirects
+        scope = set()  # Hosts of the seeds, links elsewhere aren't followed
+        robots = {}  # robots.txt fetches, by origin
+        hosts = {}  # Concurrency limits, by host
+
+        def add(url: str, depth: int) -> None:
+            if url not in seen and len(seen) < self.max_pages and urllib.parse.urlparse(url).netloc in scope:
+                seen.add(url)
+                queue.put_nowait((url, depth))
+
+        async def allowed(url: str) -> bool:
+            if not self.robots:
+                return True
+            parsed = urllib.parse.urlparse(url)
+            origin = "{}://{}".format(parsed.scheme, parsed.netloc)
+            if origin not in robots:
+                robots[origin] = asyncio.ensure_future(self.get_robots(client, origin))
+            return (await robots[origin]).can_fetch(self.user_agent, url)
+
+        async def visit(url: str, depth: int) -> None:
+            if not await allowed(url):
+                stats["skipped"] += 1
+                return
+            # A redirected url is looked up under the url it led to
+            page = state.get(url, {})
+            if "location" in page:
+                page = state.get(page["location"], {})
+            headers = {}
+            if page.get("etag"):
+                headers["If-None-Match"] = page["etag"]
+            if page.get("last_modified"):
+                headers["If-Modified-Since"] = page["last_modified"]
+            host = urllib.parse.urlparse(url).netloc
+            async with hosts.setdefault(host, asyncio.Semaphore(self.per_host)):
+                response = await client.get(url, headers=headers)
+
+            # Redirects are followed, pages are keyed by their final url, which must be in scope
+            final_url = urllib.parse.urldefrag(str(response.url))[0]
+            if final_url != url:
+                if urllib.parse.urlparse(final_url).netloc not in scope or not await allowed(final_url):
+                    stats["skipped"] += 1
+                    return
+                seen.add(final_url)
+                if "hash" in state.get(url, {}):
+                    # The url was a page, its chunks are dropped (it is known as a redirect on the next crawl)
+                    await pages.put((url, "", None))
+                else:
+                    state[url] = {"location": final_url}
+            if final_url in fetched:
+                return
+            fetched.add(final_url)
+            url = final_url
+            stats["pages"] += 1
+
+            if response.status_code == 304:
+                stats["not_modified"] += 1
+                links = page.get("links", [])
+            elif response.status_code in [404, 410]:
+                if url in state:
+                    await pages.put((url, "", None))
+                return
+            elif response.status_code == 200:
+                content_type = response.headers.get("content-type", "")
+                if "html" not in content_type and not content_type.startswith("text/"):
+                    stats["skipped"] += 1
+                    return
+                html = "html" in content_type
+                text = self.compactor.compact(response.text, url, html=html, record=False)
+                links = self.get_links(response.text, str(response.url)) if html else []
+                entry = {
+                    "etag": response.headers.get("etag", ""),
+                    "last_modified": response.headers.get("last-modified", ""),
+                    "hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+                    "links": links,
+                }
+                if entry["hash"] == page.get("hash"):
+                    stats["unchanged"] += 1
+                    state[url] = entry
+                else:
+                    await pages.put((url, text, entry))
+            else:
+                stats["errors"] += 1
+                self.logger.info("Error crawling {}: {}".format(url, response.status_code))
+                return
+
+            if depth < self.max_depth:
+                for link in links:
+                    add(link, depth + 1)
+
+        async def fetch() -> None:
+            while True:
+                url, depth = await queue.get()
+                try:
+                    await visit(url, depth)
+                except Exception as e:
+                    stats["errors"] += 1
+                    self.logger.info("Error crawling {}: {}".format(url, e))
+                finally:
+                    queue.task_done()
+
+        # Pages are ingested one at a time, while the crawl goes on
+        async def ingest() -> None:
+            while True:
+                url, text, entry = await pages.get()
+                try:
+                    await asyncio.to_thread(on_page, url, text)
+                    if entry is None:
+                        stats["removed"] += 1
+                        state.pop(url, None)
+                    else:
+                        stats["changed"] += 1
+                        state[url] = entry
+                except Exception as e:
+                    stats["errors"] += 1
+                    self.logger.exception(e)
+                finally:
+                    pages.task_done()
+
+        async with httpx.AsyncClient(
+            headers={"User-Agent": self.user_agent},
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.concurrency),
+        ) as client:
+            for seed in seeds:
+                if self.is_sitemap(seed):
+                    # Sitemaps list the pages, their links aren't followed
+                    for url in await self.get_sitemap(client, seed):
+                        scope.add(urllib.parse.urlparse(url).netloc)
+                        add(url, self.max_depth)
+                else:
+                    scope.add(urllib.parse.urlparse(seed).netloc)
+                    add(urllib.parse.urldefrag(seed)[0], 0)
+
+            tasks = [asyncio.create_task(fetch()) for _ in range(self.concurrency)] + [asyncio.create_task(ingest())]
+            await queue.join()
+            await pages.join()
+            for task in tasks:
+                task.cancel()
+        return stats
+
+    # Crawl from a thread without an event loop
+    def run(self, seeds: list[str], state: dict, on_page) -> dict:
+        return asyncio.run(self.crawl(seeds, state, on_page))
+
+
+class SpeechCache:
+    """Speech cache class, keeps synthesized sentences on disk, so that repeated ones are played without the API"""
+
+    SENTENCE_PATTERN = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+    def __init__(self, config: dict, logger: logging.Logger, api: ApiClient):
+        self.logger = logger
+        self.api = api
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+        self.size = None  # Running size of the cache files, summed on first use
+        self.configure(config)
+
+    # Apply the [audio] section of the config
+    def configure(self, config: dict) -> None:
+        audio_config = config["audio"]
+        with self.lock:
+            self.size = None
+        self.model = audio_config["model"]
+        self.voice = audio_config["voice"]
+        self.enabled = audio_config.get("cache", True)
+        self.path = os.path.expanduser(audio_config.get("cache_path", "~/.config/neuma/tts"))
+        self.max_size = audio_config.get("cache_max_size", 100) * 1024 * 1024
+        self.format = audio_config.get("cache_format", "opus")
+        if hasattr(self, "executor"):
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(max_workers=audio_config.get("workers", 4))
+
+    # Split a text into normalised sentences
+    def split_sentences(self, text: str) -> list[str]:
+        sentences = (" ".join(sentence.split()) for sentence in self.SENTENCE_PATTERN.split(text))
+        return [sentence for sentence in sentences if re.search(r"\w", sentence)]
+
+    # Get the cache file of a sentence, keyed by model, voice and text
+    def get_file(self, sentence: str) -> str:
+        key = hashlib.sha256("\0".join([self.model, self.voice, sentence]).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "{}.{}".format(key, self.format))
+
+    # Get the audio file of a sentence, synthesized if it isn't cached
+    def get_audio(self, sentence: str) -> str:
+        audio_file = self.get_file(sentence)
+        if self.enabled and os.path.isfile(audio_file):
+            # The modification time orders the least recently used files
+            os.utime(audio_file)
+            with self.lock:
+                self.stats["hits"] += 1
+            return audio_file
+
+        with self.lock:
+            self.stats["misses"] += 1
+        speech = self.api.call(
+            "audio",
+            self.api.client.audio.speech.create,
+            model=self.model,
+            voice=self.voice,
+            input=sentence,
+            response_format=self.format,
+            units=len(sentence),
+        )
+        os.makedirs(self.path, exist_ok=True)
+        # Written aside, a cached file is never seen half written (uncached files are only used once)
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False) as f:
+            tmp_file = f.name
+        try:
+            speech.write_to_file(tmp_file)
+            if not self.enabled:
+                return tmp_file
+            os.replace(tmp_file, audio_file)
+        except Exception:
+            os.remove(tmp_file)
+            raise
+        self.evict(os.path.getsize(audio_file))
+        return audio_file
+
+    # Get the cache files, least recently used first
+    def get_files(self) -> list:
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(files)
+
+    # Add a new file to the running size, dropping the least recently used files above the size limit
+    def evict(self, added: int) -> None:
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _mtime, size, _path in self.get_files())
+            else:
+                self.size += added
+            if self.size <= self.max_size:
+                return
+            for _mtime, size, path in self.get_files():
+                if self.size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    self.size -= size
+                except FileNotFoundError:
+                    pass
+
+    # Speak a text, sentence by sentence, playing the sentences ready while the next ones are synthesized
+    def speak(self, text: str, play) -> None:
+        sentences = self.split_sentences(text)
+        # Sentences repeated in the text are synthesized once
+        get_audio = self.api.bind(self.get_audio)
+        unique_futures = {sentence: self.executor.submit(get_audio, sentence) for sentence in dict.fromkeys(sentences)}
+        futures = [unique_futures[sentence] for sentence in sentences]
+        try:
+            while futures:
+                ready = []
+                while futures and (not ready or futures[0].done()):
+                    future = futures.pop(0)
+                    try:
+                        ready.append(future.result())
+                    except Exception as e:
+                        # A failed sentence is skipped, the others are still spoken
+                        self.logger.exception(e)
+                if ready:
+                    play(ready)
+        finally:
+            if not self.enabled:
+                # Uncached files are removed, also when playing fails
+                for future in unique_futures.values():
+                    future.cancel()
+                for future in unique_futures.values():
+                    if not future.cancelled() and future.exception() is None:
+                        with contextlib.suppress(OSError):
+                            os.remove(future.result())
+
+    # Get the hits, misses and size of the cache
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        if os.path.isdir(self.path):
+            files = self.get_files()
+            stats["files"] = len(files)
+            stats["size"] = "{:.1f}MB".format(sum(size for _mtime, size, _path in files) / 1024 / 1024)
+        return stats
+
+
+class SpeechCapture:
+    """Speech capture class, transcribes speech in segments cut at pauses, while the user is still talking"""
+
+    def __init__(self, config: dict, logger: logging.Logger, transcribe):
+        self.logger = logger
+        self.transcribe = transcribe  # Called with a (file name, wav data) tuple
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.configure(config)
+
+    # Apply the [audio] section of the config
+    def configure(self, config: dict) -> None:
+        audio_config = config["audio"]
+        self.input_timeout = audio_config["input_timeout"]
+        self.input_limit = audio_config["input_limit"]
+        self.segment_pause = audio_config.get("segment_pause", 0.4)
+        self.end_pause = audio_config.get("end_pause", 1.0)
+        self.min_segment = audio_config.get("min_segment", 2.0)
+
+    # Get the energy (RMS) of a frame of audio
+    @staticmethod
+    def get_energy(frame: bytes, sample_width: int) -> float:
+        samples = np.frombuffer(frame, dtype={1: np.int8, 2: np.int16, 4: np.int32}[sample_width])
+        return float(np.sqrt(np.mean(samples.astype(np.float64) ** 2))) if samples.size else 0.0
+
+    # Encode frames of audio as a WAV file
+    @staticmethod
+    def to_wav(frames: list[bytes], sample_rate: int, sample_width: int) -> bytes:
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(sample_width)
+            wav.setframerate(sample_rate)
+            wav.writeframes(b"".join(frames))
+        return buffer.getvalue()
+
+    # Capture speech from a microphone, returning its transcription
+    def capture(self, source, energy_threshold: float) -> str:
+        import speech_recognition  # Loaded by listen
+
+        frame_seconds = source.CHUNK / source.SAMPLE_RATE
+        pre_roll = int(0.3 / frame_seconds) + 1  # Frames kept from before the speech starts
+        hang = int(0.2 / frame_seconds) + 1  # Frames of silence kept after the speech stops
+
+        def submit(frames: list[bytes]) -> None:
+            wav = self.to_wav(frames, source.SAMPLE_RATE, source.SAMPLE_WIDTH)
+            futures.append(self.executor.submit(self.transcribe, ("segment.wav", wav)))
+            self.logger.info("Transcribing a segment of {:.1f}s".format(len(frames) * frame_seconds))
+
+        futures = []
+        recent = []  # Last frames, between segments
+        segment = None  # Frames of the current segment, None between segments
+        voiced = 0  # Frames of speech in the current segment
+        silence = 0  # Frames since the last speech
+        elapsed = 0.0
+        started = False
+        while True:
+            frame = source.stream.read(source.CHUNK)
+            elapsed += frame_seconds
+            speech = self.get_energy(frame, source.SAMPLE_WIDTH) > energy_threshold
+            silence = 0 if speech else silence + 1
+
+            if segment is None:
+                recent = (recent + [frame])[-pre_roll:]
+                if speech:
+                    # Speech starts, leading silence is trimmed to the pre-roll
+                    segment = recent
+                    voiced = 0
+                    if not started:
+                        started = True
+                        elapsed = 0.0
+                elif not started and elapsed > self.input_timeout:
+                    raise speech_recognition.WaitTimeoutError("listening timed out while waiting for phrase to start")
+            else:
+                segment.append(frame)
+            if speech:
+                voiced += 1
+
+            if started and (silence * frame_seconds >= self.end_pause or elapsed >= self.input_limit):
+                break
+
+            # Cut at a pause once the segment is long enough, trailing silence trimmed to the hang
+            if segment is not None and silence * frame_seconds >= self.segment_pause \
+                    and len(segment) * frame_seconds >= self.min_segment:
+                submit(segment[:len(segment) - silence + hang])
+                recent = segment[-pre_roll:]
+                segment = None
+
+        # Noise too short to be speech isn't sent
+        if segment is not None and voiced * frame_seconds >= 0.2:
+            submit(segment[:len(segment) - silence + hang])
+
+        # Stitch the segments, most were transcribed while the user was talking (a failed one raises)
+        transcripts = [future.result() for future in futures]
+        return " ".join(transcript.strip() for transcript in transcripts if transcript)
+
+
+class BM25Index:
+    """BM25 index class, lexical search over chunks"""
+
+    TOKEN_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # Term -> {chunk id: term frequency}
+        self.lengths = []  # Number of terms per chunk
+
+    # Split a text into lowercase terms
+    @classmethod
+    def tokenize(cls, text: str) -> list[str]:
+        return cls.TOKEN_PATTERN.findall(text.lower())
+
+    # Add texts to the index
+    def add(self, texts: list[str]) -> None:
+        for text in texts:
+            chunk_id = len(self.lengths)
+            terms = self.tokenize(text)
+            self.lengths.append(len(terms))
+            for term in terms:
+                frequencies = self.postings.setdefault(term, {})
+                frequencies[chunk_id] = frequencies.get(chunk_id, 0) + 1
+
+    # Search the index, best first
+    def search(self, query: str, k: int = 4) -> list[tuple[int, float]]:
+        count = len(self.lengths)
+        if count == 0:
+            return []
+        average_length = sum(self.lengths) / count
+        scores = {}
+        for term in set(self.tokenize(query)):
+            frequencies = self.postings.get(term)
+            if not frequencies:
+                continue
+            idf = math.log(1 + (count - len(frequencies) + 0.5) / (len(frequencies) + 0.5))
+            for chunk_id, frequency in frequencies.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+class ContentCompactor:
+    """Content compactor class, cuts the tokens of inserted files and web pages while keeping their content"""
+
+    # Elements and class/id names of page boilerplate
+    BOILERPLATE_TAGS = ["script", "style", "noscript", "nav", "header", "footer", "aside", "form", "iframe", "svg", "button"]
+    BOILERPLATE_NAMES = {
+        "cookie", "cookies", "consent", "banner", "nav", "navbar", "navigation", "menu", "footer", "sidebar",
+        "subscribe", "newsletter", "share", "social", "advert", "ads", "promo", "popup", "modal", "breadcrumb",
+        "breadcrumbs",
+    }
+    NAME_SEPARATOR_PATTERN = re.compile(r"[-_\s]+")
+
+    # Extensions of prose, whose repeated lines are dropped
+    PROSE_EXTENSIONS = ["txt", "md", "markdown", "rst", "org", "adoc", "tex"]
+
+    # Line comments, by file extension
+    LINE_COMMENTS = {
+        "#": ["py", "sh", "bash", "rb", "pl", "r", "yaml", "yml", "toml", "conf", "cfg", "ini"],
+        "//": ["js", "jsx", "ts", "tsx", "c", "h", "cpp", "hpp", "cc", "cs", "java", "go", "rs", "kt", "swift", "php", "scala"],
+        "--": ["sql", "lua", "hs"],
+    }
+    # String literals, line comments and block comments, matched together so that a "/*" inside a string or a
+    # line comment doesn't start a block comment
+    CODE_TOKEN_PATTERN = re.compile(
+        r"\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`|//[^\n]*|/\*.*?\*/", re.DOTALL
+    )
+
+    # Variable parts of log lines : timestamps, hexadecimal ids and numbers
+    LOG_VARIABLE_PATTERN = re.compile(
+        r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?|\b0x[0-9a-fA-F]+\b|\b[0-9a-fA-F]{8,}\b|\d+"
+    )
+
+    def __init__(self, config: dict, logger: logging.Logger):
+        self.logger = logger
+        self.stats = {"compactions": 0, "tokens_before": 0, "tokens_after": 0}
+        self.lock = threading.Lock()
+        self.configure(config)
+
+    # Apply the [compaction] section of the config
+    def configure(self, config: dict) -> None:
+        compaction_config = config.get("compaction", {})
+        self.enabled = compaction_config.get("enabled", True)
+        self.min_duplicate_length = compaction_config.get("min_duplicate_length", 20)
+
+    # Check if an element is boilerplate by the words of its classes and id ("site-nav", not "canvas")
+    def is_boilerplate(self, element) -> bool:
+        names = " ".join(element.get("class", [])) + " " + (element.get("id") or "")
+        return any(word in self.BOILERPLATE_NAMES for word in self.NAME_SEPARATOR_PATTERN.split(names.lower()))
+
+    # Extract the main content of a page as text
+    def compact_html(self, html: str) -> str:
+        soup = BeautifulSoup(html, "html.parser")
+        for element in soup(self.BOILERPLATE_TAGS):
+            element.decompose()
+        for element in soup.find_all(True):
+            if element.decomposed or element.name in ["html", "body", "main", "article"]:
+                continue
+            if self.is_boilerplate(element):
+                element.decompose()
+
+        # The main content is the article, or the element holding the most paragraph text
+        main = soup.find("article") or soup.find("main")
+        if main is None:
+            totals = {}
+            for paragraph in soup.find_all("p"):
+                if paragraph.parent is not None:
+                    parent, total = totals.get(id(paragraph.parent), (paragraph.parent, 0))
+                    totals[id(parent)] = (parent, total + len(paragraph.get_text()))
+            main = max(totals.values(), key=lambda item: item[1])[0] if totals else (soup.body or soup)
+        title = soup.title.get_text().strip() if soup.title else ""
+        text = main.get_text("\n")
+        return self.compact_text((title + "\n" if title else "") + text)
+
+    # Remove repeated lines and extra whitespace from prose, only blank lines and trailing whitespace from
+    # other text (rows of a csv can repeat, and tabs separate their values)
+    def compact_text(self, text: str, prose: bool = True) -> str:
+        lines = []
+        seen = set()
+        for line in text.splitlines():
+            line = " ".join(line.split()) if prose else line.rstrip()
+            if not line:
+                continue
+            if prose and len(line) >= self.min_duplicate_length:
+                if line in seen:
+                    continue
+                seen.add(line)
+            lines.append(line)
+        return "\n".join(lines)
+
+    # Remove comments, trailing whitespace and blank lines from code
+    def compact_code(self, code: str, extension: str) -> str:
+        marker = next((marker for marker, extensions in self.LINE_COMMENTS.items() if extension in extensions), None)
+        if marker == "//" or extension == "css":
+            code = self.CODE_TOKEN_PATTERN.sub(
+                lambda match: "" if match.group().startswith("/*") else match.group(), code
+            )
+        lines = []
+        for line in code.splitlines():
+            line = line.rstrip()
+            # Only whole line comments, trailing ones could be inside strings
+            if not line or (marker and line.lstrip().startswith(marker) and not line.lstrip().startswith("#!")):
+                continue
+            lines.append(line)
+        return "\n".join(lines)
+
+    # Merge log lines that only differ by timestamps, ids and numbers, with their counts
+    def compact_log(self, log: str) -> str:
+        counts = OrderedDict()
+        for line in log.splitlines():
+            line = line.rstrip()
+            if not line:
+                continue
+            key = self.LOG_VARIABLE_PATTERN.sub("#", line)
+            if key in counts:
+                counts[key][1] += 1
+            else:
+                counts[key] = [line, 1]
+        return "\n".join(
+            line if count == 1 else "{} [x{}]".format(line, count) for line, count in counts.values()
+        )
+
+    # Get the extension of a file name or url
+    @staticmethod
+    def get_extension(name: str) -> str:
+        return os.path.splitext(name.split("?")[0])[1].lstrip(".").lower()
+
+    # Check if a file is a log, whose repeated lines can be merged
+    def is_log(self, name: str) -> bool:
+        return self.enabled and self.get_extension(name) in ["log", "out"]
+
+    # Compact a text according to its kind (from a file name or url), recording the tokens saved
+    def compact(self, text: str, name: str, html: bool = False, record: bool = True) -> str:
+        if not self.enabled:
+            # Plain text of pages, as before compaction existed
+            return " ".join(BeautifulSoup(text, "html.parser").get_text().split()) if html else text
+        extension = self.get_extension(name)
+        if html or extension in ["html", "htm", "xhtml"]:
+            compacted = self.compact_html(text)
+        elif self.is_log(name):
+            compacted = self.compact_log(text)
+        elif any(extension in extensions for extensions in self.LINE_COMMENTS.values()) or extension in ["css", "json"]:
+            compacted = self.compact_code(text, extension)
+        else:
+            compacted = self.compact_text(text, extension in self.PROSE_EXTENSIONS)
+
+        if record:
+            self.record(name, Chunker.count_tokens(text), Chunker.count_tokens(compacted))
+        return compacted
+
+    # Record the tokens before and after a compaction
+    def record(self, name: str, before: int, after: int) -> None:
+        with self.lock:
+            self.stats["compactions"] += 1
+            self.stats["tokens_before"] += before
+            self.stats["tokens_after"] += after
+        self.logger.info("Compacted {}: {} -> {} tokens".format(name, before, after))
+
+    # Get the tokens before and after compaction
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        if stats["tokens_before"]:
+            stats["saved"] = "{:.1%}".format(1 - stats["tokens_after"] / stats["tokens_before"])
+        return stats
+
+
+class FileIncluder:
+    """File includer class, inserts files in prompts, only their spans most relevant to the question when large"""
+
+    TOKEN_PATTERN = re.compile(r"~\{f:(.+?)\}~")
+
+    def __init__(self, config: dict, logger: logging.Logger, compactor: ContentCompactor):
+        self.logger = logger
+        self.compactor = compactor
+        self.cache = OrderedDict()  # Path -> (mtime, size, spans, BM25 index)
+        self.lock = threading.Lock()
+        self.configure(config)
+
+    # Apply the [files] section of the config
+    def configure(self, config: dict) -> None:
+        files_config = config.get("files", {})
+        self.max_tokens = files_config.get("max_tokens", 4000)
+        self.large_file_size = files_config.get("large_file_size", 32768)
+        self.span_lines = files_config.get("span_lines", 40)
+        self.cache_entries = files_config.get("cache_entries", 32)
+
+    # Expand the paths and globs of a token
+    @staticmethod
+    def expand(pattern: str) -> list[str]:
+        pattern = os.path.expanduser(pattern.strip())
+        if glob.has_magic(pattern):
+            return sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+        return [pattern] if os.path.isfile(pattern) else []
+
+    # Split a file into spans of lines, memory-mapped so that large files aren't copied whole
+    def read_spans(self, path: str) -> list[tuple[int, str]]:
+        spans = []
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return spans
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start = 0
+                line = 1
+                while start < len(mapped):
+                    stop = start
+                    for _ in range(self.span_lines):
+                        stop = mapped.find(b"\n", stop) + 1 or len(mapped)
+                        if stop == len(mapped):
+                            break
+                    spans.append((line, mapped[start:stop].decode("utf-8", errors="replace")))
+                    line += self.span_lines
+                    start = stop
+        return spans
+
+    # Get the spans and index of a file, from the cache if the file didn't change since
+    def get_spans(self, path: str) -> tuple[list, BM25Index]:
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.cache.get(path)
+            if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+                self.cache.move_to_end(path)
+                return cached[2], cached[3]
+        spans = self.read_spans(path)
+        index = BM25Index()
+        index.add([text for _line, text in spans])
+        with self.lock:
+            self.cache[path] = (stat.st_mtime, stat.st_size, spans, index)
+            while len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+        return spans, index
+
+    # Get the spans of a file most relevant to the question, in file order, within a token budget
+    def select_spans(self, path: str, question: str, budget: int) -> str:
+        spans, index = self.get_spans(path)
+        ranked = [span_id for span_id, _score in index.search(question, len(spans))]
+        if not ranked:
+            # Nothing matches, keep the beginning and the end
+            ranked = [span_id for pair in zip(range(len(spans)), reversed(range(len(spans)))) for span_id in pair]
+        # Spans are compacted before counting, so that more of them fit
+        selected = {}
+        used = 0
+        before = 0
+        for span_id in ranked:
+            if span_id in selected:
+                continue
+            text = self.compactor.compact(spans[span_id][1], path, record=False).rstrip("\n") + "\n"
+            tokens = Chunker.count_tokens(text)
+            if used + tokens > budget:
+                continue
+            selected[span_id] = text
+            used += tokens
+            before += Chunker.count_tokens(spans[span_id][1])
+        if self.compactor.enabled:
+            self.compactor.record(path, before, used)
+
+        parts = []
+        previous = None
+        for span_id in sorted(selected):
+            if previous is not None and span_id != previous + 1:
+                parts.append("[...]\n")
+            line, text = spans[span_id]
+            parts.append("[lines {}-{}]\n{}".format(line, line + len(text.splitlines()) - 1, selected[span_id]))
+            previous = span_id
+        self.logger.info("Included {} of {} spans of {}".format(len(selected), len(spans), path))
+        return "".join(parts)
+
+    # Read a file, whole if small enough (once compacted), or its relevant spans
+    def read(self, path: str, question: str, budget: int) -> str:
+        # Logs can shrink a lot once repeated lines are merged, whatever their size
+        if os.path.getsize(path) <= self.large_file_size or self.compactor.is_log(path):
+            spans, _index = self.get_spans(path)
+            raw = "".join(text for _line, text in spans)
+            content = self.compactor.compact(raw, path, record=False)
+            tokens = Chunker.count_tokens(content)
+            if tokens <= budget:
+                if self.compactor.enabled:
+                    self.compactor.record(path, Chunker.count_tokens(raw), tokens)
+                return content
+        return self.select_spans(path, question, budget)
+
+    # Replace the file tokens of a prompt with the content of their files
+    def include(self, prompt: str) -> str:
+        tokens = list(dict.fromkeys(self.TOKEN_PATTERN.findall(prompt)))
+        if not tokens:
+            return prompt
+        question = self.TOKEN_PATTERN.sub(" ", prompt)
+        paths = {token: self.expand(token) for token in tokens}
+
+        # The budget is shared by all the files
+        remaining_files = sum(len(token_paths) for token_paths in paths.values())
+        remaining_tokens = self.max_tokens
+        for token, token_paths in paths.items():
+            if not token_paths:
+                self.logger.info("File not found: {}".format(token))
+                continue
+            contents = []
+            for path in token_paths:
+                content = self.read(path, question, remaining_tokens // remaining_files)
+                remaining_files -= 1
+                remaining_tokens -= Chunker.count_tokens(content)
+                contents.append(content if len(token_paths) == 1 else "--- {} ---\n{}".format(path, content))
+            prompt = prompt.replace("~{f:" + token + "}~", "\n".join(contents))
+        return prompt
+
+
+class LexicalIndex:
+    """Lexical index class, a persistent BM25 index of the chunks of a vector db"""
+
+    def __init__(self, persist_directory: str):
+        self.index_file = os.path.join(persist_directory, "lexical.sqlite")
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.index_file, check_same_thread=False)
+        # Underscores are part of terms, so that identifiers stay whole
+        self.connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+            "text, metadata UNINDEXED, tokenize = \"unicode61 tokenchars '_'\")"
+        )
+
+    # Add chunks to the index
+    def add_documents(self, documents: list[Document]) -> None:
+        with self.lock:
+            self.connection.executemany(
+                "INSERT INTO chunks (text, metadata) VALUES (?, ?)",
+                [(document.page_content, json.dumps(document.metadata, default=str)) for document in documents],
+            )
+            self.connection.commit()
+
+    # Remove the chunks of a source from the index
+    def delete_source(self, source: str) -> None:
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM chunks WHERE json_extract(metadata, '$.source') = ?", (source,)
+            )
+            self.connection.commit()
+
+    # Get the number of chunks in the index
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    # Search the index, best first
+    def search(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        terms = list(dict.fromkeys(BM25Index.tokenize(query)))[:64]
+        if not terms:
+            return []
+        match = " OR ".join('"{}"'.format(term) for term in terms)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT text, metadata, bm25(chunks) FROM chunks WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?",
+                (match, k),
+            ).fetchall()
+        # bm25() is lower for better matches
+        return [
+            (Document(page_content=text, metadata=json.loads(metadata)), -score)
+            for text, metadata, score in rows
+        ]
+
+
+class RetrievalCache:
+    """Retrieval cache class, keeps recent results per vector db generation"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.stats = {}  # Hits and misses per vector db
+        self.lock = threading.Lock()
+
+    # Normalise a query, so that trivial variations share an entry
+    @staticmethod
+    def normalise(query: str) -> str:
+        return " ".join(query.lower().split()).rstrip(".?! ")
+
+    # Get cached results, or None
+    def get(self, vector_db: str, key: tuple) -> list | None:
+        with self.lock:
+            stats = self.stats.setdefault(vector_db, {"hits": 0, "misses": 0})
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                stats["hits"] += 1
+                return self.entries[key]
+            stats["misses"] += 1
+            return None
+
+    # Store results, dropping the least recently used entries
+    def put(self, key: tuple, results: list) -> None:
+        with self.lock:
+            self.entries[key] = results
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Change the number of entries, dropping the least recently used ones
+    def resize(self, max_entries: int) -> None:
+        with self.lock:
+            self.max_entries = max_entries
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Drop the entries of a vector db
+    def invalidate(self, vector_db: str) -> None:
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == vector_db]:
+                del self.entries[key]
+
+    # Get the stats of a vector db
+    def get_stats(self, vector_db: str) -> dict:
+        with self.lock:
+            stats = dict(self.stats.get(vector_db, {"hits": 0, "misses": 0}))
+        lookups = stats["hits"] + stats["misses"]
+        if lookups:
+            stats["hit_rate"] = "{:.1%}".format(stats["hits"] / lookups)
+        return stats
+
+
+class Chunker:
+    """Chunker class, splits documents by tokens along their structure"""
+
+    LANGUAGES = {
+        ".md": Language.MARKDOWN,
+        ".markdown": Language.MARKDOWN,
+        ".rst": Language.RST,
+        ".tex": Language.LATEX,
+        ".html": Language.HTML,
+        ".htm": Language.HTML,
+        ".py": Language.PYTHON,
+        ".js": Language.JS,
+        ".jsx": Language.JS,
+        ".ts": Language.TS,
+        ".tsx": Language.TS,
+        ".go": Language.GO,
+        ".rs": Language.RUST,
+        ".java": Language.JAVA,
+        ".kt": Language.KOTLIN,
+        ".c": Language.C,
+        ".h": Language.C,
+        ".cpp": Language.CPP,
+        ".hpp": Language.CPP,
+        ".cs": Language.CSHARP,
+        ".rb": Language.RUBY,
+        ".php": Language.PHP,
+        ".scala": Language.SCALA,
+        ".swift": Language.SWIFT,
+        ".lua": Language.LUA,
+    }
+    TABLES = [".csv", ".tsv"]
+
+    def __init__(self, profile: dict):
+        self.size = profile.get("size", 256)
+        self.overlap = profile.get("overlap", 25)
+        self.unit = profile.get("unit", "tokens")
+        self.format_aware = profile.get("format_aware", True)
+        self.splitters = {}
+
+    # Count the tokens of a text
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        return len(get_encoding().encode(text, disallowed_special=()))
+
+    # Get the length of a text, in the unit of the profile
+    def length(self, text: str) -> int:
+        if self.unit == "tokens":
+            return self.count_tokens(text)
+        return len(text)
+
+    # Get the format of a document from its source
+    def get_format(self, document: Document) -> str:
+        if not self.format_aware:
+            return "text"
+        extension = os.path.splitext(document.metadata.get("source", ""))[1].lower()
+        if extension in self.TABLES:
+            return "table"
+        if extension in self.LANGUAGES:
+            return extension
+        return "text"
+
+    # Get the splitter for a format
+    def get_splitter(self, document_format: str) -> RecursiveCharacterTextSplitter:
+        if document_format not in self.splitters:
+            settings = {
+                "chunk_size": self.size,
+                "chunk_overlap": self.overlap,
+                "length_function": self.length,
+                "add_start_index": True,
+            }
+            if document_format in self.LANGUAGES:
+                splitter = RecursiveCharacterTextSplitter.from_language(
+                    self.LANGUAGES[document_format], **settings
+                )
+            else:
+                splitter = RecursiveCharacterTextSplitter(**settings)
+            self.splitters[document_format] = splitter
+        return self.splitters[document_format]
+
+    # Split a table by rows, repeating the header in each chunk
+    def split_table(self, document: Document) -> list[Document]:
+        lines = document.page_content.splitlines(keepends=True)
+        if not lines:
+            return []
+        header = lines[0]
+        chunks = []
+        rows = []
+        start_index = len(header)
+        offset = len(header)
+        for line in lines[1:]:
+            if rows and self.length(header + "".join(rows) + line) > self.size:
+                metadata = dict(document.metadata, start_index=start_index)
+                chunks.append(Document(page_content=header + "".join(rows), metadata=metadata))
+                rows = []
+                start_index = offset
+            rows.append(line)
+            offset += len(line)
+        if rows or not chunks:
+            metadata = dict(document.metadata, start_index=start_index)
+            chunks.append(Document(page_content=header + "".join(rows), metadata=metadata))
+        return chunks
+
+    # Split documents into chunks
+    def split_documents(self, documents: list[Document]) -> list[Document]:
+        chunks = []
+        for document in documents:
+            document_format = self.get_format(document)
+            if document_format == "table":
+                chunks.extend(self.split_table(document))
+            else:
+                chunks.extend(self.get_splitter(document_format).split_documents([document]))
+        return chunks
+
+
+class ContextPacker:
+    """Context packer class, fits retrieved chunks into a token budget"""
+
+    def __init__(self, config: dict):
+        context_config = config.get("context", {})
+        self.max_tokens = context_config.get("max_tokens", 1500)
+        self.mmr_lambda = context_config.get("mmr_lambda", 0.7)
+        self.duplicate_threshold = context_config.get("duplicate_threshold", 0.8)
+
+    # Merge chunks of the same source that overlap or touch, using their start index
+    @staticmethod
+    def merge(results: list) -> list:
+        merged = []
+        positioned = {}
+        for document, score in results:
+            source = document.metadata.get("source")
+            start = document.metadata.get("start_index")
+            if source is None or start is None:
+                merged.append([document.page_content, document.metadata, score])
+                continue
+            positioned.setdefault(source, []).append((int(start), document, score))
+
+        for source, chunks in positioned.items():
+            chunks.sort(key=lambda chunk: chunk[0])
+            current = None
+            for start, document, score in chunks:
+                if current is not None and start <= current["end"]:
+                    # Append only the part that isn't already there
+                    overlap = current["end"] - start
+                    current["text"] += document.page_content[overlap:]
+                    current["end"] = max(current["end"], start + len(document.page_content))
+                    current["score"] = max(current["score"], score)
+                else:
+                    if current is not None:
+                        merged.append([current["text"], current["metadata"], current["score"]])
+                    current = {
+                        "text": document.page_content,
+                        "metadata": document.metadata,
+                        "end": start + len(document.page_content),
+                        "score": score,
+                    }
+            merged.append([current["text"], current["metadata"], current["score"]])
+        return merged
+
+    # Get the similarity of two sets of terms
+    @staticmethod
+    def similarity(terms: set, other_terms: set) -> float:
+        if not terms or not other_terms:
+            return 0.0
+        return len(terms & other_terms) / len(terms | other_terms)
+
+    # Pack results into a context, returns the context text and the packed documents
+    def pack(self, results: list) -> tuple[str, list]:
+        candidates = self.merge(results)
+        if not candidates:
+            return "", []
+
+        scores = [score for _text, _metadata, score in candidates]
+        low, high = min(scores), max(scores)
+        terms = [set(BM25Index.tokenize(text)) for text, _metadata, _score in candidates]
+
+        # Maximal marginal relevance, dropping near duplicates
+        selected = []
+        remaining = list(range(len(candidates)))
+        tokens = 0
+        while remaining:
+            best, best_mmr = None, None
+            for i in remaining:
+                relevance = (scores[i] - low) / (high - low) if high > low else 1.0
+                redundancy = max((self.similarity(terms[i], terms[j]) for j in selected), default=0.0)
+                mmr = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+                if best_mmr is None or mmr > best_mmr:
+                    best, best_mmr = i, mmr
+            remaining.remove(best)
+
+            if any(self.similarity(terms[best], terms[j]) >= self.duplicate_threshold for j in selected):
+                continue
+            text_tokens = Chunker.count_tokens(candidates[best][0])
+            if tokens + text_tokens > self.max_tokens:
+                continue
+            selected.append(best)
+            tokens += text_tokens
+
+        documents = [
+            Document(page_content=candidates[i][0], metadata=candidates[i][1]) for i in selected
+        ]
+        context_text = "\n\n---\n\n".join(document.page_content for document in documents)
+        return context_text, documents
+
+
+class NumpyVectorStore(VectorStore):
+    """Vector store backed by memory-mapped NumPy matrices and a JSON lines sidecar"""
+
+    QUANTIZATIONS = ["none", "int8", "pq"]
+
+    # Write locks, by store folder, shared by all the handles opened on a store
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def __init__(
+            self,
+            persist_directory: str,
+            embedding_function: Embeddings,
+            dtype: str = "float32",
+            quantization: str = "none",
+            pq_subspaces: int = 96,
+            pq_min_train: int = 10000,
+            rescore_factor: int = 4,
+            keep_full: bool = False,
+            block_size: int = 65536,
+            logger: logging.Logger | None = None,
+    ):
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError("No quantization with that name found.")
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self.dtype = np.dtype(dtype)
+        self.quantization = quantization
+        self.pq_subspaces = pq_subspaces
+        self.pq_min_train = pq_min_train  # Codebooks trained on fewer vectors are trained again
+        self.rescore_factor = rescore_factor
+        self.logger = logger or logging.getLogger(__name__)
+        # Quantized stores drop the full precision vectors (once PQ codebooks are trained), unless kept for re-scoring
+        self.keep_full = keep_full or quantization == "none"
+        self.block_size = block_size
+        self.files = {
+            "vectors": os.path.join(persist_directory, "vectors.npy"),
+            "offsets": os.path.join(persist_directory, "offsets.npy"),
+            "codes": os.path.join(persist_directory, "codes.npy"),
+            "scales": os.path.join(persist_directory, "scales.npy"),
+            "codebooks": os.path.join(persist_directory, "codebooks.npy"),
+            "trained": os.path.join(persist_directory, "trained.npy"),  # Number of vectors the codebooks were trained on
+            "deleted": os.path.join(persist_directory, "deleted.npy"),
+        }
+        self.documents_file = os.path.join(persist_directory, "documents.jsonl")
+        self.arrays = {}  # Memory-mapped arrays, by name, swapped whole so that readers keep a consistent set
+        with self.locks_lock:
+            self.lock = self.locks.setdefault(os.path.realpath(persist_directory), threading.Lock())
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    # Map the arrays that exist on disk, and the sidecar, so that the offsets of a set stay valid after a
+    # compaction swaps in a new sidecar
+    def map_arrays(self) -> dict:
+        arrays = {
+            name: np.load(path, mmap_mode="r") for name, path in self.files.items() if os.path.isfile(path)
+        }
+        if os.path.isfile(self.documents_file) and os.path.getsize(self.documents_file):
+            arrays["documents"] = np.memmap(self.documents_file, dtype=np.uint8, mode="r")
+        return arrays
+
+    # Get the mapped arrays, readers use the returned set even if a write swaps in a new one
+    def load(self) -> dict:
+        arrays = self.arrays
+        if not arrays:
+            arrays = self.arrays = self.map_arrays()
+        return arrays
+
+    # Get the number of chunks in the store
+    def count(self, arrays: dict | None = None) -> int:
+        arrays = arrays if arrays is not None else self.load()
+        return arrays["offsets"].shape[0] if "offsets" in arrays else 0
+
+    # Get the dimension of the vectors
+    def dimension(self, arrays: dict | None = None) -> int:
+        arrays = arrays if arrays is not None else self.load()
+        if "vectors" in arrays:
+            return arrays["vectors"].shape[1]
+        if "codebooks" in arrays:
+            return arrays["codebooks"].shape[0] * arrays["codebooks"].shape[2]
+        if "codes" in arrays:
+            return arrays["codes"].shape[1]
+        return 0
+
+    # Normalize vectors so that a dot product is a cosine similarity
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    # Append rows to a .npy file by writing a grown copy, then swapping it in
+    def append_rows(self, name: str, rows: np.ndarray, dtype) -> None:
+        path = self.files[name]
+        tmp_path = path[:-4] + ".tmp.npy"
+        old = self.arrays.get(name)
+        old_count = 0 if old is None else old.shape[0]
+        matrix = np.lib.format.open_memmap(
+            tmp_path,
+            mode="w+",
+            dtype=dtype,
+            shape=(old_count + rows.shape[0],) + rows.shape[1:],
+        )
+        if old_count:
+            matrix[:old_count] = old
+        matrix[old_count:] = rows
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, path)
+
+    # Quantize vectors to int8, with one scale per vector
+    @staticmethod
+    def quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    # Train product quantization codebooks (subspaces x centroids x subspace dimension) with k-means
+    def train_codebooks(self, vectors: np.ndarray, iterations: int = 10) -> np.ndarray:
+        dimension = vectors.shape[1]
+        subspaces = max(s for s in range(1, min(self.pq_subspaces, dimension) + 1) if dimension % s == 0)
+        sample = vectors[np.random.default_rng(0).permutation(len(vectors))[:20000]]
+        centroids = min(256, len(sample))
+        codebooks = []
+        for part in np.split(sample, subspaces, axis=1):
+            codebook = part[:centroids].copy()
+            for _ in range(iterations):
+                assignments = self.nearest_centroids(part, codebook)
+                for c in range(centroids):
+                    members = part[assignments == c]
+                    if len(members):
+                        codebook[c] = members.mean(axis=0)
+            codebooks.append(codebook)
+        return np.stack(codebooks).astype(np.float32)
+
+    # Get the nearest centroid of each row
+    @staticmethod
+    def nearest_centroids(rows: np.ndarray, codebook: np.ndarray) -> np.ndarray:
+        distances = (codebook ** 2).sum(axis=1)[None, :] - 2 * rows @ codebook.T
+        return distances.argmin(axis=1)
+
+    # Encode vectors with product quantization codebooks
+    def encode_pq(self, vectors: np.ndarray, codebooks: np.ndarray) -> np.ndarray:
+        parts = np.split(vectors, codebooks.shape[0], axis=1)
+        return np.stack(
+            [self.nearest_centroids(part, codebook) for part, codebook in zip(parts, codebooks)],
+            axis=1,
+        ).astype(np.uint8)
+
+    # Write a .npy file aside, then swap it in
+    def write_rows(self, name: str, rows: np.ndarray) -> None:
+        tmp_path = self.files[name][:-4] + ".tmp.npy"
+        np.save(tmp_path, rows)
+        os.replace(tmp_path, self.files[name])
+
+    # Encode new vectors with product quantization, training the codebooks again (on all the vectors,
+    # and encoding them again) while they were trained on fewer than pq_min_train vectors
+    def add_pq_codes(self, vectors: np.ndarray) -> None:
+        trained = int(self.arrays["trained"][0]) if "trained" in self.arrays else 0
+        old_count = self.count()
+        if "codebooks" in self.arrays and trained >= self.pq_min_train:
+            self.append_rows("codes", self.encode_pq(vectors, np.asarray(self.arrays["codebooks"])), np.uint8)
+            return
+        if "codebooks" in self.arrays and "vectors" not in self.arrays:
+            # Without full vectors the old codes can't be encoded again
+            self.logger.warning(
+                "PQ codebooks of {} trained on {} vectors (pq_min_train is {}), dbs created with keep_full train them again".format(
+                    self.persist_directory, trained, self.pq_min_train
+                )
+            )
+            self.append_rows("codes", self.encode_pq(vectors, np.asarray(self.arrays["codebooks"])), np.uint8)
+            return
+        if old_count and "vectors" in self.arrays:
+            vectors = np.concatenate([np.asarray(self.arrays["vectors"], dtype=np.float32), vectors])
+        if len(vectors) < self.pq_min_train:
+            self.logger.warning(
+                "PQ codebooks of {} trained on {} vectors (pq_min_train is {}), trained again as vectors are added".format(
+                    self.persist_directory, len(vectors), self.pq_min_train
+                )
+            )
+        codebooks = self.train_codebooks(vectors)
+        self.write_rows("codebooks", codebooks)
+        self.write_rows("trained", np.asarray([len(vectors)], dtype=np.int64))
+        self.write_rows("codes", self.encode_pq(vectors, codebooks))
+        if not self.keeps_vectors(len(vectors)) and os.path.isfile(self.files["vectors"]):
+            # Trained on enough vectors, the full precision ones aren't needed anymore
+            os.remove(self.files["vectors"])
+
+    # Check if the full precision vectors are stored: kept for re-scoring, or until the PQ codebooks are
+    # trained on pq_min_train vectors (given the number they are trained on)
+    def keeps_vectors(self, trained: int | None = None) -> bool:
+        if self.keep_full:
+            return True
+        if self.quantization != "pq" or (self.count() and "vectors" not in self.arrays):
+            return False
+        if trained is None:
+            trained = int(self.arrays["trained"][0]) if "trained" in self.arrays else 0
+        return trained < self.pq_min_train
+
+    # Embed texts and append them to the store
+    def add_texts(self, texts, metadatas: list[dict] | None = None, **kwargs) -> list[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self.normalize(
+            np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        )
+
+        with self.lock:
+            os.makedirs(self.persist_directory, exist_ok=True)
+            # Mapped again, another handle may have written since
+            self.arrays = self.map_arrays()
+            old_count = self.count()
+
+            # Append the documents to the sidecar, remembering where each one starts
+            offsets = []
+            with open(self.documents_file, "ab") as f:
+                offset = f.tell()
+                for text, metadata in zip(texts, metadatas):
+                    line = (json.dumps({"text": text, "metadata": metadata}, default=str) + "\n").encode("utf-8")
+                    offsets.append(offset)
+                    f.write(line)
+                    offset += len(line)
+
+            if self.keeps_vectors():
+                self.append_rows("vectors", vectors, self.dtype)
+            if self.quantization == "int8":
+                codes, scales = self.quantize_int8(vectors)
+                self.append_rows("codes", codes, np.int8)
+                self.append_rows("scales", scales, np.float32)
+            elif self.quantization == "pq":
+                self.add_pq_codes(vectors)
+            self.append_rows("offsets", np.asarray(offsets, dtype=np.int64), np.int64)
+
+            # Swap in the new files
+            self.arrays = self.map_arrays()
+
+        return [str(i) for i in range(old_count, old_count + len(texts))]
+
+    # Mark the chunks of a source as deleted, searches skip them
+    def delete_source(self, source: str) -> int:
+        with self.lock:
+            if not os.path.isfile(self.documents_file):
+                return 0
+            self.arrays = self.map_arrays()
+            deleted = set(self.arrays["deleted"].tolist()) if "deleted" in self.arrays else set()
+            ids = []
+            with open(self.documents_file, "rb") as f:
+                for i, line in enumerate(f):
+                    if i not in deleted and json.loads(line)["metadata"].get("source") == source:
+                        ids.append(i)
+            if ids:
+                self.append_rows("deleted", np.asarray(ids, dtype=np.int64), np.int64)
+                self.arrays = self.map_arrays()
+            return len(ids)
+
+    # Get the sources of the chunks that aren't deleted
+    def get_sources(self) -> set:
+        arrays = self.load()
+        if not os.path.isfile(self.documents_file):
+            return set()
+        deleted = set(arrays["deleted"].tolist()) if "deleted" in arrays else set()
+        sources = set()
+        with open(self.documents_file, "rb") as f:
+            for i, line in enumerate(f):
+                if i not in deleted:
+                    sources.add(json.loads(line)["metadata"].get("source"))
+        return sources
+
+    # Copy rows of a .npy file into a new one, in blocks to bound memory
+    def copy_rows(self, name: str, ids: np.ndarray) -> str:
+        old = self.arrays[name]
+        tmp_path = self.files[name][:-4] + ".tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=old.dtype, shape=(len(ids),) + old.shape[1:])
+        for start in range(0, len(ids), self.block_size):
+            matrix[start:start + self.block_size] = old[ids[start:start + self.block_size]]
+        matrix.flush()
+        del matrix
+        return tmp_path
+
+    # Rewrite the store without its deleted chunks, returning the number of chunks dropped
+    def compact(self) -> int:
+        with self.lock:
+            self.arrays = self.map_arrays()
+            if "deleted" not in self.arrays:
+                return 0
+            deleted = np.unique(np.asarray(self.arrays["deleted"]))
+            ids = np.setdiff1d(np.arange(self.count()), deleted)
+
+            # Write the new files aside, then swap them in
+            tmp_documents_file = self.documents_file + ".tmp"
+            offsets = []
+            with open(self.documents_file, "rb") as source, open(tmp_documents_file, "wb") as target:
+                for i in ids:
+                    source.seek(int(self.arrays["offsets"][i]))
+                    offsets.append(target.tell())
+                    target.write(source.readline())
+            tmp_paths = {
+                name: self.copy_rows(name, ids) for name in ["vectors", "codes", "scales"] if name in self.arrays
+            }
+            tmp_paths["offsets"] = self.files["offsets"][:-4] + ".tmp.npy"
+            np.save(tmp_paths["offsets"], np.asarray(offsets, dtype=np.int64))
+
+            for name, tmp_path in tmp_paths.items():
+                os.replace(tmp_path, self.files[name])
+            os.replace(tmp_documents_file, self.documents_file)
+            os.remove(self.files["deleted"])
+            self.arrays = self.map_arrays()
+            return len(deleted)
+
+    # Score a block of rows against normalized queries
+    def score_block(self, arrays: dict, queries: np.ndarray, start: int, stop: int, exact: bool = False) -> np.ndarray:
+        if exact or self.quantization == "none":
+            block = np.asarray(arrays["vectors"][start:stop], dtype=np.float32)
+            return queries @ block.T
+        if self.quantization == "int8":
+            block = np.asarray(arrays["codes"][start:stop], dtype=np.float32)
+            return (queries @ block.T) * np.asarray(arrays["scales"][start:stop])[None, :]
+        # Product quantization, scores are sums of per subspace lookup tables
+        codebooks = arrays["codebooks"]
+        parts = np.split(queries, codebooks.shape[0], axis=1)
+        tables = np.stack([part @ codebook.T for part, codebook in zip(parts, codebooks)], axis=1)
+        codes = np.asarray(arrays["codes"][start:stop], dtype=np.intp)
+        return tables[:, np.arange(codebooks.shape[0])[None, :], codes].sum(axis=2)
+
+    # Keep the k best of the given scores and ids, per query
+    @staticmethod
+    def top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, top, axis=1)
+            ids = np.take_along_axis(ids, top, axis=1)
+        order = np.argsort(-scores, axis=1)
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    # Brute force top-k search of a batch of query vectors, in blocks of rows to bound memory
+    def search_vectors(
+            self,
+            query_vectors: np.ndarray,
+            k: int,
+            exact: bool = False,
+            rescore: bool = True,
+            arrays: dict | None = None,
+    ) -> list[list[tuple[int, float]]]:
+        arrays = arrays if arrays is not None else self.load()
+        count = self.count(arrays)
+        if count == 0 or k <= 0:
+            return [[] for _ in query_vectors]
+
+        exact = exact and "vectors" in arrays
+        rescore = rescore and not exact and self.quantization != "none" and "vectors" in arrays
+        candidates = k * self.rescore_factor if rescore else k
+
+        queries = self.normalize(np.asarray(query_vectors, dtype=np.float32))
+        deleted = np.asarray(arrays["deleted"]) if "deleted" in arrays else None
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, count, self.block_size):
+            stop = min(count, start + self.block_size)
+            scores = self.score_block(arrays, queries, start, stop, exact)
+            if deleted is not None:
+                in_block = deleted[(deleted >= start) & (deleted < stop)]
+                scores[:, in_block - start] = -np.inf
+            ids = np.broadcast_to(np.arange(start, stop), scores.shape)
+            best_scores, best_ids = self.top_k(
+                np.concatenate([best_scores, scores], axis=1),
+                np.concatenate([best_ids, ids], axis=1),
+                candidates,
+            )
+
+        # Re-score the candidates with the full precision vectors
+        if rescore:
+            vectors = arrays["vectors"]
+            best_scores = np.stack([
+                np.asarray(vectors[np.sort(row_ids)], dtype=np.float32) @ query
+                for query, row_ids in zip(queries, best_ids)
+            ])
+            best_ids = np.sort(best_ids, axis=1)
+            if deleted is not None:
+                best_scores[np.isin(best_ids, deleted)] = -np.inf
+            best_scores, best_ids = self.top_k(best_scores, best_ids, k)
+
+        return [
+            [(int(i), float(score)) for i, score in zip(row_ids, row_scores) if score != -np.inf]
+            for row_ids, row_scores in zip(best_ids, best_scores)
+        ]
+
+    # Read chunks from the sidecar
+    def get_documents(self, ids: list[int], arrays: dict | None = None) -> list[Document]:
+        arrays = arrays if arrays is not None else self.load()
+        documents = []
+        data, offsets = arrays.get("documents"), arrays.get("offsets")
+        for i in ids:
+            start = int(offsets[i])
+            stop = int(offsets[i + 1]) if i + 1 < len(offsets) else len(data)
+            record = json.loads(bytes(data[start:stop]).split(b"\n", 1)[0])
+            documents.append(Document(page_content=record["text"], metadata=record["metadata"]))
+        return documents
+
+    # Get the size and recall of the quantized vectors, compared to full precision
+    def get_stats(self, sample_size: int = 50, k: int = 10) -> dict:
+        arrays = self.load()
+        count = self.count(arrays)
+        dimension = self.dimension(arrays)
+        stats = {
+            "chunks": count,
+            "dimension": dimension,
+            "quantization": self.quantization,
+        }
+        if "deleted" in arrays:
+            stats["deleted"] = arrays["deleted"].shape[0]
+        if count == 0 or self.quantization == "none":
+            return stats
+
+        # Compared to float32 vectors, the size on disk includes the full vectors kept for re-scoring
+        full_size = count * dimension * 4
+        stored_size = sum(
+            arrays[name].nbytes for name in ["codes", "scales", "codebooks", "vectors"] if name in arrays
+        )
+        stats["keep_full"] = self.keep_full
+        stats["compression"] = "{:.1f}x".format(full_size / stored_size)
+        if "trained" in arrays:
+            stats["pq_trained"] = int(arrays["trained"][0])
+
+        # Recall against exact search, using stored vectors as queries (excluding themselves)
+        if "vectors" in arrays and count > k:
+            sample = np.random.default_rng(0).permutation(count)[:sample_size]
+            queries = np.asarray(arrays["vectors"][np.sort(sample)], dtype=np.float32)
+            exact = self.search_vectors(queries, k + 1, exact=True, arrays=arrays)
+            recalls = {"quantized": [], "rescored": []}
+            for key, rescore in [("quantized", False), ("rescored", True)]:
+                approximate = self.search_vectors(queries, k + 1, rescore=rescore, arrays=arrays)
+                for i, expected, found in zip(np.sort(sample), exact, approximate):
+                    expected_ids = {j for j, _score in expected if j != i}
+                    found_ids = {j for j, _score in found if j != i}
+                    recalls[key].append(len(expected_ids & found_ids) / max(1, len(expected_ids)))
+            stats["recall@{}".format(k)] = {
+                key: round(float(np.mean(values)), 3) for key, values in recalls.items()
+            }
+        return stats
+
+    def similarity_search_by_vector_with_relevance_scores(
+            self,
+            embedding: list[float],
+            k: int = 4,
+            **kwargs,
+    ) -> list[tuple[Document, float]]:
+        # One set of arrays for both, a write in between doesn't shift the ids
+        arrays = self.load()
+        results = self.search_vectors(np.asarray([embedding]), k, arrays=arrays)[0]
+        documents = self.get_documents([i for i, _score in results], arrays)
+        return [(document, score) for document, (_i, score) in zip(documents, results)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> list[tuple[Document, float]]:
+        query_vector = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_relevance_scores(query_vector, k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> list[Document]:
+        return [document for document, _score in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts, embedding: Embeddings, metadatas: list[dict] | None = None, **kwargs):
+        persist_directory = kwargs.pop("persist_directory")
+        store = cls(persist_directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+
+class ShardedVectorStore(VectorStore):
+    """Vector store spread over several shards, searched concurrently"""
+
+    def __init__(self, shards: list[VectorStore]):
+        self.shards = shards
+        self.executor = ThreadPoolExecutor(max_workers=len(shards))
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.shards[0].embeddings
+
+    # Get the shard of a chunk, all chunks of a source go to the same shard
+    def get_shard(self, document: Document) -> int:
+        source = str(document.metadata.get("source", ""))
+        return zlib.crc32(source.encode("utf-8")) % len(self.shards)
+
+    def add_documents(self, documents: list[Document], **kwargs) -> list[str]:
+        groups = {}
+        for document in documents:
+            groups.setdefault(self.get_shard(document), []).append(document)
+        # Shards are filled in other threads, their embedding calls keep the usage attribution of this one
+        bind = getattr(self.embeddings, "bind", lambda function: function)
+        futures = [
+            self.executor.submit(bind(self.shards[shard].add_documents), group)
+            for shard, group in groups.items()
+        ]
+        return [chunk_id for future in futures for chunk_id in future.result()]
+
+    def add_texts(self, texts, metadatas: list[dict] | None = None, **kwargs) -> list[str]:
+        metadatas = metadatas or [{} for _ in texts]
+        return self.add_documents(
+            [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+        )
+
+    # Search one shard by vector, with relevance scores
+    @staticmethod
+    def search_shard(shard: VectorStore, vector: list[float], k: int) -> list[tuple[Document, float]]:
+        relevance = shard._select_relevance_score_fn()
+        results = shard.similarity_search_by_vector_with_relevance_scores(vector, k=k)
+        return [(document, relevance(score)) for document, score in results]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> list[tuple[Document, float]]:
+        # Embed the query once for all shards
+        vector = self.embeddings.embed_query(query)
+        futures = [self.executor.submit(self.search_shard, shard, vector, k) for shard in self.shards]
+        results = [result for future in futures for result in future.result()]
+        return sorted(results, key=lambda result: result[1], reverse=True)[:k]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> list[Document]:
+        return [document for document, _score in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # Shard scores are already relevance scores
+        return lambda score: score
+
+    # Get the stats of the shards
+    def get_stats(self) -> dict:
+        shard_stats = [shard.get_stats() for shard in self.shards]
+        return {
+            "shards": len(self.shards),
+            "chunks": sum(stats["chunks"] for stats in shard_stats),
+            "shard_stats": shard_stats,
+        }
+
+    # The shards are given as stores, or as a number of numpy stores under persist_directory
+    @classmethod
+    def from_texts(cls, texts, embedding: Embeddings, metadatas: list[dict] | None = None, **kwargs):
+        shards = kwargs.pop("shards")
+        if isinstance(shards, int):
+            persist_directory = kwargs.pop("persist_directory")
+            shards = [
+                NumpyVectorStore(os.path.join(persist_directory, "shard-{}".format(shard)), embedding, **kwargs)
+                for shard in range(shards)
+            ]
+        store = cls(shards)
+        store.add_texts(texts, metadatas)
+        return store
+
+
+class IndexMaintainer:
+    """Index maintainer class, inspects, compacts, tunes and benchmarks the stores of vector dbs"""
+
+    # Chroma HNSW parameters, and their defaults
+    HNSW_PARAMETERS = {"M": "hnsw:M", "ef_construction": "hnsw:construction_ef", "ef_search": "hnsw:search_ef"}
+    HNSW_DEFAULTS = {"M": 16, "ef_construction": 100, "ef_search": 10}
+
+    # Numpy search parameters
+    NUMPY_PARAMETERS = ["rescore_factor"]
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+
+    # Get the chunk count, dimension, source count and index parameters of a store
+    def get_info(self, store: VectorStore) -> dict:
+        if isinstance(store, NumpyVectorStore):
+            info = store.get_stats()
+            info["sources"] = len(store.get_sources())
+            info["index"] = {"search": "brute force", "rescore_factor": store.rescore_factor}
+            return info
+        collection = store._collection
+        records = collection.get(include=["metadatas"])
+        sample = collection.get(limit=1, include=["embeddings"])
+        metadata = collection.metadata or {}
+        return {
+            "chunks": len(records["ids"]),
+            "dimension": len(sample["embeddings"][0]) if len(sample["embeddings"]) else 0,
+            "sources": len({record.get("source") for record in records["metadatas"] if record}),
+            "index": {
+                name: metadata.get(key, self.HNSW_DEFAULTS[name]) for name, key in self.HNSW_PARAMETERS.items()
+            },
+        }
+
+    # Check index parameters, returning them as numbers
+    def parse_parameters(self, backend: str, parameters: dict) -> dict:
+        names = self.NUMPY_PARAMETERS if backend == "numpy" else list(self.HNSW_PARAMETERS)
+        parsed = {}
+        for name, value in parameters.items():
+            if name not in names:
+                raise ValueError("Unknown index parameter: {} (expected {})".format(name, ", ".join(names)))
+            parsed[name] = int(value)
+            if parsed[name] < 1:
+                raise ValueError("Index parameters must be positive.")
+        return parsed
+
+    # Compact a store after deletions, rebuilding chroma indexes with the given HNSW parameters
+    def compact(self, store: VectorStore, parameters: dict | None = None) -> int:
+        if isinstance(store, NumpyVectorStore):
+            return store.compact()
+        return self.rebuild_chroma(store, parameters or {})
+
+    # Copy a chroma collection into a new one, dropping deleted labels from the HNSW index
+    def rebuild_chroma(self, store: VectorStore, parameters: dict, batch_size: int = 5000) -> int:
+        client = store._client
+        collection = store._collection
+        records = collection.get(include=["embeddings", "documents", "metadatas"])
+        metadata = dict(collection.metadata or {})
+        for name, value in parameters.items():
+            metadata[self.HNSW_PARAMETERS[name]] = value
+
+        # Build the new collection aside, then swap it in
+        rebuild_name = collection.name + "-rebuild"
+        if rebuild_name in [existing.name for existing in client.list_collections()]:
+            client.delete_collection(rebuild_name)
+        rebuilt = client.create_collection(rebuild_name, metadata=metadata)
+        for start in range(0, len(records["ids"]), batch_size):
+            stop = start + batch_size
+            rebuilt.add(
+                ids=records["ids"][start:stop],
+                embeddings=records["embeddings"][start:stop],
+                documents=records["documents"][start:stop],
+                metadatas=records["metadatas"][start:stop],
+            )
+        client.delete_collection(collection.name)
+        rebuilt.modify(name=collection.name)
+        store._collection = rebuilt
+        self.logger.info("Rebuilt collection {} with {}".format(collection.name, metadata))
+        return len(records["ids"])
+
+    # Vacuum the SQLite files of a vector db, returning the bytes saved
+    def vacuum(self, full_path: str) -> int:
+        saved = 0
+        for path, _folders, files in os.walk(full_path):
+            for name in files:
+                if not name.endswith((".sqlite", ".sqlite3")):
+                    continue
+                sqlite_file = os.path.join(path, name)
+                size = os.path.getsize(sqlite_file)
+                connection = sqlite3.connect(sqlite_file)
+                try:
+                    if name == "lexical.sqlite":
+                        connection.execute("INSERT INTO chunks (chunks) VALUES ('optimize')")
+                        connection.commit()
+                    connection.execute("VACUUM")
+                finally:
+                    connection.close()
+                saved += size - os.path.getsize(sqlite_file)
+        return saved
+
+    # Get the stored vectors of a store, with their ids, and a search by vector
+    @staticmethod
+    def get_search(store: VectorStore) -> tuple[list, np.ndarray | None, object]:
+        if isinstance(store, NumpyVectorStore):
+            arrays = store.load()
+            count = store.count(arrays)
+            deleted = set(arrays["deleted"].tolist()) if "deleted" in arrays else set()
+            ids = [i for i in range(count) if i not in deleted]
+            vectors = np.asarray(arrays["vectors"][ids], dtype=np.float32) if "vectors" in arrays else None
+            return ids, vectors, lambda vector, k: [i for i, _score in store.search_vectors(vector[None, :], k)[0]]
+        collection = store._collection
+        records = collection.get(include=["embeddings"])
+        vectors = np.asarray(records["embeddings"], dtype=np.float32)
+        return records["ids"], vectors, lambda vector, k: collection.query(
+            query_embeddings=[vector.tolist()], n_results=k, include=[]
+        )["ids"][0]
+
+    # Measure the latency and recall of a store, using a held-out sample of its own vectors as queries
+    def benchmark(self, store: VectorStore, sample_size: int = 50, k: int = 10) -> dict:
+        ids, vectors, search = self.get_search(store)
+        if len(ids) <= k or vectors is None:
+            return {"queries": 0}
+        normalized = NumpyVectorStore.normalize(vectors)
+        sample = np.random.default_rng(0).permutation(len(ids))[:sample_size]
+        latencies = []
+        recalls = []
+        for row in sample:
+            start = time.perf_counter()
+            found = search(vectors[row], k + 1)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+            # Exact neighbours by cosine similarity, the query itself excluded
+            scores = normalized @ normalized[row]
+            scores[row] = -np.inf
+            expected = {ids[i] for i in np.argpartition(-scores, k - 1)[:k]}
+            found = [i for i in found if i != ids[row]][:k]
+            recalls.append(len(expected & set(found)) / k)
+        return {
+            "queries": len(sample),
+            "recall@{}".format(k): round(float(np.mean(recalls)), 3),
+            "p50": "{:.1f}ms".format(float(np.percentile(latencies, 50))),
+            "p95": "{:.1f}ms".format(float(np.percentile(latencies, 95))),
+        }
+
+
+class RowParser:
+    """Row parser class, splits table and csv answers into rows as their text arrives"""
+
+    SOURCES_MARKER = ":left_arrow_curving_right:"  # Sources of vector db answers, not rows
+    SEPARATOR_PATTERN = re.compile(r"^\s*\|?(\s*:?-+:?\s*\|)*\s*:?-+:?\s*\|?\s*$")  # |---|:--:| lines of tables
+
+    def __init__(self, mode: str, separator: str = ","):
+        self.mode = mode
+        self.separator = separator
+        self.buffer = ""  # Text of the current line
+        self.started = False  # Text before the first row of a table is dropped
+        self.fenced = False  # Inside a ``` block
+        self.done = False  # A ``` block was closed, the rest is dropped
+
+    # Feed text, returning the rows completed by it
+    def feed(self, text: str) -> list[list[str]]:
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        return [row for row in map(self.parse_line, lines) if row is not None]
+
+    # Parse the last line
+    def close(self) -> list[list[str]]:
+        line, self.buffer = self.buffer, ""
+        row = self.parse_line(line)
+        return [row] if row is not None else []
+
+    # Get the cells of a line, or None if it isn't a row
+    def parse_line(self, line: str) -> list[str] | None:
+        if line.strip().startswith("```"):
+            self.done = self.fenced
+            self.fenced = not self.fenced
+            return None
+        if self.done or not line.strip() or line.startswith(self.SOURCES_MARKER):
+            return None
+
+        if self.mode == "table":
+            if "|" not in line or self.SEPARATOR_PATTERN.match(line):
+                return None
+            if not self.started:
+                # Remove everything before the first |
+                line = "|" + line.split("|", 1)[1]
+                self.started = True
+            return line.split("|")
+
+        # Quoted fields may hold the separator
+        if len(self.separator) == 1:
+            return next(csv.reader([line], delimiter=self.separator))
+        return line.split(self.separator)
+
+
+class RowWriter:
+    """Row writer class, writes rows to a file or stdout as CSV, TSV or JSONL"""
+
+    FORMATS = {".csv": "csv", ".tsv": "tsv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+    def __init__(self, path: str, output_format: str | None = None, mode: str = "csv"):
+        self.path = path
+        self.mode = mode  # Rows of tables have empty outer cells
+        self.format = output_format or self.FORMATS.get(os.path.splitext(path)[1].lower(), "csv")
+        if self.format not in self.FORMATS.values():
+            raise ValueError("Unknown format: {}".format(self.format))
+        self.file = sys.stdout if path == "-" else open(os.path.expanduser(path), "w", newline="")
+        self.writer = csv.writer(self.file, delimiter="\t" if self.format == "tsv" else ",")
+        self.header = None  # The first row, keys of JSONL objects
+        self.count = 0  # Rows written, without the header
+
+    # Get the cells of a row, without the empty cells of the outer | of tables
+    def clean(self, row: list[str]) -> list[str]:
+        cells = [cell.strip() for cell in row]
+        if self.mode != "table":
+            return cells
+        if len(cells) > 1 and cells[0] == "":
+            cells = cells[1:]
+        if len(cells) > 1 and cells[-1] == "":
+            cells = cells[:-1]
+        return cells
+
+    # Write a row, flushed so that it can be piped right away
+    def write(self, row: list[str]) -> None:
+        cells = self.clean(row)
+        if self.header is None:
+            self.header = cells
+            if self.format == "jsonl":
+                return
+        else:
+            self.count += 1
+        if self.format == "jsonl":
+            self.file.write(json.dumps(dict(zip(self.header, cells)), ensure_ascii=False) + "\n")
+        else:
+            self.writer.writerow(cells)
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not sys.stdout:
+            self.file.close()
+
+    # Get rows as separated values, quoted like CSV when the separator is a single character
+    @staticmethod
+    def format_rows(rows: list[list[str]], separator: str = ",") -> str:
+        if len(separator) != 1:
+            return "\n".join(separator.join(cells) for cells in rows)
+        output = io.StringIO()
+        csv.writer(output, delimiter=separator, lineterminator="\n").writerows(rows)
+        return output.getvalue().rstrip("\n")
+
+
+class MessageNode:
+    """Message node class, a message linked to the messages before it, never modified once created"""
+
+    __slots__ = ("message", "parent", "depth")
+
+    def __init__(self, message: dict, parent: "MessageNode | None" = None):
+        self.message = message
+        self.parent = parent
+        self.depth = 1 if parent is None else parent.depth + 1
+
+
+class Conversation:
+    """Conversation class, a list of messages with branches sharing their common history"""
+
+    def __init__(self):
+        self.branches = {"main": None}  # Last message node, by branch
+        self.branch = "main"
+
+    # Get the last message node of the current branch
+    @property
+    def head(self) -> MessageNode | None:
+        return self.branches[self.branch]
+
+    # Add a message to the current branch, the messages before it are shared, not copied
+    def append(self, message: dict) -> None:
+        self.branches[self.branch] = MessageNode(message, self.head)
+
+    # Get the message nodes of a branch, oldest first
+    def get_nodes(self, head: MessageNode | None = None) -> list[MessageNode]:
+        nodes = []
+        node = head if head is not None else self.head
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        return nodes[::-1]
+
+    # Get the messages of the current branch, oldest first
+    def get_messages(self) -> list[dict]:
+        return [node.message for node in self.get_nodes()]
+
+    def __iter__(self):
+        return iter(self.get_messages())
+
+    def __len__(self) -> int:
+        return 0 if self.head is None else self.head.depth
+
+    def __getitem__(self, index):
+        return self.get_messages()[index]
+
+    # Get the number of turns (user messages) of a branch
+    def count_turns(self, head: MessageNode | None) -> int:
+        return sum(1 for node in self.get_nodes(head) if node.message["role"] == "user")
+
+    # Create a branch keeping the first turns of the current branch (all by default), and switch to it
+    def fork(self, branch: str, turn: int | None = None) -> None:
+        if branch in self.branches:
+            raise ValueError("A branch with that name already exists.")
+        head = self.head
+        if turn is not None:
+            nodes = self.get_nodes()
+            user_indexes = [i for i, node in enumerate(nodes) if node.message["role"] == "user"]
+            if not 0 <= turn <= len(user_indexes):
+                raise ValueError("Turn must be between 0 and {}.".format(len(user_indexes)))
+            if turn == 0:
+                head = None
+            else:
+                # The turn ends with its answer, when there is one
+                i = user_indexes[turn - 1]
+                if i + 1 < len(nodes) and nodes[i + 1].message["role"] == "assistant":
+                    i += 1
+                head = nodes[i]
+        self.branches[branch] = head
+        self.branch = branch
+
+    # Switch to a branch
+    def checkout(self, branch: str) -> None:
+        if branch not in self.branches:
+            raise ValueError("No branch with that name found.")
+        self.branch = branch
+
+    # Get the turns of each branch, and the turns it shares with the current one
+    def list_branches(self) -> dict:
+        current = set(map(id, self.get_nodes()))
+        return {
+            branch: {
+                "turns": self.count_turns(head),
+                "shared": sum(
+                    1 for node in self.get_nodes(head) if id(node) in current and node.message["role"] == "user"
+                ),
+            }
+            for branch, head in self.branches.items()
+        }
+
+
+class Session:
+    """Session class, the state of one conversation"""
+
+    def __init__(self, mode: str = "normal", persona: str = "default", vector_db: str = ""):
+        self.conversation = Conversation()
+        self.user_prompt = ""
+        self.response = ""  # Last response, as text
+        self.processed_response = None  # Last response, formatted for display
+        self.mode = mode
+        self.persona = persona
+        self.vector_db = vector_db  # Vector dbs, separated by commas
+        self.model = None  # Model, the configured one if None
+        self.temperature = None  # Temperature, the persona's if None
+        self.max_tokens = None  # Max tokens, the configured ones if None
+        self.lock = threading.Lock()  # One request at a time per session
 
 
 class ChatModel:
     """Chat model class"""
 
+    VECTOR_DB_BACKENDS = ["chroma", "numpy"]
+
+    # Words with digits, underscores, inner capitals, dots or all capitals
+    IDENTIFIER_PATTERN = re.compile(r"^(?=.*[A-Za-z])(\w*[_\d]\w*|[a-z]+[A-Z]\w*|[A-Z]{2,}\w*|[\w-]+[./][\w./-]+)$")
+
+    # Chunking of vector dbs created before chunking profiles existed
+    LEGACY_CHUNKING = {
+        "name": "legacy",
+        "size": 300,
+        "overlap": 100,
+        "unit": "characters",
+        "format_aware": False,
+    }
+
     def __init__(self):
+        self.personae = None  # Cached personae
+        self.personae_mtime = None
         self.config = self.get_config()
         self.logging = self.config["debug"]["logging"]
         self.logger = self.set_logger(self.logging)
-        self.client = OpenAI()
+        self.ledger = UsageLedger(self.config, self.logger)
+        self.api = ApiClient(self.config, self.logger, self.ledger)
+        self.client = self.api.client
+        self.router = ModelRouter(self.config, self.logger)
+        self.hedger = RequestHedger(self.config, self.logger, self.api)
+        self.embedding_cache = EmbeddingCache(self.config, self.logger)
+        self.images = ImagePipeline(self.config, self.logger, self.api)
+        self.images_callback = None  # Called when background images are done
+        self.compactor = ContentCompactor(self.config, self.logger)
+        self.speech = SpeechCapture(self.config, self.logger, self.transcribe)
+        self.speech_cache = SpeechCache(self.config, self.logger, self.api)
+        self.files = FileIncluder(self.config, self.logger, self.compactor)
+        self.crawler = WebCrawler(self.config, self.logger, self.compactor)
+        self.quick = False  # Shell integration (-i) call
+        self.session = Session()  # Session of the command line
         self.mode = self.set_mode("normal")  # Default mode
         self.persona = self.set_persona("default")
         self.voice_output = False  # Default voice output
         self.vector_db = ""  # Default
+        self.handles_lock = threading.RLock()  # Guards the vector store and lexical index handles
+        self.vector_stores = {}  # Open vector store handles
+        self.settings_lock = threading.RLock()  # Guards the read-modify-write of the vector db settings
+        self.retrieval_cache = RetrievalCache(
+            self.config.get("retrieval", {}).get("cache_entries", 256)
+        )
+        self.retrieval_workers = self.config.get("retrieval", {}).get("workers", 8)
+        self.retrieval_executor = ThreadPoolExecutor(max_workers=self.retrieval_workers)
+        self.lexical_indexes = {}  # Open lexical index handles
+        self.maintainer = IndexMaintainer(self.logger)
+        self.ingester = AutoIngester(self.config, self.logger, self.ingest_file)
+
+    # The state of the command line session
+
+    @property
+    def conversation(self) -> list:
+        return self.session.conversation
+
+    @conversation.setter
+    def conversation(self, conversation: list) -> None:
+        self.session.conversation = conversation
+
+    @property
+    def user_prompt(self) -> str:
+        return self.session.user_prompt
+
+    @user_prompt.setter
+    def user_prompt(self, user_prompt: str) -> None:
+        self.session.user_prompt = user_prompt
+
+    @property
+    def processed_response(self) -> str | Table | Syntax:
+        return self.session.processed_response
+
+    @processed_response.setter
+    def processed_response(self, processed_response: str | Table | Syntax) -> None:
+        self.session.processed_response = processed_response
+
+    @property
+    def mode(self) -> str:
+        return self.session.mode
+
+    @mode.setter
+    def mode(self, mode: str) -> None:
+        self.session.mode = mode
+
+    @property
+    def persona(self) -> str:
+        return self.session.persona
+
+    @persona.setter
+    def persona(self, persona: str) -> None:
+        self.session.persona = persona
+
+    @property
+    def vector_db(self) -> str:
+        return self.session.vector_db
+
+    @vector_db.setter
+    def vector_db(self, vector_db: str) -> None:
+        self.session.vector_db = vector_db
+
+    # Create a session, sharing the clients, caches and vector db handles
+    def new_session(self, mode: str = "normal", persona: str = "default", vector_db: str = "") -> Session:
+        if mode not in self.list_modes():
+            raise ValueError("No mode with that name found.")
+        if persona not in [existing["name"] for existing in self.list_personae()["persona"]]:
+            raise ValueError("No persona with that name found.")
+        session = Session(mode, persona, vector_db)
+        session.temperature = self.get_persona_temperature(persona)
+        for vector_db_name in self.get_vector_db_names(session):
+            self.create_vector_db(vector_db_name, None, None, None)
+        return session
 
     def set_logger(self, logging_status: bool) -> logging.Logger | None:
         """Set up logging"""
@@ -89,6 +3632,8 @@ class ChatModel:
         log = logging.getLogger("rich")
         if logging_status is not True:
             logging.disable(sys.maxsize)
+        else:
+            logging.disable(logging.NOTSET)
         return log
 
     def get_config(self) -> dict:
@@ -133,25 +3678,21 @@ class ChatModel:
 
         # check if env_path exists
         if not os.path.exists(env_path):
-            print(f"Error: {env_path} not found.")
-            print("Make sure the file exists and OPENAI_API_KEY is set in the file.")
-            exit(1)
+            raise ValueError(
+                "{} not found. Make sure the file exists and OPENAI_API_KEY is set in the file.".format(env_path)
+            )
 
         try:
             with open(env_path, "r") as f:
                 env = toml.load(f)
                 # OpenAI
                 openai_api_key = env["OPENAI_API_KEY"]
-                if openai_api_key != "":
-                    config["openai"]["api_key"] = openai_api_key
-                    os.environ["OPENAI_API_KEY"] = openai_api_key
-                else:
-                    print(f"Error: OPENAI_API_KEY not set in {env_path}")
-                    exit(1)
-
         except Exception as e:
-            print("Error: {}".format(e))
-            exit(1)
+            raise ValueError("Error reading {}: {}".format(env_path, e))
+        if openai_api_key == "":
+            raise ValueError("OPENAI_API_KEY not set in {}".format(env_path))
+        config["openai"]["api_key"] = openai_api_key
+        os.environ["OPENAI_API_KEY"] = openai_api_key
 
         # Create data folder if it doesn't exist
         data_folder = config["conversations"]["data_folder"]
@@ -168,36 +3709,114 @@ class ChatModel:
         if not os.path.exists(image_path):
             os.makedirs(image_path)
 
+        # Remember which files to watch for changes
+        self.config_files = [config_path, env_path]
+        self.config_mtimes = self.get_config_mtimes()
+
         return config
 
-    def generate_final_message(self, user_prompt: str) -> list:
+    def get_config_mtimes(self) -> dict:
+        """Get the modification times of the config files"""
+
+        mtimes = {}
+        for path in self.config_files:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def config_changed(self) -> bool:
+        """Check if the config files changed since they were loaded"""
+
+        return self.get_config_mtimes() != self.config_mtimes
+
+    def reload_config(self) -> None:
+        """Reload config, personae and API keys in place, keeping the conversation and clients"""
+
+        try:
+            config = self.get_config()
+        except Exception:
+            # The old config is kept, and the error only reported again on the next change
+            self.config_mtimes = self.get_config_mtimes()
+            raise
+
+        # Update in place, the other components hold a reference to it
+        self.config.clear()
+        self.config.update(config)
+
+        self.logging = self.config["debug"]["logging"]
+        self.set_logger(self.logging)
+
+        self.client.api_key = self.config["openai"]["api_key"]
+        self.api.configure(self.config)
+        self.ledger.configure(self.config)
+        self.router.configure(self.config)
+        self.hedger.configure(self.config)
+        self.embedding_cache.configure(self.config)
+        self.images.configure(self.config)
+        self.compactor.configure(self.config)
+        self.speech.configure(self.config)
+        self.speech_cache.configure(self.config)
+        self.files.configure(self.config)
+        self.crawler.configure(self.config)
+        self.ingester.configure(self.config)
+
+        # Retrieval settings
+        retrieval_config = self.config.get("retrieval", {})
+        self.retrieval_cache.resize(retrieval_config.get("cache_entries", 256))
+        workers = retrieval_config.get("workers", 8)
+        if workers != self.retrieval_workers:
+            self.retrieval_workers = workers
+            executor, self.retrieval_executor = self.retrieval_executor, ThreadPoolExecutor(max_workers=workers)
+            # Running retrievals finish on the old workers
+            executor.shutdown(wait=False)
+
+        # Force personae to be read again
+        self.personae = None
+
+        # Vector stores hold the old embeddings settings
+        with self.handles_lock:
+            self.vector_stores = {}
+
+        # Fall back to defaults if the current mode or persona is gone
+        if self.mode not in self.list_modes():
+            self.mode = "normal"
+        try:
+            self.set_persona(self.persona)
+        except ValueError:
+            self.set_persona("default")
+
+    def generate_final_message(self, user_prompt: str, session: Session | None = None) -> list:
         """Generate final prompt (messages) for OpenAI API"""
 
+        session = session or self.session
+
         # Add a dot at the end of the prompt if there isn't one
         if user_prompt[-1] not in ["?", "!", "."]:
             user_prompt += "."
-        self.user_prompt = user_prompt
+        session.user_prompt = user_prompt
 
         # Conversation up to this point
-        conversation = self.conversation
+        conversation = session.conversation
 
         # Persona identity
         if not conversation:
-            self.logger.info("Persona : {}".format(self.persona))
-            if not isinstance(self.persona, str):
+            self.logger.info("Persona : {}".format(session.persona))
+            if not isinstance(session.persona, str):
                 self.logger.info("Persona is not a string")
-                self.persona = "default"
+                session.persona = "default"
 
-            persona_identity = self.get_persona_identity()
+            persona_identity = self.get_persona_identity(session.persona)
             for message in persona_identity:
                 conversation.append(message)
 
         # Mode instructions
-        self.logger.info("Mode : {}".format(self.mode))
-        mode_instructions = self.config["modes"][self.mode]
+        self.logger.info("Mode : {}".format(session.mode))
+        mode_instructions = self.config["modes"][session.mode]
         if mode_instructions:
             # Replace # with all the text after # in the user_prompt
-            hashtag = self.find_hashtag(self.user_prompt)
+            hashtag = self.find_hashtag(session.user_prompt)
             self.logger.info("hashtag: {}".format(hashtag))
             if hashtag:
                 mode_instructions = mode_instructions.replace("#", hashtag)
@@ -207,17 +3826,8 @@ class ChatModel:
 
         # File content to insert
         if "~{f:" in user_prompt and "}~" in user_prompt:
-            file_path = user_prompt.split("~{f:")[1].split("}~")[0]
-            self.logger.info("file_path: {}".format(file_path))
-            if os.path.isfile(file_path):
-                with open(file_path, "r") as f:
-                    file_content = f.read()
-                    user_prompt = user_prompt.replace(
-                        "~{f:" + file_path + "}~", file_content
-                    )
-                    self.logger.info("user_prompt: {}".format(user_prompt))
-            else:
-                self.logger.info("File not found")
+            user_prompt = self.files.include(user_prompt)
+            self.logger.info("user_prompt: {}".format(user_prompt))
 
         # URL content to insert
         if "~{w:" in user_prompt and "}~" in user_prompt:
@@ -227,12 +3837,12 @@ class ChatModel:
                 response = requests.get(url)
                 if response.status_code == 200:
                     self.logger.info("response: {}".format(response))
-                    soup = BeautifulSoup(response.text, "html.parser")
-                    url_content = soup.get_text()
-                    # remove all newlines and extra spaces
-                    url_content = re.sub(r"\s+", " ", url_content)
-                    if len(url_content) > 3000:
-                        url_content = url_content[:3000]
+                    url_content = self.compactor.compact(response.text, url, html=True)
+                    # Cut at the token budget, on a line
+                    max_tokens = self.config.get("compaction", {}).get("web_max_tokens", 1500)
+                    tokens = get_encoding().encode(url_content, disallowed_special=())
+                    if len(tokens) > max_tokens:
+                        url_content = get_encoding().decode(tokens[:max_tokens]).rsplit("\n", 1)[0]
                     user_prompt = user_prompt.replace("~{w:" + url + "}~", url_content)
                     self.logger.info("user_prompt: {}".format(user_prompt))
                 else:
@@ -244,176 +3854,253 @@ class ChatModel:
         user_prompt = {"role": "user", "content": user_prompt}
         conversation.append(user_prompt)
         self.logger.info("User prompt : {}".format(user_prompt))
-        self.logger.info("Final messages: {}".format(conversation))
+        messages = conversation.get_messages()
+        self.logger.info("Final messages: {}".format(messages))
 
-        return conversation
+        return messages
 
-    def generate_response(self, messages: list) -> str | Exception:
+    def generate_response(self, messages: list, session: Session | None = None) -> str | Exception:
         """Generate response from OpenAI API"""
 
-        prompt = json.dumps(messages)
+        session = session or self.session
 
         api_key = self.config["openai"]["api_key"]
         self.logger.info("api_key: {}".format(api_key))
 
-        # Image mode
-        if self.mode == "img":
-            image_path = self.config["images"]["path"]
+        # Usage is recorded per persona, mode and vector db
+        with self.ledger.attribute(persona=session.persona, mode=session.mode, vector_db=session.vector_db) as usage:
+            response_data = self.request_response(messages, session, usage)
 
-            if not os.path.exists(image_path):
-                os.makedirs(image_path)
+        session.response = response_data["message"]
+        session.processed_response = self.process_response(response_data["message"], session)
 
+        return session.processed_response
+
+    # Request a response (an answer or images), with its usage
+    def request_response(self, messages: list, session: Session, usage: dict) -> dict:
+
+        # Image mode
+        if session.mode == "img":
             image_prompt = messages[-1]["content"]
 
             try:
-                image_raw_data = self.generate_image(image_prompt)
-                image_obj = Image.open(BytesIO(base64.b64decode(image_raw_data)))
-                timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                image_file = slugify(image_prompt) + "-" + timestamp + ".png"
-                image_fullpath = image_path + image_file
-                image_obj.save(image_fullpath)
-                if self.config["images"]["open"]:
-                    open_command = self.config["images"]["open_command"]
-                    os.system(open_command + " " + image_fullpath)
-                response_data = {"message": "Image generated and saved to : {}".format(image_fullpath)}
+                cached_images = self.images.get_cached(image_prompt)
+                if cached_images:
+                    self.images.open(cached_images)
+                    response_data = {"message": "Image loaded from cache : {}".format(", ".join(cached_images))}
+
+                # Command line calls (and other sessions) wait for the images
+                elif self.quick or self.images_callback is None or session is not self.session:
+                    image_paths = self.images.generate(image_prompt)
+                    self.images.open(image_paths)
+                    response_data = {"message": "Image generated and saved to : {}".format(", ".join(image_paths))}
+
+                else:
+                    self.images.submit(image_prompt, self.images_callback)
+                    response_data = {"message": "Generating {} image(s) in the background...".format(self.images.variants)}
             except Exception as e:
                 self.logger.error("Error generating image: {}".format(e))
+                response_data = {"message": "Error generating image: {}".format(e)}
 
         else:
 
-            model = self.config["openai"]["model"]
-            self.logger.info("model: {}".format(model))
-
-            temperature = self.get_persona_temperature(self.persona)
-            self.logger.info("temperature: {}".format(temperature))
+            try:
+                model, request_messages, temperature, sources_text = self.prepare_request(messages, session)
 
-            max_tokens = self.config["openai"]["max_tokens"]
-            self.logger.info("max_tokens: {}".format(max_tokens))
+                start_time = time.time()
+                # Hedged requests are only used in normal chat
+                if self.hedger.enabled and session.vector_db == "":
+                    response, model = self.hedger.create(
+                        model, request_messages, temperature
+                    )
+                else:
+                    response = self.chat_completion(model, request_messages, temperature)
+                self.router.record_latency(model, time.time() - start_time)
+
+                # Usage reported by the API for this request (embeddings of the query included)
+                response_data = {
+                    "id": "",
+                    "created": "",
+                    "status": "success",
+                    "message": f"{response}\n{sources_text}" if sources_text else response,
+                    "promptTokens": usage["prompt_tokens"],
+                    "completionTokens": usage["completion_tokens"],
+                    "totalTokens": usage["prompt_tokens"] + usage["completion_tokens"],
+                    "cost": usage["cost"],
+                }
+                self.logger.info("response_data: {}".format(response_data))
+                self.logger.info("Total tokens: {}".format(response_data["totalTokens"]))
+
+                # Add to conversation (only in normal chat)
+                if session.vector_db == "":
+                    response_message = {"role": "assistant", "content": response_data["message"]}
+                    session.conversation.append(response_message)
 
-            # Vector DB query
-            if self.vector_db != "":
-                self.logger.info("type of query: vector db")
+            except Exception as e:
+                self.logger.exception(e)
+                raise
+
+        return response_data
+
+    # Get the model, messages and temperature of a request, with the context of the vector dbs and its sources
+    def prepare_request(self, messages: list, session: Session) -> tuple[str, list, float, str]:
+        model = self.router.route(
+            messages,
+            session.mode,
+            session.persona,
+            session.vector_db != "",
+            self.quick,
+            session.model,
+        )
+        # Cheaper model when a budget runs low
+        model = self.ledger.downgrade(model)
+        self.logger.info("model: {}".format(model))
+
+        temperature = session.temperature
+        if temperature is None:
+            temperature = self.get_persona_temperature(session.persona)
+        self.logger.info("temperature: {}".format(temperature))
+
+        max_tokens = session.max_tokens or self.config["openai"]["max_tokens"]
+        self.logger.info("max_tokens: {}".format(max_tokens))
+
+        if session.vector_db == "":
+            self.logger.info("type of query: default")
+            return model, messages, temperature, ""
+
+        # Vector DB query
+        self.logger.info("type of query: vector db")
+        vector_db_names = self.get_vector_db_names(session)
+        self.logger.info("vector_db_names: {}".format(vector_db_names))
+
+        # Search the DBs.
+        query = messages[-1]["content"]
+        self.logger.info("query: {}".format(query))
+        results = self.retrieve_many(
+            vector_db_names,
+            query,
+            k=self.config.get("context", {}).get("candidates", 12),
+        )
+        self.logger.info("results: {}".format(results))
+
+        # Pack the results into the context token budget
+        context_text, packed_documents = ContextPacker(self.config).pack(results)
+        self.logger.info("Context tokens: {}".format(Chunker.count_tokens(context_text)))
+        prompt = json.dumps(messages).replace("{context}", context_text)
+
+        sources = [
+            (doc.metadata.get("vector_db"), doc.metadata.get("source", None))
+            for doc in packed_documents
+        ]
+        sources_text = "\n"
+        sources = list(dict.fromkeys(sources))
+        for i, (source_db, source) in enumerate(sources):
+            source = str(source).split("/")[-1]
+            if len(vector_db_names) > 1:
+                source = "{} ({})".format(source, source_db)
+            sources_text += "\n:left_arrow_curving_right: " + source + "\n"
+        sources_text = sources_text.strip()
+
+        return model, [{"role": "user", "content": prompt}], temperature, sources_text
+
+    # Generate a response to a prompt in a session, one request at a time per session
+    def ask(self, user_prompt: str, session: Session) -> str:
+        with session.lock:
+            messages = self.generate_final_message(user_prompt, session)
+            self.generate_response(messages, session)
+            return session.response
+
+    # Stream the response to a prompt in a session, as text deltas
+    def ask_stream(self, user_prompt: str, session: Session, process: bool = True):
+        with session.lock, self.ledger.attribute(persona=session.persona, mode=session.mode, vector_db=session.vector_db):
+            messages = self.generate_final_message(user_prompt, session)
+            if session.mode == "img":
+                self.generate_response(messages, session)
+                yield session.response
+                return
 
-                try:
-                    with get_openai_callback() as callback:
+            model, request_messages, temperature, sources_text = self.prepare_request(messages, session)
+            start_time = time.time()
+            deltas = []
+            for delta in self.stream_completion(model, request_messages, temperature):
+                deltas.append(delta)
+                yield delta
+            self.router.record_latency(model, time.time() - start_time)
+            if sources_text:
+                deltas.append("\n" + sources_text)
+                yield "\n" + sources_text
+
+            session.response = "".join(deltas)
+            # Streamed rows aren't built into a table
+            session.processed_response = self.process_response(session.response, session) if process else session.response
+            if session.vector_db == "":
+                session.conversation.append({"role": "assistant", "content": session.response})
+
+    # Stream the rows of a table or csv answer as they arrive
+    def stream_rows(self, user_prompt: str, session: Session | None = None):
+        session = session or self.session
+        parser = RowParser(session.mode, self.find_hashtag(user_prompt) or ",")
+        for delta in self.ask_stream(user_prompt, session, process=False):
+            yield from parser.feed(delta)
+        yield from parser.close()
+
+    def chat_completion(self, model: str, messages: list, temperature: float) -> str:
+        """Generate a chat completion through the API client"""
+
+        chat_completions = self.api.call(
+            "chat",
+            self.client.chat.completions.create,
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            tokens=ModelRouter.count_tokens(messages),
+        )
+        return chat_completions.choices[0].message.content
+
+    def stream_completion(self, model: str, messages: list, temperature: float):
+        """Stream a chat completion through the API client, as text deltas"""
+
+        stream = self.api.call(
+            "chat",
+            self.client.chat.completions.create,
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            tokens=ModelRouter.count_tokens(messages),
+        )
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+
+    def get_embeddings(self) -> ApiEmbeddings:
+        """Get the embeddings function for the vector dbs"""
+
+        return ApiEmbeddings(
+            self.api,
+            self.config["embeddings"]["model"],
+            self.config.get("api", {}).get("embeddings_batch_size", 256),
+            self.embedding_cache,
+        )
 
-                        vector_db_name = self.vector_db
-                        self.logger.info("vector_db_name: {}".format(vector_db_name))
+    def process_response(self, response: str, session: Session | None = None) -> str | Table | Syntax:
+        """Process response, formats the response"""
 
-                        persist_folder = self.config["vector_db"]["persist_folder"]
-                        self.logger.info("persist_folder: {}".format(persist_folder))
+        session = session or self.session
 
-                        full_path = os.path.join(persist_folder, vector_db_name)
-                        self.logger.info("full_path: {}".format(full_path))
+        # Remove double line breaks
+        response = response.replace("\n\n", "\n")
 
-                        # Embeddings
-                        embeddings = OpenAIEmbeddings(
-                            openai_api_key=os.environ["OPENAI_API_KEY"],
-                            model=self.config["embeddings"]["model"],
-                        )
-
-                        # Vector store
-                        full_path = os.path.join(persist_folder, vector_db_name)
-                        vector_db = Chroma(
-                            persist_directory=full_path,
-                            embedding_function=embeddings
-                        )
-
-                        # Search the DB.
-                        self.logger.info("prompt: {}".format(prompt))
-                        results = vector_db.similarity_search_with_relevance_scores(
-                            prompt,
-                            k=4,
-                            # score_threshold=0.8
-                        )
-                        self.logger.info("results: {}".format(results))
-
-                        context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
-                        prompt = prompt.replace("{context}", context_text)
-
-                        model = ChatOpenAI()
-                        response = model.invoke(prompt)
-
-                        sources = [doc.metadata.get("source", None) for doc, _score in results]
-                        sources_text = "\n"
-                        sources = list(set(sources))
-                        for i, source in enumerate(sources):
-                            source = source.split("/")[-1]
-                            sources_text += "\n:left_arrow_curving_right: " + source + "\n"
-                        sources_text = sources_text.strip()
-
-                        formatted_response = f"{response.content}\n{sources_text}"
-
-                        response_data = {
-                            "id": "",
-                            "created": "",
-                            "status": "success",
-                            "message": formatted_response,
-                            "promptTokens": callback.prompt_tokens,
-                            "completionTokens": callback.completion_tokens,
-                            "totalTokens": callback.total_tokens,
-                        }
-                        self.logger.info("response_data: {}".format(response_data))
-                        self.logger.info("Total tokens: {}".format(callback.total_tokens))
-
-                except Exception as e:
-                    self.logger.exception(e)
-
-            # Normal query
-            else:
-                self.logger.info("type of query: default")
-
-                llm = ChatOpenAI(
-                    openai_api_key=os.environ["OPENAI_API_KEY"],
-                    model_name=model,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                )
-                try:
-                    with get_openai_callback() as callback:
-                        chat_completions = self.client.chat.completions.create(
-                            model=model,
-                            messages=messages,
-                            temperature=temperature,
-                        )
-                        response = chat_completions.choices[0].message.content
-                        response_data = {
-                            "id": "",
-                            "created": "",
-                            "status": "success",
-                            "message": response,
-                            "promptTokens": callback.prompt_tokens,
-                            "completionTokens": callback.completion_tokens,
-                            "totalTokens": callback.total_tokens,
-                            # 'sourceDocuments': response['source_documents'][0],
-                        }
-                        self.logger.info("response_data: {}".format(response_data))
-                        self.logger.info("Total tokens: {}".format(callback.total_tokens))
-
-                        # Add to conversation (only in normal chat)
-                        response_message = {"role": "assistant", "content": response_data["message"]}
-                        self.conversation.append(response_message)
-
-                except Exception as e:
-                    self.logger.exception(e)
-
-        self.processed_response = self.process_response(response_data["message"])
-
-        return self.processed_response
-
-    def process_response(self, response: str) -> str | Table | Syntax:
-        """Process response, formats the response"""
-
-        # Remove double line breaks
-        response = response.replace("\n\n", "\n")
-
-        # Keep only what is between ``` and ```
-        if "```" in response:
-            response = response.split("```")[1]
-            response = response.split("```")[0]
+        # Keep only what is between ``` and ```
+        if "```" in response:
+            response = response.split("```")[1]
+            response = response.split("```")[0]
 
         # Table mode
-        if self.mode == "table":
+        if session.mode == "table":
             # Remove everything before the first |
             if "|" in response:
                 response = response.split("|", 1)[1]
@@ -421,30 +4108,26 @@ class ChatModel:
 
             self.logger.info("response: {}".format(response))
 
-            lines = response.split("\n")
-            lines = list(filter(None, lines))
-
-            # remove lines that contain '---'
-            lines = [line for line in lines if "---" not in line]
+            parser = RowParser("table")
+            rows = parser.feed(response) + parser.close()
 
             # Create table
             table = Table(show_lines=True)
 
             # Add columns
-            for column in lines[0].split("|"):
+            for column in rows[0]:
                 table.add_column(column)
 
             # Add rows
-            for row in lines[1:]:
-                cells = row.split("|")
+            for cells in rows[1:]:
                 table.add_row(*cells)
 
             # Return table
             return table
 
         # Code mode
-        elif self.mode == "code":
-            language = self.find_hashtag(self.user_prompt)
+        elif session.mode == "code":
+            language = self.find_hashtag(session.user_prompt)
             syntax = Syntax(
                 response,
                 language,
@@ -455,9 +4138,10 @@ class ChatModel:
             return syntax
 
         # CSV mode
-        elif self.mode == "csv":
-            separator = self.find_hashtag(self.user_prompt)
-            response = response.replace(",", separator)
+        elif session.mode == "csv":
+            separator = self.find_hashtag(session.user_prompt) or ","
+            parser = RowParser("csv")
+            response = RowWriter.format_rows(parser.feed(response) + parser.close(), separator)
 
         return response
 
@@ -491,6 +4175,14 @@ class ChatModel:
             except Exception as e:
                 raise ValueError("No personae file found : {}".format(e))
 
+        # Use cached personae if the file didn't change
+        try:
+            personae_mtime = (personae_path, os.path.getmtime(personae_path))
+        except OSError:
+            personae_mtime = None
+        if self.personae is not None and personae_mtime == self.personae_mtime:
+            return self.personae
+
         # Load personae
         try:
             with open(personae_path, "r") as f:
@@ -499,6 +4191,9 @@ class ChatModel:
         except Exception as e:
             raise ValueError("No personae file found : {}".format(e))
 
+        self.personae = personae
+        self.personae_mtime = personae_mtime
+
         return personae
 
     # Set persona
@@ -517,12 +4212,13 @@ class ChatModel:
     def get_persona(self) -> str:
         return self.persona
 
-    # Get persona prompt
-    def get_persona_identity(self) -> str | list:
-        if self.persona != "":
+    # Get persona prompt (of the current persona by default)
+    def get_persona_identity(self, persona_name: str | None = None) -> str | list:
+        persona_name = persona_name or self.persona
+        if persona_name != "":
             personae = self.list_personae()
             for persona in personae["persona"]:
-                if persona["name"] == self.persona:
+                if persona["name"] == persona_name:
                     persona_identity = persona["messages"]
                     self.logger.info("Persona identity : {}".format(persona_identity))
         else:
@@ -530,11 +4226,11 @@ class ChatModel:
         return persona_identity
 
     # Get persona temperature
-    def get_persona_temperature(self, persona: str) -> float:
-        if persona != "":
+    def get_persona_temperature(self, persona_name: str) -> float:
+        if persona_name != "":
             personae = self.list_personae()
             for persona in personae["persona"]:
-                if persona["name"] == self.persona:
+                if persona["name"] == persona_name:
                     temperature = persona["temp"]
         return temperature
 
@@ -542,7 +4238,19 @@ class ChatModel:
 
     # Create new conversation
     def new_conversation(self) -> list:
-        self.conversation = []
+        self.conversation = Conversation()
+
+    # Fork the conversation into a branch, keeping its first turns (all by default)
+    def fork_conversation(self, branch: str, turn: int | None = None) -> None:
+        self.conversation.fork(branch, turn)
+
+    # Switch to a branch of the conversation
+    def checkout_conversation(self, branch: str) -> None:
+        self.conversation.checkout(branch)
+
+    # List the branches of the conversation
+    def list_branches(self) -> dict:
+        return self.conversation.list_branches()
 
     # Save conversation, write it to a file
     def save_conversation(self, filename: str) -> bool:
@@ -622,27 +4330,24 @@ class ChatModel:
 
     # List models
     def list_models(self) -> list:
-        models = self.client.models.list()
-        models = sorted(models, key=lambda x: x.created, reverse=True)
-        models_list = [model.id for model in models]
+        models_list = self.router.list_models(self.api)
         models_list = [model for model in models_list if "gpt" in model]
         self.logger.info("models_list: {}".format(models_list))
         return models_list
 
     # Get GPT model
     def get_model(self) -> str:
-        return self.config["openai"]["model"]
+        return self.session.model or self.config["openai"]["model"]
 
-    # Set GPT model
+    # Set GPT model, for the current session
     def set_model(self, model: str) -> bool:
-        self.config["openai"]["model"] = model
+        self.session.model = model
         return True
 
     # Audio
 
     # Voice input
     def listen(self) -> str | Exception:
-        self.config = self.get_config()
         self.input_device = self.config["audio"]["input_device"]
         self.input_timeout = self.config["audio"]["input_timeout"]
         self.logger.info("input_timeout: {}".format(self.input_timeout))
@@ -651,6 +4356,10 @@ class ChatModel:
 
         self.logger.info("Listening...")
 
+        # Audio is only loaded when used, sounddevice quiets the ALSA warnings of pyaudio
+        import sounddevice  # noqa: F401
+        import speech_recognition
+
         # https://github.com/Uberi/speech_recognition
         recognizer = speech_recognition.Recognizer()
 
@@ -658,18 +4367,8 @@ class ChatModel:
         with speech_recognition.Microphone(device_index=self.input_device) as source:
             recognizer.adjust_for_ambient_noise(source)
             try:
-                audio = recognizer.listen(
-                    source,
-                    timeout=self.input_timeout,
-                    phrase_time_limit=self.input_limit,
-                )
-
-                with open("tmp.wav", "wb") as f:
-                    f.write(audio.get_wav_data())
-                audio_file = open("tmp.wav", "rb")
-
-                # Transcribe audio to text https://platform.openai.com/docs/guides/speech-to-text
-                transcription = self.transcribe(audio_file)
+                # Segments of speech are transcribed while listening https://platform.openai.com/docs/guides/speech-to-text
+                transcription = self.speech.capture(source, recognizer.energy_threshold)
                 self.logger.info("transcription: {}".format(transcription))
 
                 return transcription
@@ -677,19 +4376,33 @@ class ChatModel:
             except speech_recognition.WaitTimeoutError as e:
                 return e
 
+            # Failed transcriptions are displayed by the controller
+            except Exception as e:
+                return e
+
     # Transcribe
-    def transcribe(self, audio_file: str) -> str:
+    def transcribe(self, audio_file) -> str:
 
         try:
-            transcript = self.client.audio.transcriptions.create(
+            # Transcriptions are billed by the second
+            seconds = 0
+            if isinstance(audio_file, tuple):
+                with wave.open(io.BytesIO(audio_file[1])) as wav:
+                    seconds = wav.getnframes() / wav.getframerate()
+            transcript = self.api.call(
+                "audio",
+                self.client.audio.transcriptions.create,
                 model="whisper-1",
                 file=audio_file,
+                units=seconds,
             )
             transcript = transcript.text
             return transcript
 
         except Exception as e:
+            # A failed segment fails the whole voice input, instead of silently dropping words
             self.logger.exception(e)
+            raise
 
     # Voice output
     def get_voice_output(self) -> str:
@@ -700,53 +4413,291 @@ class ChatModel:
 
     def speak(self, response: str) -> None:
         if self.voice_output:
-            audio_file = "./tmp.wav"
-            with openai_audio.speech.with_streaming_response.create(
-                    model=self.config["audio"]["model"],
-                    voice=self.config["audio"]["voice"],
-                    input=response,
-            ) as response:
-                response.stream_to_file(audio_file)
-                subprocess.run(["mpv", "--really-quiet", audio_file])
-                os.remove(audio_file)
+            with self.ledger.attribute(persona=self.persona, mode=self.mode):
+                self.speech_cache.speak(
+                    response,
+                    lambda audio_files: subprocess.run(["mpv", "--really-quiet"] + audio_files),
+                )
 
     # Documents
 
     # Load documents
     def load_documents(self, directory: str) -> list:
-        loader = DirectoryLoader(directory)
+        from langchain_community.document_loaders import DirectoryLoader  # Documents are only loaded when used
+
+        loader = DirectoryLoader(os.path.realpath(directory))
         documents = loader.load()
+        # Sources are real paths, as reported by watched folders
+        for document in documents:
+            document.metadata["source"] = os.path.realpath(document.metadata["source"])
         return documents
 
-    # Split text
-    def split_text(self, documents: list[Document]) -> list:
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=300,
-            chunk_overlap=100,
-            length_function=len,
-            add_start_index=True,
-        )
-        chunks = text_splitter.split_documents(documents)
+    # Split text, with the chunking profile of a vector db (the current one by default)
+    def split_text(self, documents: list[Document], vector_db: str | None = None) -> list:
+        vector_db = vector_db or self.vector_db
+        profile = self.get_vector_db_settings(vector_db).get("chunking", self.LEGACY_CHUNKING)
+        chunker = Chunker(profile)
+        chunks = chunker.split_documents(documents)
         return chunks
 
-    # Save to vector db
-    def save_chunks_to_db(self, chunks: list[Document]) -> None:
-        persist_folder = self.config["vector_db"]["persist_folder"]
-        vector_db_name = self.vector_db
-        full_path = os.path.join(persist_folder, vector_db_name)
-        self.logger.info("full_path: {}".format(full_path))
-        db = Chroma.from_documents(
-            chunks,
-            OpenAIEmbeddings(),
-            persist_directory=full_path,
+    # List chunking profiles
+    def list_chunking_profiles(self) -> dict:
+        return self.config.get("chunking", {}).get("profiles", {"legacy": self.LEGACY_CHUNKING})
+
+    # Get the chunking profile of the current vector db
+    def get_chunking_profile(self) -> dict:
+        return self.get_vector_db_settings(self.vector_db).get("chunking", self.LEGACY_CHUNKING)
+
+    # Set the chunking profile of a vector db (the current one by default), used by the next ingestions
+    def set_chunking_profile(self, profile_name: str, vector_db: str | None = None) -> None:
+        vector_db = vector_db or self.vector_db
+        profiles = self.list_chunking_profiles()
+        if profile_name not in profiles:
+            raise ValueError("No chunking profile with that name found.")
+        settings = self.get_vector_db_settings(vector_db)
+        settings["chunking"] = dict(profiles[profile_name], name=profile_name)
+        self.set_vector_db_settings(vector_db, settings)
+
+    # Compare chunking profiles on documents : chunk count, embedding tokens and retrieval hit rate
+    def compare_chunking_profiles(self, documents: list[Document], sample_size: int = 50, k: int = 4) -> list:
+        # Held-out queries are sentences taken from the documents, a hit is a top-k chunk containing it
+        sentences = []
+        for document in documents:
+            for sentence in re.split(r"(?<=[.!?])\s+", document.page_content):
+                sentence = " ".join(sentence.split())
+                if len(sentence.split()) >= 8:
+                    sentences.append(sentence)
+        queries = random.Random(0).sample(sentences, min(sample_size, len(sentences)))
+
+        report = []
+        for profile_name, profile in self.list_chunking_profiles().items():
+            chunks = Chunker(profile).split_documents(documents)
+            texts = [" ".join(chunk.page_content.split()) for chunk in chunks]
+            index = BM25Index()
+            index.add(texts)
+            hits = 0
+            for query in queries:
+                if any(query in texts[chunk_id] for chunk_id, _score in index.search(query, k)):
+                    hits += 1
+            report.append({
+                "profile": profile_name,
+                "chunks": len(chunks),
+                "tokens": sum(Chunker.count_tokens(chunk.page_content) for chunk in chunks),
+                "hit_rate": "{:.0%}".format(hits / len(queries)) if queries else "n/a",
+            })
+        return report
+
+    # Save to vector db, and to its lexical index
+    def save_chunks_to_db(self, chunks: list[Document], vector_db: str | None = None) -> None:
+        vector_db = vector_db or self.vector_db
+        vector_store = self.get_vector_store(vector_db)
+        # Embedding calls are batch jobs, throttled when a budget runs low
+        with self.ledger.attribute(vector_db=vector_db, batch=True):
+            vector_store.add_documents(chunks)
+        self.get_lexical_index(vector_db).add_documents(chunks)
+        self.bump_vector_db_generation(vector_db)
+
+    # Remove the chunks of a source from a vector db and its lexical index
+    def delete_source(self, vector_db: str, source: str) -> None:
+        if "://" not in source:
+            source = os.path.realpath(source)
+        vector_store = self.get_vector_store(vector_db)
+        shards = vector_store.shards if isinstance(vector_store, ShardedVectorStore) else [vector_store]
+        for shard in shards:
+            if isinstance(shard, NumpyVectorStore):
+                shard.delete_source(source)
+            else:
+                shard._collection.delete(where={"source": source})
+        self.get_lexical_index(vector_db).delete_source(source)
+
+    # Replace the chunks of a source, the new ones are embedded before the old ones are deleted
+    def replace_source(self, vector_db: str, source: str, chunks: list[Document]) -> None:
+        if chunks and self.embedding_cache.enabled:
+            # A failed embedding keeps the old chunks, the store then reads the new vectors from the cache
+            with self.ledger.attribute(vector_db=vector_db, batch=True):
+                self.get_embeddings().embed_documents([chunk.page_content for chunk in chunks])
+        self.delete_source(vector_db, source)
+        if chunks:
+            self.save_chunks_to_db(chunks, vector_db)
+        else:
+            self.bump_vector_db_generation(vector_db)
+
+    # Re-ingest a changed file of a vector db, replacing its chunks (a deleted file only loses them)
+    def ingest_file(self, vector_db: str, path: str) -> int:
+        # Checked first, so that a file held over budget keeps its old chunks
+        with self.ledger.attribute(vector_db=vector_db, batch=True):
+            self.ledger.check("embeddings")
+        path = os.path.realpath(path)
+        chunks = []
+        if os.path.isfile(path):
+            from langchain_community.document_loaders import UnstructuredFileLoader
+
+            documents = UnstructuredFileLoader(path).load()
+            chunks = self.split_text(documents, vector_db)
+        # Unchanged chunks are served by the embedding cache, only changed ones are embedded
+        self.replace_source(vector_db, path, chunks)
+        return len(chunks)
+
+    # Crawl web pages and sitemaps into a vector db, only new and changed pages are embedded
+    def crawl_urls(self, vector_db: str, urls: list[str]) -> dict:
+        state_file = os.path.join(self.config["vector_db"]["persist_folder"], vector_db, "crawl.json")
+        try:
+            with open(state_file, "r") as f:
+                state = json.load(f)
+        except Exception:
+            state = {}
+
+        # The chunks of a page are replaced, a removed page only loses them
+        def ingest(url: str, text: str) -> None:
+            chunks = self.split_text([Document(page_content=text, metadata={"source": url})], vector_db) if text else []
+            self.replace_source(vector_db, url, chunks)
+
+        try:
+            return self.crawler.run(urls, state, ingest)
+        finally:
+            # Written aside, an interrupted write doesn't lose the previous state
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(state_file), suffix=".tmp", delete=False) as f:
+                json.dump(state, f)
+            os.replace(f.name, state_file)
+
+    # Bind a folder to a vector db, its changed files are re-ingested in the background
+    def watch_folder(self, vector_db: str, folder: str) -> None:
+        folder = os.path.realpath(folder)
+        settings = self.get_vector_db_settings(vector_db)
+        settings["watch"] = list(dict.fromkeys(settings.get("watch", []) + [folder]))
+        self.set_vector_db_settings(vector_db, settings)
+        self.ingester.watch(vector_db, folder)
+
+    # Unbind the folders of a vector db
+    def unwatch_folders(self, vector_db: str) -> None:
+        self.ingester.unwatch(vector_db)
+        settings = self.get_vector_db_settings(vector_db)
+        if settings.pop("watch", None) is not None:
+            self.set_vector_db_settings(vector_db, settings)
+
+    # Resume watching the folders bound to vector dbs
+    def resume_watches(self) -> None:
+        for vector_db in self.get_vector_dbs():
+            for folder in self.get_vector_db_settings(vector_db).get("watch", []):
+                folder = os.path.realpath(folder)
+                if os.path.isdir(folder):
+                    self.ingester.watch(vector_db, folder)
+
+    # Bump the generation of a vector db, so that cached retrievals are dropped
+    def bump_vector_db_generation(self, vector_db: str) -> None:
+        with self.settings_lock:
+            settings = self.get_vector_db_settings(vector_db)
+            settings["generation"] = settings.get("generation", 0) + 1
+            self.set_vector_db_settings(vector_db, settings)
+        self.retrieval_cache.invalidate(vector_db)
+
+    # Get the lexical index of a vector db, reusing open handles
+    def get_lexical_index(self, vector_db: str) -> LexicalIndex:
+        with self.handles_lock:
+            if vector_db not in self.lexical_indexes:
+                full_path = os.path.join(self.config["vector_db"]["persist_folder"], vector_db)
+                self.lexical_indexes[vector_db] = LexicalIndex(full_path)
+            return self.lexical_indexes[vector_db]
+
+    # Check if a query is mostly made of identifiers (error codes, function names, paths...)
+    def is_identifier_heavy(self, query: str) -> bool:
+        words = [word.strip(".,;:!?()[]{}'\"`") for word in query.split()]
+        words = [word for word in words if word]
+        if not words:
+            return False
+        identifiers = [word for word in words if self.IDENTIFIER_PATTERN.match(word)]
+        ratio = self.config.get("retrieval", {}).get("identifier_ratio", 0.3)
+        return len(identifiers) / len(words) >= ratio
+
+    # Retrieve chunks from several vector dbs concurrently, merged by normalised score
+    def retrieve_many(self, vector_db_names: list, query: str, k: int = 4) -> list:
+        if len(vector_db_names) == 1:
+            results = self.retrieve(vector_db_names[0], query, k)
+            for document, _score in results:
+                document.metadata["vector_db"] = vector_db_names[0]
+            return results
+
+        futures = {
+            vector_db_name: self.retrieval_executor.submit(self.api.bind(self.retrieve), vector_db_name, query, k)
+            for vector_db_name in vector_db_names
+        }
+        results = {vector_db_name: future.result() for vector_db_name, future in futures.items()}
+        return self.fuse_results(results, k, self.config.get("retrieval", {}).get("rrf_k", 60))
+
+    # Fuse the ranked results of several vector dbs by reciprocal rank
+    @staticmethod
+    def fuse_results(results: dict, k: int, rrf_k: int = 60) -> list:
+        # Scores of different dbs (and retrieval modes: fused ranks, BM25, cosine relevance) aren't comparable,
+        # only the ranks within each db are
+        fused = []
+        for vector_db_name, ranked in results.items():
+            for rank, (document, _score) in enumerate(ranked):
+                document.metadata["vector_db"] = vector_db_name
+                fused.append((document, 1 / (rrf_k + rank + 1)))
+        fused.sort(key=lambda result: result[1], reverse=True)
+        return fused[:k]
+
+    # Retrieve chunks from a vector db, from the cache if the db didn't change since
+    def retrieve(self, vector_db_name: str, query: str, k: int = 4) -> list:
+        settings = self.get_vector_db_settings(vector_db_name)
+        key = (
+            vector_db_name,
+            settings.get("created", 0),
+            settings.get("generation", 0),
+            RetrievalCache.normalise(query),
+            k,
+            json.dumps(self.config.get("retrieval", {}), sort_keys=True),
         )
+        results = self.retrieval_cache.get(vector_db_name, key)
+        if results is None:
+            results = self.search_vector_db(vector_db_name, query, k)
+            self.retrieval_cache.put(key, results)
+        return list(results)
+
+    # Search a vector db, fusing lexical and vector search
+    def search_vector_db(self, vector_db_name: str, query: str, k: int = 4) -> list:
+        retrieval_config = self.config.get("retrieval", {})
+        retrieval_mode = retrieval_config.get("mode", "hybrid")
+        candidates = max(k, retrieval_config.get("candidates", 20))
+
+        # Vector dbs created before lexical indexes existed only have vectors
+        lexical_results = []
+        if retrieval_mode != "vector":
+            full_path = os.path.join(self.config["vector_db"]["persist_folder"], vector_db_name)
+            if vector_db_name in self.lexical_indexes or os.path.isfile(os.path.join(full_path, "lexical.sqlite")):
+                lexical_results = self.get_lexical_index(vector_db_name).search(query, candidates)
+
+        # Lexical fast path, no embedding call
+        if lexical_results and (retrieval_mode == "lexical" or self.is_identifier_heavy(query)):
+            self.logger.info("Lexical retrieval")
+            return lexical_results[:k]
+
+        vector_db = self.get_vector_store(vector_db_name)
+        vector_results = vector_db.similarity_search_with_relevance_scores(query, k=candidates)
+        if not lexical_results:
+            return vector_results[:k]
+
+        return self.reciprocal_rank_fusion([vector_results, lexical_results], k, retrieval_config.get("rrf_k", 60))
+
+    # Fuse ranked lists of results, a chunk found by several lists adds up its reciprocal ranks
+    @staticmethod
+    def reciprocal_rank_fusion(result_lists: list, k: int, rrf_k: int = 60) -> list:
+        fused = {}
+        for results in result_lists:
+            for rank, (document, _score) in enumerate(results):
+                key = (document.metadata.get("source"), document.metadata.get("start_index"), document.page_content)
+                if key not in fused:
+                    fused[key] = [document, 0]
+                fused[key][1] += 1 / (rrf_k + rank + 1)
+        ranked = sorted(fused.values(), key=lambda item: item[1], reverse=True)
+        return [(document, score) for document, score in ranked[:k]]
 
     # Embed
-    def embed_doc(self, documents: list) -> OpenAIEmbeddings | None | Exception:
+    def embed_doc(self, documents: list) -> ApiEmbeddings | None | Exception:
         embeddings_model = self.config["embeddings"]["model"]
         self.logger.info("Embeddings model: {}".format(embeddings_model))
         try:
-            embeddings = OpenAIEmbeddings(model=embeddings_model)
+            embeddings = self.get_embeddings()
             embeddings.embed_documents([text.page_content for text in documents])
             return embeddings
 
@@ -765,10 +4716,15 @@ class ChatModel:
     def get_vector_db(self) -> str:
         return self.vector_db
 
-    # Get information about the vector db
-    def get_vector_db_info(self) -> dict:
+    # Get the names of the vector dbs in use (by the current session by default)
+    def get_vector_db_names(self, session: Session | None = None) -> list:
+        session = session or self.session
+        return [name for name in session.vector_db.split(",") if name]
+
+    # Get information about a vector db
+    def get_vector_db_info(self, vector_db: str) -> dict:
         persist_folder = self.config["vector_db"]["persist_folder"]
-        full_path = os.path.join(persist_folder, self.vector_db)
+        full_path = os.path.join(persist_folder, vector_db)
         total_size = 0
         for dirpath, dirnames, filenames in os.walk(full_path):
             for f in filenames:
@@ -777,20 +4733,201 @@ class ChatModel:
         total_size = total_size / 1024
         total_size = int(total_size)
         total_size = str(total_size) + "K"
-        return {"name": self.vector_db, "size": total_size}
-
-    # Set vector db
-    def set_vector_db(self, vector_db: str) -> None:
+        vector_db_info = {"name": vector_db, "size": total_size}
+
+        settings = self.get_vector_db_settings(vector_db)
+        vector_db_info["backend"] = settings["backend"]
+        vector_db_info["shards"] = settings.get("shards", 1)
+        vector_db_info["generation"] = settings.get("generation", 0)
+        vector_db_info["retrieval_cache"] = self.retrieval_cache.get_stats(vector_db)
+
+        # Chunks, dimension, sources and index parameters, summed over the shards
+        shard_infos = [self.maintainer.get_info(shard) for shard in self.get_vector_db_shards(vector_db)]
+        vector_db_info.update(shard_infos[0])
+        if len(shard_infos) > 1:
+            for key in ["chunks", "sources", "deleted"]:
+                vector_db_info[key] = sum(info.get(key, 0) for info in shard_infos)
+            vector_db_info["shard_info"] = shard_infos
+        if vector_db_info.get("deleted"):
+            vector_db_info["bloat"] = "{:.1%}".format(vector_db_info["deleted"] / vector_db_info["chunks"])
+
+        return vector_db_info
+
+    # Get the stores of the shards of a vector db
+    def get_vector_db_shards(self, vector_db: str) -> list:
+        vector_store = self.get_vector_store(vector_db)
+        return vector_store.shards if isinstance(vector_store, ShardedVectorStore) else [vector_store]
+
+    # Compact a vector db after deletions, returning the number of chunks dropped (or rebuilt for chroma)
+    def compact_vector_db(self, vector_db: str, parameters: dict | None = None) -> int:
+        count = sum(
+            self.maintainer.compact(shard, parameters) for shard in self.get_vector_db_shards(vector_db)
+        )
+        self.bump_vector_db_generation(vector_db)
+        return count
+
+    # Tune the index parameters of a vector db, chroma indexes are rebuilt with them
+    def tune_vector_db(self, vector_db: str, parameters: dict) -> dict:
+        settings = self.get_vector_db_settings(vector_db)
+        parameters = self.maintainer.parse_parameters(settings["backend"], parameters)
+        if settings["backend"] == "numpy":
+            settings.update(parameters)
+            self.set_vector_db_settings(vector_db, settings)
+            with self.handles_lock:
+                self.vector_stores.pop(vector_db, None)
+        else:
+            settings["hnsw"] = dict(settings.get("hnsw", {}), **parameters)
+            self.set_vector_db_settings(vector_db, settings)
+            self.compact_vector_db(vector_db, parameters)
+        return parameters
+
+    # Vacuum the SQLite files of a vector db, returning the bytes saved
+    def vacuum_vector_db(self, vector_db: str) -> int:
+        with self.handles_lock:
+            lexical_index = self.lexical_indexes.pop(vector_db, None)
+        if lexical_index is not None:
+            lexical_index.connection.close()
+        full_path = os.path.join(self.config["vector_db"]["persist_folder"], vector_db)
+        return self.maintainer.vacuum(full_path)
+
+    # Benchmark the latency and recall of a vector db, shard by shard
+    def benchmark_vector_db(self, vector_db: str) -> list:
+        return [self.maintainer.benchmark(shard) for shard in self.get_vector_db_shards(vector_db)]
+
+    # Set vector db (or several, separated by commas), the other settings are only used when creating it
+    def set_vector_db(
+            self,
+            vector_db: str,
+            backend: str | None = None,
+            quantization: str | None = None,
+            shards: int | None = None,
+    ) -> None:
+        if backend is not None and backend not in self.VECTOR_DB_BACKENDS:
+            raise ValueError("No vector db backend with that name found.")
+        if quantization is not None and quantization not in NumpyVectorStore.QUANTIZATIONS:
+            raise ValueError("No quantization with that name found.")
+        if quantization not in [None, "none"] and (backend or self.config["vector_db"].get("backend", "chroma")) != "numpy":
+            raise ValueError("Quantization needs the numpy backend.")
+        if shards is not None and int(shards) < 1:
+            raise ValueError("A vector db needs at least one shard.")
         self.vector_db = vector_db
+        for vector_db_name in self.get_vector_db_names():
+            self.create_vector_db(vector_db_name, backend, quantization, shards)
+
+    # Create a vector db if it doesn't exist
+    def create_vector_db(self, vector_db: str, backend: str | None, quantization: str | None, shards: int | None) -> None:
         if not os.path.exists(self.config["vector_db"]["persist_folder"]):
             os.mkdir(self.config["vector_db"]["persist_folder"])
         full_path = self.config["vector_db"]["persist_folder"] + "/" + vector_db
         if not os.path.exists(full_path):
             os.mkdir(full_path)
+            self.set_vector_db_settings(vector_db, {
+                "backend": backend or self.config["vector_db"].get("backend", "chroma"),
+                "dtype": self.config["vector_db"].get("dtype", "float32"),
+                "quantization": quantization or self.config["vector_db"].get("quantization", "none"),
+                "pq_subspaces": self.config["vector_db"].get("pq_subspaces", 96),
+                "pq_min_train": self.config["vector_db"].get("pq_min_train", 10000),
+                "rescore_factor": self.config["vector_db"].get("rescore_factor", 4),
+                "keep_full": self.config["vector_db"].get("keep_full", False),
+                "shards": int(shards or self.config["vector_db"].get("shards", 1)),
+                "hnsw": self.maintainer.parse_parameters("chroma", self.config["vector_db"].get("hnsw", {})),
+                "created": time.time(),
+                "generation": 0,
+            })
+            default_profile = self.config.get("chunking", {}).get("default")
+            if default_profile in self.list_chunking_profiles():
+                self.set_chunking_profile(default_profile, vector_db)
+
+    # Get the settings of a vector db
+    def get_vector_db_settings(self, vector_db: str) -> dict:
+        settings_file = os.path.join(self.config["vector_db"]["persist_folder"], vector_db, "neuma.json")
+        try:
+            with open(settings_file, "r") as f:
+                return json.load(f)
+        except Exception:
+            # Vector dbs created before settings existed are chroma dbs
+            return {"backend": "chroma"}
+
+    # Save the settings of a vector db
+    def set_vector_db_settings(self, vector_db: str, settings: dict) -> None:
+        settings_file = os.path.join(self.config["vector_db"]["persist_folder"], vector_db, "neuma.json")
+        # Written aside, a concurrent read never sees a partial file
+        with self.settings_lock:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=os.path.dirname(settings_file), suffix=".tmp", delete=False
+            ) as f:
+                json.dump(settings, f)
+            os.replace(f.name, settings_file)
+
+    # Get the vector store of a vector db, reusing open handles
+    def get_vector_store(self, vector_db: str) -> VectorStore:
+        with self.handles_lock:
+            if vector_db not in self.vector_stores:
+                self.vector_stores[vector_db] = self.open_vector_db(vector_db)
+            return self.vector_stores[vector_db]
+
+    # Open the vector store of a vector db, sharded or not
+    def open_vector_db(self, vector_db: str) -> VectorStore:
+        settings = self.get_vector_db_settings(vector_db)
+        full_path = os.path.join(self.config["vector_db"]["persist_folder"], vector_db)
+        self.logger.info("Opening {} vector db: {}".format(settings["backend"], full_path))
+        shards = settings.get("shards", 1)
+        if shards > 1:
+            vector_store = ShardedVectorStore([
+                self.open_vector_store(full_path, settings, shard) for shard in range(shards)
+            ])
+        else:
+            vector_store = self.open_vector_store(full_path, settings)
+        return vector_store
+
+    # Open the vector store of a vector db (or of one of its shards)
+    def open_vector_store(self, full_path: str, settings: dict, shard: int | None = None) -> VectorStore:
+        if settings["backend"] == "numpy":
+            if shard is not None:
+                full_path = os.path.join(full_path, "shard-{}".format(shard))
+            vector_store = NumpyVectorStore(
+                full_path,
+                self.get_embeddings(),
+                dtype=settings.get("dtype", "float32"),
+                quantization=settings.get("quantization", "none"),
+                pq_subspaces=settings.get("pq_subspaces", 96),
+                pq_min_train=settings.get("pq_min_train", 10000),
+                rescore_factor=settings.get("rescore_factor", 4),
+                keep_full=settings.get("keep_full", True),
+                logger=self.logger,
+            )
+        else:
+            # Chroma is only imported when a chroma db is used
+            from langchain.vectorstores.chroma import Chroma
+            # HNSW parameters only apply when the collection is created (or rebuilt)
+            collection_metadata = {
+                IndexMaintainer.HNSW_PARAMETERS[name]: value for name, value in settings.get("hnsw", {}).items()
+            } or None
+            if shard is not None:
+                vector_store = Chroma(
+                    collection_name="shard-{}".format(shard),
+                    persist_directory=full_path,
+                    embedding_function=self.get_embeddings(),
+                    collection_metadata=collection_metadata,
+                )
+            else:
+                vector_store = Chroma(
+                    persist_directory=full_path,
+                    embedding_function=self.get_embeddings(),
+                    collection_metadata=collection_metadata,
+                )
+        return vector_store
 
     # Trash vector db
     def trash_vector_db(self, vector_db: str) -> bool | Exception:
         persist_folder = self.config["vector_db"]["persist_folder"]
+        self.ingester.unwatch(vector_db)
+        with self.handles_lock:
+            self.vector_stores.pop(vector_db, None)
+            lexical_index = self.lexical_indexes.pop(vector_db, None)
+        self.retrieval_cache.invalidate(vector_db)
+        if lexical_index is not None:
+            lexical_index.connection.close()
         try:
             shutil.rmtree(persist_folder + "/" + vector_db)
         except Exception as e:
@@ -799,23 +4936,6 @@ class ChatModel:
 
         return True
 
-    # Image generation
-    def generate_image(self, prompt: str) -> str | Exception:
-        try:
-            response = self.client.images.generate(
-                model=self.config["images"]["model"],
-                prompt=prompt,
-                size=self.config["images"]["size"],
-                quality=self.config["images"]["quality"],
-                n=1,
-                response_format="b64_json"
-            )
-            image_raw_data = response.data[0].b64_json
-            return image_raw_data
-        except Exception as e:
-            self.logger.exception(e)
-            return e
-
     # Other settings
 
     # Copy to clipboard
@@ -828,20 +4948,166 @@ class ChatModel:
             output = selection
         pyperclip.copy(output)
 
-    # Set temperature
+    # Get temperature
+    def get_temperature(self) -> float:
+        # Same fallback as the requests
+        if self.session.temperature is None:
+            return self.get_persona_temperature(self.session.persona)
+        return self.session.temperature
+
+    # Set temperature, for the current session
     def set_temperature(self, temperature: float) -> bool:
         if float(temperature) < 0 or float(temperature) > 2:
             return Exception("Temperature must be between 0 and 2")
         else:
-            self.config["openai"]["temperature"] = float(temperature)
+            self.session.temperature = float(temperature)
             return True
 
-    # Set max_tokens
+    # Get max_tokens
+    def get_max_tokens(self) -> int:
+        return self.session.max_tokens or self.config["openai"]["max_tokens"]
+
+    # Set max_tokens, for the current session
     def set_max_tokens(self, max_tokens: int) -> bool:
-        self.config["openai"]["max_tokens"] = int(max_tokens)
+        self.session.max_tokens = int(max_tokens)
         return True
 
 
+# AsyncChatModel
+class AsyncChatModel:
+    """Async chat model class, serves many sessions from an event loop, sharing one chat model"""
+
+    def __init__(self, chat_model: ChatModel | None = None, workers: int = 32):
+        self.chat_model = chat_model or ChatModel()
+        # Requests block on the network, they run in threads so that the event loop stays free
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    # Create a session
+    def new_session(self, mode: str = "normal", persona: str = "default", vector_db: str = "") -> Session:
+        return self.chat_model.new_session(mode, persona, vector_db)
+
+    # Generate the response to a prompt in a session
+    async def generate(self, session: Session, user_prompt: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.chat_model.ask, user_prompt, session)
+
+    # Stream the response to a prompt in a session, as text deltas
+    async def stream(self, session: Session, user_prompt: str):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        stopped = threading.Event()  # Set when the consumer stops early
+
+        def produce() -> None:
+            deltas = self.chat_model.ask_stream(user_prompt, session)
+            try:
+                for delta in deltas:
+                    if stopped.is_set():
+                        return
+                    loop.call_soon_threadsafe(queue.put_nowait, delta)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except Exception as e:
+                if not stopped.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                # Closing the generator releases the session lock and the API stream
+                deltas.close()
+
+        self.executor.submit(produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    # Stop the worker threads
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+# CommandRegistry
+class CommandRegistry:
+    """Command registry class, dispatches bare commands with a dict and commands with arguments with a prefix trie"""
+
+    PLUGIN_GROUP = "neuma.commands"
+
+    def __init__(self, logger, context=None):
+        self.logger = logger
+        self.context = context  # Passed to plugin handlers
+        self.exact = {}  # Bare commands
+        self.trie = {}  # Commands with arguments, one node per character
+        self.entries = []  # In help order
+
+    # Register a command, with arguments if it has a usage (optional ones also match the bare command);
+    # the handler is a callable or a "module:function" loaded on first use
+    def register(self, name: str, handler, description: str, usage: str | None = None, optional: bool = False) -> None:
+        entry = {"name": name, "handler": handler, "description": description, "usage": usage}
+        if usage is None or optional:
+            self.exact[name] = entry
+        if usage is not None:
+            node = self.trie
+            for char in name + " ":
+                node = node.setdefault(char, {})
+            node[None] = entry
+        self.entries.append(entry)
+
+    # Register the commands of installed plugins, their modules are only imported when the command is used
+    def load_plugins(self) -> None:
+        try:
+            plugins = importlib.metadata.entry_points(group=self.PLUGIN_GROUP)
+        except Exception as e:
+            self.logger.exception(e)
+            return
+        for plugin in plugins:
+            if any(entry["name"] == plugin.name for entry in self.entries):
+                self.logger.warning("Plugin command {} shadows a command, skipped".format(plugin.name))
+                continue
+            description = "Plugin command ({})".format(plugin.dist.name if plugin.dist else plugin.value)
+            self.register(plugin.name, plugin.value, description, "[arguments]", optional=True)
+            self.logger.info("Plugin command {}: {}".format(plugin.name, plugin.value))
+
+    # Find the handler and the arguments of a command, or None
+    def resolve(self, command: str) -> tuple | None:
+        entry = self.exact.get(command)
+        arguments = ""
+        if entry is None:
+            # Longest registered prefix, the walk is bounded by the longest command name
+            node = self.trie
+            for index, char in enumerate(command):
+                node = node.get(char)
+                if node is None:
+                    break
+                if None in node:
+                    entry = node[None]
+                    arguments = command[index + 1:]
+        if entry is None:
+            return None
+        return self.load(entry), arguments
+
+    # Load the handler of a command
+    def load(self, entry: dict):
+        if isinstance(entry["handler"], str):
+            module_name, _, function_name = entry["handler"].partition(":")
+            function = importlib.import_module(module_name)
+            for attribute in function_name.split("."):
+                function = getattr(function, attribute)
+            entry["handler"] = functools.partial(function, self.context)
+            self.logger.info("Loaded command {} from {}".format(entry["name"], module_name))
+        return entry["handler"]
+
+    # Get the help rows
+    def get_help(self) -> list:
+        return [
+            (entry["name"] if entry["usage"] is None else "{} {}".format(entry["name"], entry["usage"]), entry["description"])
+            for entry in self.entries
+        ]
+
+
 # ChatView
 class ChatView:
     """Chat view class"""
@@ -866,38 +5132,104 @@ class ChatView:
         help_table = Table(box=box.SQUARE)
         help_table.add_column("Command", max_width=20)
         help_table.add_column("Description")
-        help_table.add_row("h", "Display this help section")
-        help_table.add_row("r", "Restart")
-        help_table.add_row("c", "List saved conversations")
-        help_table.add_row("c \\[conversation]", "Open conversation \\[conversation]")
-        help_table.add_row("cc", "Create a new conversation")
-        help_table.add_row(
-            "cs [conversation]", "Save the current conversation as \\[conversation]"
-        )
-        help_table.add_row("ct \\[conversation]", "Trash conversation \\[conversation]")
-        help_table.add_row("cy", "Copy current conversation to clipboard")
-        help_table.add_row("m", "List available modes")
-        help_table.add_row("m \\[mode]", "Switch to mode \\[mode]")
-        help_table.add_row("p", "List available personae")
-        help_table.add_row("p \\[persona]", "Switch to persona \\[persona]")
-        help_table.add_row("vi", "Switch to voice input")
-        help_table.add_row("vo", "Switch on voice output")
-        help_table.add_row("e \\[document]", "Embed \\[path/to/files]")
-        help_table.add_row("d", "List available vector dbs")
-        help_table.add_row("d \\[db]", "Create or switch to vector db \\[db]")
-        help_table.add_row("dt \\[db]", "Trash vector db \\[db]")
-        help_table.add_row("y", "Copy last answer to clipboard")
-        help_table.add_row("t", "Get the current temperature value")
-        help_table.add_row("t \\[temp]", "Set the temperature to \\[temp]")
-        help_table.add_row("mt", "Get the current max_tokens value")
-        help_table.add_row("mt \\[max_tokens]", "Set the max_tokens to \\[max_tokens]")
-        help_table.add_row("g", "List available GPT models")
-        help_table.add_row("g \\[model]", "Set GPT model to [model]")
-        help_table.add_row("lm", "List available microphones")
-        help_table.add_row("cls", "Clear the screen")
-        help_table.add_row("q", "Quit")
+        for command, description in self.chat_controller.commands.get_help():
+            help_table.add_row(escape(command), escape(description))
         self.console.print(help_table)
 
+    def display_rows(self, rows, mode: str, separator: str = ",", writer: RowWriter | None = None) -> int:
+        """Display table or csv rows as they arrive, a page at a time, and write them out"""
+
+        page_rows = self.config.get("output", {}).get("page_rows", 50)
+        display = writer is None or writer.file is not sys.stdout  # Rows written to stdout aren't displayed
+        page = []
+        header = None
+        widths = None
+        first_page = True
+        console, pager = self.console, None
+        count = 0
+
+        status = self.console.status("")
+        status.start()
+        try:
+            for row in rows:
+                status.stop()
+                count += 1
+                if writer is not None:
+                    writer.write(row)
+                if not display:
+                    continue
+                if header is None:
+                    header = row
+                    continue
+                page.append(row)
+                if len(page) < page_rows:
+                    continue
+
+                # Longer answers go through the pager, with the column widths of the first page
+                if widths is None:
+                    widths = [max(len(cells[i]) if i < len(cells) else 0 for cells in [header] + page) for i in range(len(header))]
+                    console, pager = self.open_pager()
+                display = self.render_page(console, header, page, mode, separator, widths, first_page)
+                first_page = False
+                page = []
+
+            if display and header is not None and (page or first_page):
+                self.render_page(console, header, page, mode, separator, widths, first_page)
+        finally:
+            status.stop()
+            if pager is not None:
+                try:
+                    pager.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+                pager.wait()
+            if writer is not None:
+                writer.close()
+        return count
+
+    def open_pager(self) -> tuple:
+        """Open the pager, rows are streamed to it (the console itself if there is none)"""
+
+        command = self.config.get("output", {}).get("pager", "less -RS")
+        if not command or not sys.stdout.isatty():
+            return self.console, None
+        try:
+            pager = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, text=True)
+        except OSError:
+            return self.console, None
+        console = Console(
+            file=pager.stdin,
+            force_terminal=True,
+            color_system=self.console.color_system,
+            width=self.console.width,
+            theme=Theme(self.config["theme"]),
+        )
+        return console, pager
+
+    def render_page(self, console: Console, header: list, rows: list, mode: str, separator: str, widths: list | None, show_header: bool) -> bool:
+        """Render a page of rows, as a table or as separated values, False if the pager was quit"""
+
+        try:
+            self.render_rows(console, header, rows, mode, separator, widths, show_header)
+            return True
+        except (BrokenPipeError, OSError):
+            # The rows are still written out
+            return False
+
+    def render_rows(self, console: Console, header: list, rows: list, mode: str, separator: str, widths: list | None, show_header: bool) -> None:
+        """Render rows, as a table or as separated values"""
+
+        if mode != "table":
+            lines = ([header] if show_header else []) + rows
+            console.print(Padding(RowWriter.format_rows(lines, separator), (0, 2)), style="answer")
+            return
+        table = Table(show_lines=True, show_header=show_header)
+        for i, column in enumerate(header):
+            table.add_column(column, width=widths[i] if widths else None)
+        for cells in rows:
+            table.add_row(*cells)
+        console.print(table)
+
     def display_response(self, response: str) -> None:
         """Display response in chat view or speak it"""
 
@@ -922,12 +5254,17 @@ class ChatController:
         self.chat_view.config = self.chat_model.config
         self.chat_view.chat_controller = self
         self.input_mode = "text"
+        self.export = None  # The file rows of table and csv answers are written to
         self.console = Console(
-            theme=Theme(self.chat_model.config["theme"]),
             record=True,
             color_system="truecolor",
         )
+        self.console.push_theme(Theme(self.chat_model.config["theme"]))
         self.chat_view.console = self.console
+        self.chat_model.images_callback = self.on_images_done
+        self.commands = CommandRegistry(self.logger, self)
+        self.register_commands()
+        self.commands.load_plugins()
 
     # Startup
     def start(self):
@@ -943,11 +5280,30 @@ class ChatController:
         # Create a new conversation
         self.chat_model.new_conversation()
 
+        # Re-ingest the changed files of watched folders in the background
+        self.chat_model.resume_watches()
+
         # Parse command
         while True:
             user_input = self.chat_view.console.input("> ")
+
+            # Apply config changes made since the last command
+            if self.chat_model.config_changed():
+                try:
+                    self.reload()
+                except Exception as e:
+                    self.chat_view.display_message("Error reloading config: {}".format(e), "error")
+
             self.parse_command(user_input)
 
+    # Reload
+    def reload(self) -> None:
+        """Reload config and personae in place"""
+
+        self.chat_model.reload_config()
+        self.console.pop_theme()
+        self.console.push_theme(Theme(self.chat_model.config["theme"]))
+
     # Parse command line arguments
     def parse_command_line_arguments(self, arguments: list) -> None:
         """Parse command line arguments"""
@@ -967,6 +5323,8 @@ class ChatController:
         parser.add_argument("-d", "--db", help="Set vector db")
         parser.add_argument("-t", "--temp", help="Set temperature")
         parser.add_argument("-vo", "--voiceout", help="Enable voice output")
+        parser.add_argument("-o", "--output", help="Write the rows of table and csv answers to a file, - for stdout")
+        parser.add_argument("-f", "--format", choices=["csv", "tsv", "jsonl"], help="Format of the rows written out")
 
         # Parse the command line arguments
         args = parser.parse_args()
@@ -993,7 +5351,23 @@ class ChatController:
 
         # Prompt input
         if args.input:
+            self.chat_model.quick = True
             self.chat_model.new_conversation()
+
+            # Table and csv answers are streamed row by row
+            if self.chat_model.get_mode() in ["table", "csv"]:
+                writer = RowWriter(args.output, args.format, self.chat_model.get_mode()) if args.output else None
+                rows = []
+                self.chat_view.display_rows(
+                    self.collect_rows(self.chat_model.stream_rows(args.input), rows),
+                    self.chat_model.get_mode(),
+                    self.chat_model.find_hashtag(args.input) or ",",
+                    writer,
+                )
+                if args.voiceout:
+                    self.chat_model.speak(self.get_rows_text(rows))
+                sys.exit()
+
             final_message = self.chat_model.generate_final_message(args.input)
             response = self.chat_model.generate_response(final_message)
             print(response)
@@ -1001,6 +5375,66 @@ class ChatController:
                 self.chat_model.speak(response)
             sys.exit()
 
+    # Register the built-in commands, in help order
+    def register_commands(self) -> None:
+        """Register the built-in commands"""
+        commands = self.commands
+        commands.register("h", self.on_help, "Display this help section")
+        commands.register("r", self.on_reload, "Reload config and personae")
+        commands.register("c", self.on_list_conversations, "List saved conversations")
+        commands.register("c", self.on_open_conversation, "Open conversation [conversation]", "[conversation]")
+        commands.register("cc", self.on_new_conversation, "Create a new conversation")
+        commands.register("cs", self.on_save_conversation, "Save the current conversation as [conversation]", "[conversation]")
+        commands.register("ct", self.on_trash_conversation, "Trash conversation [conversation]", "[conversation]")
+        commands.register("cy", self.on_copy_conversation, "Copy current conversation to clipboard")
+        commands.register("b", self.on_list_branches, "List the branches of the conversation")
+        commands.register("bf", self.on_fork_conversation, "Fork the conversation into [branch], keeping its first [turn] turns", "[branch] [turn]")
+        commands.register("bc", self.on_checkout_branch, "Switch to branch [branch]", "[branch]")
+        commands.register("m", self.on_list_modes, "List available modes")
+        commands.register("m", self.on_set_mode, "Switch to mode [mode]", "[mode]")
+        commands.register("p", self.on_list_personae, "List available personae")
+        commands.register("p", self.on_set_persona, "Switch to persona [persona]", "[persona]")
+        commands.register("vi", self.on_voice_input, "Switch to voice input")
+        commands.register("vo", self.on_voice_output, "Switch on voice output")
+        commands.register("vc", self.on_voice_cache_stats, "Display voice output cache stats")
+        commands.register("e", self.on_embed, "Embed [path/to/files], or crawl [url] or [sitemap.xml] (several separated by spaces)", "[document]")
+        commands.register("d", self.on_list_vector_dbs, "List available vector dbs")
+        commands.register(
+            "d", self.on_set_vector_db,
+            "Create or switch to vector db [db], created with [backend] (chroma or numpy), "
+            "[quant] (none, int8 or pq) and split into [shards]; [db1,db2] uses several vector dbs at once",
+            "[db] [backend] [quant] [shards]",
+        )
+        commands.register("di", self.on_vector_db_info, "Display info about the current vector db")
+        commands.register("dk", self.on_compact_vector_db, "Compact the current vector db after deletions")
+        commands.register("dv", self.on_vacuum_vector_db, "Vacuum the SQLite files of the current vector db")
+        commands.register("dh", self.on_tune_vector_db, "Tune the index of the current vector db", "[param=value]")
+        commands.register("dp", self.on_benchmark_vector_db, "Benchmark the latency and recall of the current vector db")
+        commands.register("dt", self.on_trash_vector_db, "Trash vector db [db]", "[db]")
+        commands.register("dw", self.on_watch_folder, "Watch [path/to/files] and re-ingest changed files", "[path]")
+        commands.register("dw", self.on_watch_stats, "Display watched folders, queue depth and lag")
+        commands.register("dwx", self.on_unwatch_folders, "Stop watching folders")
+        commands.register("ec", self.on_embedding_cache_stats, "Display embedding cache stats")
+        commands.register("fs", self.on_compaction_stats, "Display file and web page compaction stats")
+        commands.register("dc", self.on_list_chunking_profiles, "List chunking profiles")
+        commands.register("dc", self.on_set_chunking_profile, "Set the chunking profile of the current vector db", "[profile]")
+        commands.register("dr", self.on_compare_chunking_profiles, "Compare chunking profiles on [path/to/files]", "[path]")
+        commands.register("y", self.on_copy_answer, "Copy last answer to clipboard")
+        commands.register("o", self.on_get_export, "Get the file rows of table and csv answers are written to")
+        commands.register("o", self.on_set_export, "Write the rows of table and csv answers to [file] (.csv, .tsv or .jsonl)", "[file]")
+        commands.register("ox", self.on_stop_export, "Stop writing rows to a file")
+        commands.register("t", self.on_get_temperature, "Get the current temperature value")
+        commands.register("t", self.on_set_temperature, "Set the temperature to [temp]", "[temp]")
+        commands.register("mt", self.on_get_max_tokens, "Get the current max_tokens value")
+        commands.register("mt", self.on_set_max_tokens, "Set the max_tokens to [max_tokens]", "[max_tokens]")
+        commands.register("g", self.on_list_models, "List available GPT models")
+        commands.register("g", self.on_set_model, "Set GPT model to [model]", "[model]")
+        commands.register("hs", self.on_hedging_stats, "Display hedging stats")
+        commands.register("u", self.on_usage, "Display the usage of this day and month against the budgets")
+        commands.register("lm", self.on_list_microphones, "List available microphones")
+        commands.register("cls", self.on_clear_screen, "Clear the screen")
+        commands.register("q", self.on_quit, "Quit")
+
     # Parse command
     def parse_command(self, command: str) -> None:
         """Parse the user input and execute the command"""
@@ -1009,467 +5443,808 @@ class ChatController:
         if command == "":
             return
 
-        # System
+        # Find the command, anything else is a prompt
+        try:
+            resolved = self.commands.resolve(command)
+        except Exception as e:
+            self.chat_view.display_message("Error loading command: {}".format(e), "error")
+            return
+        if resolved is None:
+            self.on_prompt(command)
+            return
 
-        # Exit
-        if command == "q":
-            self.exit_app()
+        handler, arguments = resolved
+        handler(arguments)
 
-        # Restart
-        elif command == "r":
-            self.chat_view.display_message("Restarting...", "success")
-            sleep(1)
-            try:
-                os.execl(sys.executable, sys.executable, __file__)
-            except Exception as e:
-                self.chat_view.display_message("Error: {}".format(e), "error")
-                sys.exit()
+    # System
 
-        # Help
-        elif command == "h":
-            self.chat_view.display_help()
+    # Exit
+    def on_quit(self, arguments: str) -> None:
+        self.exit_app()
 
-        # Clear screen
-        elif command == "cls":
-            self.chat_view.clear_screen()
+    # Reload
+    def on_reload(self, arguments: str) -> None:
+        start_time = time.time()
+        try:
+            self.reload()
+            self.chat_view.display_message(
+                "Reloaded in {:.0f}ms.".format((time.time() - start_time) * 1000),
+                "success",
+            )
+        except Exception as e:
+            self.chat_view.display_message("Error reloading: {}".format(e), "error")
 
-        # Copy answer to clipboard
-        elif command == "y":
-            # log conversation
-            if len(self.chat_model.conversation) > 0:
-                last_message = self.chat_model.conversation[-1].get("content")
-                self.logger.info("Last message: {}".format(last_message))
-                self.chat_model.copy_to_clipboard(last_message)
-                self.chat_view.display_message(
-                    "Copied last answer to clipboard.", "success"
-                )
-            else:
-                self.chat_view.display_message("Nothing to copy to clipboard.", "error")
+    # Help
+    def on_help(self, arguments: str) -> None:
+        self.chat_view.display_help()
+
+    # Clear screen
+    def on_clear_screen(self, arguments: str) -> None:
+        self.chat_view.clear_screen()
 
-        # Get temperature
-        elif command == "t":
+    # Copy answer to clipboard
+    def on_copy_answer(self, arguments: str) -> None:
+        # log conversation
+        if len(self.chat_model.conversation) > 0:
+            last_message = self.chat_model.conversation[-1].get("content")
+            self.logger.info("Last message: {}".format(last_message))
+            self.chat_model.copy_to_clipboard(last_message)
             self.chat_view.display_message(
-                "Temperature: {}".format(
-                    self.chat_model.config["openai"]["temperature"]
-                ),
-                "info",
+                "Copied last answer to clipboard.", "success"
             )
+        else:
+            self.chat_view.display_message("Nothing to copy to clipboard.", "error")
+
+    # Get temperature
+    def on_get_temperature(self, arguments: str) -> None:
+        self.chat_view.display_message(
+            "Temperature: {}".format(
+                self.chat_model.get_temperature()
+            ),
+            "info",
+        )
 
-        # Set temperature
-        elif command.startswith("t "):
-            temp = command[2:]
-            set_temp = self.chat_model.set_temperature(temp)
-            if isinstance(set_temp, Exception):
-                self.chat_view.display_message(
-                    "Error setting temperature: {}".format(set_temp), "error"
-                )
-            else:
-                self.chat_view.display_message(
-                    "temperature set to {}.".format(temp), "success"
-                )
+    # Set temperature
+    def on_set_temperature(self, arguments: str) -> None:
+        temp = arguments
+        set_temp = self.chat_model.set_temperature(temp)
+        if isinstance(set_temp, Exception):
+            self.chat_view.display_message(
+                "Error setting temperature: {}".format(set_temp), "error"
+            )
+        else:
+            self.chat_view.display_message(
+                "temperature set to {}.".format(temp), "success"
+            )
+
+    # Get max tokens
+    def on_get_max_tokens(self, arguments: str) -> None:
+        self.chat_view.display_message(
+            "max_tokens: {}".format(self.chat_model.get_max_tokens()),
+            "info",
+        )
 
-        # Get max tokens
-        elif command == "mt":
+    # Set max tokens
+    def on_set_max_tokens(self, arguments: str) -> None:
+        max_tokens = arguments
+        set_max_tokens = self.chat_model.set_max_tokens(max_tokens)
+        if isinstance(set_max_tokens, Exception):
             self.chat_view.display_message(
-                "max_tokens: {}".format(self.chat_model.config["openai"]["max_tokens"]),
-                "info",
+                "Error setting max tokens: {}".format(set_max_tokens), "error"
+            )
+        else:
+            self.chat_view.display_message(
+                "max_tokens set to {}.".format(max_tokens), "success"
             )
 
-        # Set max tokens
-        elif command.startswith("mt "):
-            max_tokens = command[2:]
-            set_max_tokens = self.chat_model.set_max_tokens(max_tokens)
-            if isinstance(set_max_tokens, Exception):
-                self.chat_view.display_message(
-                    "Error setting max tokens: {}".format(set_max_tokens), "error"
-                )
+    # List GPT models
+    def on_list_models(self, arguments: str) -> None:
+        models = self.chat_model.list_models()
+        self.chat_view.display_message("GPT Models", "section")
+        current_model = self.chat_model.get_model()
+        for model in models:
+            if model == current_model:
+                self.chat_view.display_message(model + " <", "info")
             else:
-                self.chat_view.display_message(
-                    "max_tokens set to {}.".format(max_tokens), "success"
-                )
+                self.chat_view.display_message(model, "info")
 
-        # List GPT models
-        elif command == "g":
-            models = self.chat_model.list_models()
-            self.chat_view.display_message("GPT Models", "section")
-            current_model = self.chat_model.get_model()
-            for model in models:
-                if model == current_model:
-                    self.chat_view.display_message(model + " <", "info")
-                else:
-                    self.chat_view.display_message(model, "info")
+    # Set GPT model
+    def on_set_model(self, arguments: str) -> None:
+        model = arguments.split(" ")[0]
+        self.chat_model.set_model(model)
+        self.chat_view.display_message("Model set to {}.".format(model), "success")
+
+    # Get hedging stats
+    def on_hedging_stats(self, arguments: str) -> None:
+        hedging_stats = self.chat_model.hedger.get_stats()
+        self.chat_view.display_message("Hedging stats", "section")
+        for key, value in hedging_stats.items():
+            self.chat_view.display_message("{}: {}".format(key, value), "info")
+
+    # Get usage and budgets
+    def on_usage(self, arguments: str) -> None:
+        report = self.chat_model.ledger.get_report()
+        self.chat_view.display_message("Usage", "section")
+        for period, spent in report["budgets"].items():
+            self.chat_view.display_message("{}: {}".format(period, spent), "info")
+        usage_table = Table(box=box.SQUARE)
+        for column in ["This month by", "", "Prompt tokens", "Completion tokens", "Cost", "Calls"]:
+            usage_table.add_column(column)
+        for dimension, rows in report["breakdown"].items():
+            for row in rows:
+                usage_table.add_row(
+                    dimension, row["name"] or "-", str(row["prompt_tokens"]), str(row["completion_tokens"]),
+                    "{:.4f}".format(row["cost"]), str(row["calls"]),
+                )
+        self.console.print(usage_table)
 
-        # Set GPT model
-        elif command.startswith("g "):
-            model = command.split(" ")[1]
-            self.chat_model.set_model(model)
-            self.chat_view.display_message("Model set to {}.".format(model), "success")
+    # Conversations
 
-        # Conversations
+    # List conversations
+    def on_list_conversations(self, arguments: str) -> None:
+        conversations_list = self.chat_model.list_conversations()
+        if isinstance(conversations_list, Exception):
+            self.chat_view.display_message(
+                "Error listing conversation: {}".format(conversations_list), "error"
+            )
+        else:
+            # if there is at least one conversation
+            if len(conversations_list) > 0:
+                self.chat_view.display_message("Conversations", "section")
+                for conversation in conversations_list:
+                    self.chat_view.display_message(conversation, "info")
+
+    # Create conversation
+    def on_new_conversation(self, arguments: str) -> None:
+        self.chat_model.new_conversation()
+        self.chat_view.mode = "normal"
+        self.chat_view.display_message("New conversation.", "success")
+        sleep(1)
+        self.chat_view.clear_screen()
 
-        # List conversations
-        elif command == "c":
-            conversations_list = self.chat_model.list_conversations()
-            if isinstance(conversations_list, Exception):
-                self.chat_view.display_message(
-                    "Error listing conversation: {}".format(conversations_list), "error"
-                )
-            else:
-                # if there is at least one conversation
-                if len(conversations_list) > 0:
-                    self.chat_view.display_message("Conversations", "section")
-                    for conversation in conversations_list:
-                        self.chat_view.display_message(conversation, "info")
-
-        # Create conversation
-        elif command == "cc":
-            self.chat_model.new_conversation()
-            self.chat_view.mode = "normal"
-            self.chat_view.display_message("New conversation.", "success")
-            sleep(1)
-            self.chat_view.clear_screen()
+    # List branches
+    def on_list_branches(self, arguments: str) -> None:
+        self.chat_view.display_message("Branches", "section")
+        current_branch = self.chat_model.conversation.branch
+        for branch, branch_info in self.chat_model.list_branches().items():
+            line = "{} ({} turns, {} shared)".format(branch, branch_info["turns"], branch_info["shared"])
+            if branch == current_branch:
+                line += " <"
+            self.chat_view.display_message(line, "info")
+
+    # Fork conversation
+    def on_fork_conversation(self, arguments: str) -> None:
+        arguments = arguments.split(" ")
+        try:
+            turn = int(arguments[1]) if len(arguments) > 1 else None
+            self.chat_model.fork_conversation(arguments[0], turn)
+            self.chat_view.display_message("Forked to branch {}.".format(arguments[0]), "success")
+        except Exception as e:
+            self.chat_view.display_message(
+                "Error forking conversation: {}".format(e), "error"
+            )
 
-        # Save conversation
-        elif command.startswith("cs "):
-            filename = command.split(" ")[-1]
-            save = self.chat_model.save_conversation(filename)
-            if isinstance(save, Exception):
-                self.chat_view.display_message(
-                    "Error saving conversation: {}".format(save), "error"
-                )
-            else:
-                self.chat_view.display_message("Conversation saved.", "success")
-
-        # Open conversation
-        elif command.startswith("c "):
-            filename = command.split(" ")[-1]
-            if filename == "":
-                self.chat_view.display_message("Please specify a filename.", "error")
-            open_conversation = self.chat_model.open_conversation(filename)
-            if isinstance(open_conversation, Exception):
-                self.chat_view.display_message(
-                    "Error opening conversation: {}".format(open_conversation), "error"
-                )
-            else:
-                self.chat_view.display_message("Conversation opened.", "success")
-                sleep(1)
-                self.chat_view.clear_screen()
-                self.chat_view.display_message(self.chat_model.conversation, "answer")
-
-        # Trash conversation
-        elif command.startswith("ct "):
-            filename = command.split(" ")[-1]
-            trash_conversation = self.chat_model.trash_conversation(filename)
-            if isinstance(trash_conversation, Exception):
-                self.chat_view.display_message(
-                    "Error trashing conversation: {}".format(trash_conversation),
-                    "error",
-                )
-            else:
-                self.chat_view.display_message("Conversation trashed.", "success")
+    # Checkout branch
+    def on_checkout_branch(self, arguments: str) -> None:
+        branch = arguments.split(" ")[0]
+        try:
+            self.chat_model.checkout_conversation(branch)
+            self.chat_view.display_message("Switched to branch {}.".format(branch), "success")
+        except Exception as e:
+            self.chat_view.display_message(
+                "Error switching branch: {}".format(e), "error"
+            )
 
-        # Copy conversation to clipboard
-        elif command == "cy":
-            self.chat_model.copy_to_clipboard(self.chat_model.conversation)
+    # Save conversation
+    def on_save_conversation(self, arguments: str) -> None:
+        filename = arguments.split(" ")[-1]
+        save = self.chat_model.save_conversation(filename)
+        if isinstance(save, Exception):
             self.chat_view.display_message(
-                "Copied conversation to clipboard.", "success"
+                "Error saving conversation: {}".format(save), "error"
             )
+        else:
+            self.chat_view.display_message("Conversation saved.", "success")
 
-        # Modes
+    # Open conversation
+    def on_open_conversation(self, arguments: str) -> None:
+        filename = arguments.split(" ")[-1]
+        if filename == "":
+            self.chat_view.display_message("Please specify a filename.", "error")
+        open_conversation = self.chat_model.open_conversation(filename)
+        if isinstance(open_conversation, Exception):
+            self.chat_view.display_message(
+                "Error opening conversation: {}".format(open_conversation), "error"
+            )
+        else:
+            self.chat_view.display_message("Conversation opened.", "success")
+            sleep(1)
+            self.chat_view.clear_screen()
+            self.chat_view.display_message(self.chat_model.conversation, "answer")
 
-        # List modes
-        elif command == "m":
-            modes = self.chat_model.list_modes()
-            self.chat_view.display_message("Modes", "section")
-            current_mode = self.chat_model.get_mode()
-            for mode in modes:
-                if mode == current_mode:
-                    self.chat_view.display_message(mode + " <", "info")
-                else:
-                    self.chat_view.display_message(mode, "info")
+    # Trash conversation
+    def on_trash_conversation(self, arguments: str) -> None:
+        filename = arguments.split(" ")[-1]
+        trash_conversation = self.chat_model.trash_conversation(filename)
+        if isinstance(trash_conversation, Exception):
+            self.chat_view.display_message(
+                "Error trashing conversation: {}".format(trash_conversation),
+                "error",
+            )
+        else:
+            self.chat_view.display_message("Conversation trashed.", "success")
 
-        # Set mode
-        elif command.startswith("m "):
-            mode = command.split(" ")[1]
-            try:
-                set_mode = self.chat_model.set_mode(mode)
-                self.chat_view.display_message(
-                    "Mode set to {}.".format(mode), "success"
-                )
-            except Exception as e:
-                self.chat_view.display_message(
-                    "Error setting mode: {}".format(e), "error"
-                )
+    # Copy conversation to clipboard
+    def on_copy_conversation(self, arguments: str) -> None:
+        self.chat_model.copy_to_clipboard(self.chat_model.conversation.get_messages())
+        self.chat_view.display_message(
+            "Copied conversation to clipboard.", "success"
+        )
 
-        # Personae
+    # Modes
 
-        # List Personae
-        elif command == "p":
-            personae = self.chat_model.list_personae()
-            self.chat_view.display_message("Personae", "section")
-            current_persona = self.chat_model.get_persona()
+    # List modes
+    def on_list_modes(self, arguments: str) -> None:
+        modes = self.chat_model.list_modes()
+        self.chat_view.display_message("Modes", "section")
+        current_mode = self.chat_model.get_mode()
+        for mode in modes:
+            if mode == current_mode:
+                self.chat_view.display_message(mode + " <", "info")
+            else:
+                self.chat_view.display_message(mode, "info")
 
-            for persona in personae["persona"]:
-                if persona["name"] == current_persona:
-                    self.chat_view.display_message(persona["name"] + " <", "info")
-                else:
-                    self.chat_view.display_message(persona["name"], "info")
+    # Set mode
+    def on_set_mode(self, arguments: str) -> None:
+        mode = arguments.split(" ")[0]
+        try:
+            self.chat_model.set_mode(mode)
+            self.chat_view.display_message(
+                "Mode set to {}.".format(mode), "success"
+            )
+        except Exception as e:
+            self.chat_view.display_message(
+                "Error setting mode: {}".format(e), "error"
+            )
 
-        # Set persona
-        elif command.startswith("p "):
-            persona = command.split(" ")[1]
-            try:
-                set_persona = self.chat_model.set_persona(persona)
-                self.chat_view.display_message(
-                    "Persona set to {}.".format(persona), "success"
-                )
-                self.chat_model.new_conversation()
-                sleep(1)
-                self.chat_view.clear_screen()
-            except Exception as e:
-                self.chat_view.display_message(
-                    "Error setting persona: {}".format(e), "error"
-                )
+    # Personae
 
-        # Languages / Voice
+    # List Personae
+    def on_list_personae(self, arguments: str) -> None:
+        personae = self.chat_model.list_personae()
+        self.chat_view.display_message("Personae", "section")
+        current_persona = self.chat_model.get_persona()
 
-        # Voice input
-        elif command == "vi":
-            # Toggle input mode
-            if self.input_mode == "text":
-                self.input_mode = "voice"
-                self.chat_view.display_message("Voice input mode enabled. ", "success")
-                self.chat_view.display_message("(Say [bold]Disable voice input[/bold] to disable.)", "info")
-                self.logger.info("Voice input mode enabled. Disable by saying 'Disable voice input'.")
+        for persona in personae["persona"]:
+            if persona["name"] == current_persona:
+                self.chat_view.display_message(persona["name"] + " <", "info")
+            else:
+                self.chat_view.display_message(persona["name"], "info")
 
-                # while in voice input mode
-                while self.input_mode == "voice":
-                    # Start spinner
-                    with self.chat_view.console.status(""):
-                        # Listen for voice input
-                        self.voice_input = self.chat_model.listen()
+    # Set persona
+    def on_set_persona(self, arguments: str) -> None:
+        persona = arguments.split(" ")[0]
+        try:
+            self.chat_model.set_persona(persona)
+            self.chat_view.display_message(
+                "Persona set to {}.".format(persona), "success"
+            )
+            self.chat_model.new_conversation()
+            sleep(1)
+            self.chat_view.clear_screen()
+        except Exception as e:
+            self.chat_view.display_message(
+                "Error setting persona: {}".format(e), "error"
+            )
 
-                    # Stop spinner
-                    self.chat_view.console.status("").stop()
+    # Languages / Voice
 
-                    if isinstance(self.voice_input, Exception):
+    # Voice input
+    def on_voice_input(self, arguments: str) -> None:
+        # Toggle input mode
+        if self.input_mode == "text":
+            self.input_mode = "voice"
+            self.chat_view.display_message("Voice input mode enabled. ", "success")
+            self.chat_view.display_message("(Say [bold]Disable voice input[/bold] to disable.)", "info")
+            self.logger.info("Voice input mode enabled. Disable by saying 'Disable voice input'.")
+
+            # while in voice input mode
+            while self.input_mode == "voice":
+                # Start spinner
+                with self.chat_view.console.status(""):
+                    # Listen for voice input
+                    self.voice_input = self.chat_model.listen()
+
+                # Stop spinner
+                self.chat_view.console.status("").stop()
+
+                if isinstance(self.voice_input, Exception):
+                    self.chat_view.display_message(
+                        "Error with voice input: {}".format(self.voice_input),
+                        "error",
+                    )
+                else:
+                    # Display voice input
+                    self.chat_view.display_message(self.voice_input, "prompt")
+                    # if self.voice_input == "Disable voice input.":
+                    if (
+                            "disable" in self.voice_input.lower() and "voice" in self.voice_input.lower() and "input" in self.voice_input.lower()
+                    ):
+                        self.input_mode = "text"
+                        self.chat_model.set_voice_output(False)
                         self.chat_view.display_message(
-                            "Error with voice input: {}".format(self.voice_input),
-                            "error",
+                            "Voice input mode disabled.", "success"
                         )
                     else:
-                        # Display voice input
-                        self.chat_view.display_message(self.voice_input, "prompt")
-                        # if self.voice_input == "Disable voice input.":
-                        if (
-                                "disable" in self.voice_input.lower() and "voice" in self.voice_input.lower() and "input" in self.voice_input.lower()
-                        ):
-                            self.input_mode = "text"
-                            self.chat_model.set_voice_output(False)
-                            self.chat_view.display_message(
-                                "Voice input mode disabled.", "success"
+                        self.logger.info("Processing voice input...")
+
+                        # Start spinner
+                        with self.chat_view.console.status(""):
+                            # Generate final prompt
+                            final_message = self.chat_model.generate_final_message(
+                                self.voice_input
                             )
-                        else:
-                            self.logger.info("Processing voice input...")
 
-                            # Start spinner
-                            with self.chat_view.console.status(""):
-                                # Generate final prompt
-                                final_message = self.chat_model.generate_final_message(
-                                    self.voice_input
-                                )
+                            # Generate response
+                            response = self.chat_model.generate_response(
+                                final_message
+                            )
 
-                                # Generate response
-                                response = self.chat_model.generate_response(
-                                    final_message
-                                )
+                        # Stop spinner
+                        self.chat_view.console.status("").stop()
 
-                            # Stop spinner
-                            self.chat_view.console.status("").stop()
+                        # Display response
+                        self.chat_view.display_response(response)
 
-                            # Display response
-                            self.chat_view.display_response(response)
+        else:
+            self.input_mode = "text"
+            self.chat_view.display_message("Voice input mode disabled.", "success")
 
-            else:
-                self.input_mode = "text"
-                self.chat_view.display_message("Voice input mode disabled.", "success")
-
-        # Voice output
-        elif command == "vo":
-            self.chat_model.set_voice_output(not self.chat_model.get_voice_output())
-            if self.chat_model.get_voice_output():
-                self.chat_view.display_message("Voice output enabled.", "success")
-            else:
-                self.chat_view.display_message("Voice output disabled.", "success")
+    # Voice output
+    def on_voice_output(self, arguments: str) -> None:
+        self.chat_model.set_voice_output(not self.chat_model.get_voice_output())
+        if self.chat_model.get_voice_output():
+            self.chat_view.display_message("Voice output enabled.", "success")
+        else:
+            self.chat_view.display_message("Voice output disabled.", "success")
 
-        # List microphones
-        elif command.startswith("lm"):
-            self.chat_view.display_message("Available input devices", "section")
-            if len(speech_recognition.Microphone.list_microphone_names()) == 0:
-                self.chat_view.display_message("No input devices found.", "info")
-            else:
-                current_microphone = self.chat_model.config["audio"]["input_device"]
-                for index, name in enumerate(
-                        speech_recognition.Microphone.list_microphone_names()
-                ):
-                    if index == current_microphone:
-                        self.chat_view.display_message(
-                            '{0} : {1} <'.format(index, name), "info"
-                        )
-                    else:
-                        self.chat_view.display_message(
-                            '{0} : {1}'.format(index, name), "info"
-                        )
+    # List microphones
+    def on_list_microphones(self, arguments: str) -> None:
+        import speech_recognition  # Audio is only loaded when used
+
+        self.chat_view.display_message("Available input devices", "section")
+        if len(speech_recognition.Microphone.list_microphone_names()) == 0:
+            self.chat_view.display_message("No input devices found.", "info")
+        else:
+            current_microphone = self.chat_model.config["audio"]["input_device"]
+            for index, name in enumerate(
+                    speech_recognition.Microphone.list_microphone_names()
+            ):
+                if index == current_microphone:
+                    self.chat_view.display_message(
+                        '{0} : {1} <'.format(index, name), "info"
+                    )
+                else:
+                    self.chat_view.display_message(
+                        '{0} : {1}'.format(index, name), "info"
+                    )
 
-        # Documents
+    # Get voice output cache stats
+    def on_voice_cache_stats(self, arguments: str) -> None:
+        speech_cache_stats = self.chat_model.speech_cache.get_stats()
+        self.chat_view.display_message("Voice cache stats: {}".format(speech_cache_stats), "info")
 
-        # List vector dbs
-        elif command == "d":
-            vector_dbs = self.chat_model.get_vector_dbs()
-            self.chat_view.display_message("Vector stores", "section")
-            if len(vector_dbs) == 0:
-                self.chat_view.display_message("No vector stores found.", "info")
-            else:
-                current_vector_db = self.chat_model.get_vector_db()
-                for vector_db in vector_dbs:
-                    if vector_db == current_vector_db:
-                        self.chat_view.display_message(vector_db + " <", "info")
-                    else:
-                        self.chat_view.display_message(vector_db, "info")
+    # Documents
 
-        # Create or use vector db
-        elif command.startswith("d "):
-            vector_db = command.split(" ")[1]
-            self.chat_model.set_vector_db(vector_db)
+    # List vector dbs
+    def on_list_vector_dbs(self, arguments: str) -> None:
+        vector_dbs = self.chat_model.get_vector_dbs()
+        self.chat_view.display_message("Vector stores", "section")
+        if len(vector_dbs) == 0:
+            self.chat_view.display_message("No vector stores found.", "info")
+        else:
+            current_vector_dbs = self.chat_model.get_vector_db_names()
+            for vector_db in vector_dbs:
+                if vector_db in current_vector_dbs:
+                    self.chat_view.display_message(vector_db + " <", "info")
+                else:
+                    self.chat_view.display_message(vector_db, "info")
+
+    # Create or use vector db
+    def on_set_vector_db(self, arguments: str) -> None:
+        arguments = arguments.split(" ")
+        vector_db = arguments[0]
+        backend = arguments[1] if len(arguments) > 1 else None
+        quantization = arguments[2] if len(arguments) > 2 else None
+        shards = arguments[3] if len(arguments) > 3 else None
+        try:
+            self.chat_model.set_vector_db(vector_db, backend, quantization, shards)
             self.chat_view.display_message(
                 "Vector store set to {}.".format(vector_db), "success"
             )
-
-        # Get info about vector db
-        elif command == "di":
-            vector_db_info = self.chat_model.get_vector_db_info()
-            self.chat_view.display_message("Vector db info: {}".format(vector_db_info), "info")
-
-        # Trash vector db
-        elif command.startswith("dt "):
-            vector_db = command.split(" ")[1]
+        except Exception as e:
             self.chat_view.display_message(
-                "Trash vector db: {}? (y/n)".format(vector_db), "warning"
+                "Error setting vector store: {}".format(e), "error"
             )
-            confirm = input("  ")
-            if confirm.lower() != "y":
-                return
-            trash_vector_db = self.chat_model.trash_vector_db(vector_db)
-            if isinstance(trash_vector_db, Exception):
-                self.chat_view.display_message(
-                    "Error trashing vector db: {}".format(trash_vector_db),
-                    "error",
-                )
-            else:
-                self.chat_view.display_message("Vector db {} trashed.".format(vector_db), "success")
 
-        # Embed document
-        elif command.startswith("e "):
-            path = command.split(" ")[1]
+    # Get info about vector db
+    def on_vector_db_info(self, arguments: str) -> None:
+        for vector_db in self.chat_model.get_vector_db_names():
+            vector_db_info = self.chat_model.get_vector_db_info(vector_db)
+            self.chat_view.display_message("Vector db info: {}".format(vector_db_info), "info")
 
+    # Compact vector db
+    def on_compact_vector_db(self, arguments: str) -> None:
+        for vector_db in self.chat_model.get_vector_db_names():
             with self.chat_view.console.status(""):
-
-                # If there is no vector db set, return an error
-                if self.chat_model.get_vector_db() == "":
+                try:
+                    count = self.chat_model.compact_vector_db(vector_db)
                     self.chat_view.display_message(
-                        "Please create or use a vector store first.", "error"
+                        "Vector db {} compacted ({} chunks).".format(vector_db, count), "success"
                     )
-                    return
-
-                # If there is no path specified, return an error
-                if path == "":
-                    self.chat_view.display_message("Please specify a path.", "error")
-                    return
-
-                # If path points to a folder that doesn't exist, return an error
-                if not os.path.exists(path):
+                except Exception as e:
                     self.chat_view.display_message(
-                        "Path not found: {}".format(path), "error"
+                        "Error compacting vector db: {}".format(e), "error"
                     )
-                    return
 
-                # Load document
-                try:
-                    documents = self.chat_model.load_documents(path)
-                    num_docs = len(documents)
+    # Vacuum vector db
+    def on_vacuum_vector_db(self, arguments: str) -> None:
+        for vector_db in self.chat_model.get_vector_db_names():
+            try:
+                saved = self.chat_model.vacuum_vector_db(vector_db)
+                self.chat_view.display_message(
+                    "Vector db {} vacuumed ({}K saved).".format(vector_db, saved // 1024), "success"
+                )
+            except Exception as e:
+                self.chat_view.display_message(
+                    "Error vacuuming vector db: {}".format(e), "error"
+                )
 
+    # Tune index parameters
+    def on_tune_vector_db(self, arguments: str) -> None:
+        try:
+            parameters = dict(argument.split("=", 1) for argument in arguments.split(" ") if argument)
+        except ValueError:
+            self.chat_view.display_message("Please use parameter=value.", "error")
+            return
+        for vector_db in self.chat_model.get_vector_db_names():
+            with self.chat_view.console.status(""):
+                try:
+                    parameters = self.chat_model.tune_vector_db(vector_db, parameters)
                     self.chat_view.display_message(
-                        "Loaded {} documents from: {}. ".format(num_docs, path),
-                        "success"
+                        "Vector db {} index set to {}.".format(vector_db, parameters), "success"
                     )
-                    # list all documents
-                    for doc in documents:
-                        filename = doc.metadata["source"].replace(path, "").replace("/", "")
-                        self.chat_view.display_message(
-                            filename,
-                            "info"
-                        )
-
-                    self.logger.info("Loaded documents in: {}".format(path))
                 except Exception as e:
                     self.chat_view.display_message(
-                        "Error loading documents: {}".format(e), "error"
+                        "Error tuning vector db: {}".format(e), "error"
                     )
 
-                # Split text
+    # Benchmark vector db
+    def on_benchmark_vector_db(self, arguments: str) -> None:
+        for vector_db in self.chat_model.get_vector_db_names():
+            with self.chat_view.console.status(""):
                 try:
-                    chunks = self.chat_model.split_text(documents)
-                    self.chat_view.display_message(
-                        "Documents split into {} chunks.".format(len(chunks)), "success"
-                    )
-                    self.logger.info(
-                        "Documents split into {} chunks.".format(len(chunks))
-                    )
+                    benchmark = self.chat_model.benchmark_vector_db(vector_db)
+                    self.chat_view.display_message("Benchmark: {}: {}".format(vector_db, benchmark), "info")
                 except Exception as e:
                     self.chat_view.display_message(
-                        "Error splitting text: {}".format(e), "error"
+                        "Error benchmarking vector db: {}".format(e), "error"
                     )
 
-                # Embed document
+    # Display watched folders, queue depth and lag
+    def on_watch_stats(self, arguments: str) -> None:
+        for vector_db in self.chat_model.get_vector_db_names():
+            watch_stats = self.chat_model.ingester.get_stats(vector_db)
+            self.chat_view.display_message("Watch stats: {}: {}".format(vector_db, watch_stats), "info")
+
+    # Stop watching folders
+    def on_unwatch_folders(self, arguments: str) -> None:
+        for vector_db in self.chat_model.get_vector_db_names():
+            self.chat_model.unwatch_folders(vector_db)
+        self.chat_view.display_message("Stopped watching folders.", "success")
+
+    # Watch a folder
+    def on_watch_folder(self, arguments: str) -> None:
+        folder = arguments.split(" ")[0]
+        if len(self.chat_model.get_vector_db_names()) != 1:
+            self.chat_view.display_message(
+                "Please use a single vector store first.", "error"
+            )
+            return
+        if not os.path.isdir(folder):
+            self.chat_view.display_message("Folder not found: {}".format(folder), "error")
+            return
+        try:
+            self.chat_model.watch_folder(self.chat_model.get_vector_db(), folder)
+            self.chat_view.display_message(
+                "Watching {}, changed files are re-ingested.".format(folder), "success"
+            )
+        except Exception as e:
+            self.chat_view.display_message(
+                "Error watching folder: {}".format(e), "error"
+            )
+
+    # Get compaction stats
+    def on_compaction_stats(self, arguments: str) -> None:
+        compaction_stats = self.chat_model.compactor.get_stats()
+        self.chat_view.display_message("Compaction stats: {}".format(compaction_stats), "info")
+
+    # Get embedding cache stats
+    def on_embedding_cache_stats(self, arguments: str) -> None:
+        embedding_cache_stats = self.chat_model.embedding_cache.get_stats()
+        self.chat_view.display_message("Embedding cache stats: {}".format(embedding_cache_stats), "info")
+
+    # List chunking profiles
+    def on_list_chunking_profiles(self, arguments: str) -> None:
+        profiles = self.chat_model.list_chunking_profiles()
+        self.chat_view.display_message("Chunking profiles", "section")
+        current_profile = self.chat_model.get_chunking_profile().get("name")
+        for profile_name, profile in profiles.items():
+            if profile_name == current_profile:
+                self.chat_view.display_message("{} {} <".format(profile_name, profile), "info")
+            else:
+                self.chat_view.display_message("{} {}".format(profile_name, profile), "info")
+
+    # Set chunking profile
+    def on_set_chunking_profile(self, arguments: str) -> None:
+        profile_name = arguments.split(" ")[0]
+        if len(self.chat_model.get_vector_db_names()) != 1:
+            self.chat_view.display_message(
+                "Please use a single vector store first.", "error"
+            )
+            return
+        try:
+            self.chat_model.set_chunking_profile(profile_name)
+            self.chat_view.display_message(
+                "Chunking profile set to {}.".format(profile_name), "success"
+            )
+        except Exception as e:
+            self.chat_view.display_message(
+                "Error setting chunking profile: {}".format(e), "error"
+            )
+
+    # Compare chunking profiles
+    def on_compare_chunking_profiles(self, arguments: str) -> None:
+        path = arguments.split(" ")[0]
+        if not os.path.exists(path):
+            self.chat_view.display_message("Path not found: {}".format(path), "error")
+            return
+        with self.chat_view.console.status(""):
+            try:
+                documents = self.chat_model.load_documents(path)
+                report = self.chat_model.compare_chunking_profiles(documents)
+            except Exception as e:
+                self.chat_view.display_message(
+                    "Error comparing chunking profiles: {}".format(e), "error"
+                )
+                return
+        report_table = Table(box=box.SQUARE)
+        for column in ["Profile", "Chunks", "Embedding tokens", "Hit rate"]:
+            report_table.add_column(column)
+        for row in report:
+            report_table.add_row(row["profile"], str(row["chunks"]), str(row["tokens"]), row["hit_rate"])
+        self.console.print(report_table)
+
+    # Trash vector db
+    def on_trash_vector_db(self, arguments: str) -> None:
+        vector_db = arguments.split(" ")[0]
+        self.chat_view.display_message(
+            "Trash vector db: {}? (y/n)".format(vector_db), "warning"
+        )
+        confirm = input("  ")
+        if confirm.lower() != "y":
+            return
+        trash_vector_db = self.chat_model.trash_vector_db(vector_db)
+        if isinstance(trash_vector_db, Exception):
+            self.chat_view.display_message(
+                "Error trashing vector db: {}".format(trash_vector_db),
+                "error",
+            )
+        else:
+            self.chat_view.display_message("Vector db {} trashed.".format(vector_db), "success")
+
+    # Embed document
+    def on_embed(self, arguments: str) -> None:
+        path = arguments.split(" ")[0]
+
+        with self.chat_view.console.status(""):
+
+            # If there is no vector db set, return an error
+            if self.chat_model.get_vector_db() == "":
+                self.chat_view.display_message(
+                    "Please create or use a vector store first.", "error"
+                )
+                return
+
+            # Documents are embedded into a single vector db
+            if len(self.chat_model.get_vector_db_names()) > 1:
+                self.chat_view.display_message(
+                    "Please use a single vector store to embed documents.", "error"
+                )
+                return
+
+            # If there is no path specified, return an error
+            if path == "":
+                self.chat_view.display_message("Please specify a path.", "error")
+                return
+
+            # Web pages and sitemaps are crawled
+            if path.startswith("http://") or path.startswith("https://"):
+                urls = arguments.split()
                 try:
-                    embeddings = self.chat_model.save_chunks_to_db(chunks)
+                    crawl_stats = self.chat_model.crawl_urls(self.chat_model.get_vector_db(), urls)
                     self.chat_view.display_message(
-                        "Documents chunks saved to db.", "success"
+                        "Crawled {} pages, {} new or changed pages saved to db.".format(
+                            crawl_stats["pages"], crawl_stats["changed"]
+                        ),
+                        "success",
                     )
-                    self.logger.info("Document chunks saved to db")
+                    self.chat_view.display_message("Crawl stats: {}".format(crawl_stats), "info")
+                    self.logger.info("Crawled {}: {}".format(urls, crawl_stats))
                 except Exception as e:
                     self.chat_view.display_message(
-                        "Error saving chunks to db: {}".format(e), "error"
+                        "Error crawling {}: {}".format(path, e), "error"
                     )
+                return
 
-        # Normal prompt
-        else:
-            # Start spinner
-            with self.chat_view.console.status(""):
+            # If path points to a folder that doesn't exist, return an error
+            if not os.path.exists(path):
+                self.chat_view.display_message(
+                    "Path not found: {}".format(path), "error"
+                )
+                return
 
-                # Generate final prompt
-                try:
-                    final_message = self.chat_model.generate_final_message(command)
+            # Load document
+            try:
+                documents = self.chat_model.load_documents(path)
+                num_docs = len(documents)
 
-                    # Generate response
-                    try:
-                        response = self.chat_model.generate_response(final_message)
+                self.chat_view.display_message(
+                    "Loaded {} documents from: {}. ".format(num_docs, path),
+                    "success"
+                )
+                # list all documents
+                for doc in documents:
+                    filename = doc.metadata["source"].replace(os.path.realpath(path), "").replace("/", "")
+                    self.chat_view.display_message(
+                        filename,
+                        "info"
+                    )
 
-                        # Display response
-                        self.chat_view.display_response(response)
+                self.logger.info("Loaded documents in: {}".format(path))
+            except Exception as e:
+                self.chat_view.display_message(
+                    "Error loading documents: {}".format(e), "error"
+                )
 
-                    # Error generating response
-                    except Exception as e:
-                        self.chat_view.display_message(
-                            "Error generating response: {}".format(e), "error"
-                        )
+            # Split text
+            try:
+                chunks = self.chat_model.split_text(documents)
+                self.chat_view.display_message(
+                    "Documents split into {} chunks.".format(len(chunks)), "success"
+                )
+                self.logger.info(
+                    "Documents split into {} chunks.".format(len(chunks))
+                )
+            except Exception as e:
+                self.chat_view.display_message(
+                    "Error splitting text: {}".format(e), "error"
+                )
 
-                # Error generating final prompt
+            # Embed document
+            try:
+                embeddings = self.chat_model.save_chunks_to_db(chunks)
+                self.chat_view.display_message(
+                    "Documents chunks saved to db.", "success"
+                )
+                self.logger.info("Document chunks saved to db")
+            except Exception as e:
+                self.chat_view.display_message(
+                    "Error saving chunks to db: {}".format(e), "error"
+                )
+
+    # Prompt
+    def on_prompt(self, command: str) -> None:
+        # Table and csv answers are displayed as their rows arrive
+        if self.chat_model.get_mode() in ["table", "csv"]:
+            self.on_rows(command)
+            return
+
+        # Start spinner
+        with self.chat_view.console.status(""):
+
+            # Generate final prompt
+            try:
+                final_message = self.chat_model.generate_final_message(command)
+
+                # Generate response
+                try:
+                    response = self.chat_model.generate_response(final_message)
+
+                    # Display response
+                    self.chat_view.display_response(response)
+
+                # Error generating response
                 except Exception as e:
                     self.chat_view.display_message(
-                        "Error generating final message: {}".format(e), "error"
+                        "Error generating response: {}".format(e), "error"
                     )
 
+            # Error generating final prompt
+            except Exception as e:
+                self.chat_view.display_message(
+                    "Error generating final message: {}".format(e), "error"
+                )
+
+    # Prompt with a table or csv answer
+    def on_rows(self, command: str) -> None:
+        try:
+            writer = RowWriter(self.export, mode=self.chat_model.get_mode()) if self.export else None
+            rows = []
+            self.chat_view.display_rows(
+                self.collect_rows(self.chat_model.stream_rows(command), rows),
+                self.chat_model.get_mode(),
+                self.chat_model.find_hashtag(command) or ",",
+                writer,
+            )
+            if writer is not None:
+                self.chat_view.display_message(
+                    "{} rows written to {}.".format(writer.count, self.export), "success"
+                )
+            self.speak(self.get_rows_text(rows))
+        except Exception as e:
+            self.chat_view.display_message(
+                "Error generating response: {}".format(e), "error"
+            )
+
+    # Keep the rows of an answer as they are displayed
+    @staticmethod
+    def collect_rows(rows, collected: list):
+        for row in rows:
+            collected.append(row)
+            yield row
+
+    # Get the rows of an answer as text to speak, a line of cells per row
+    @staticmethod
+    def get_rows_text(rows: list) -> str:
+        return "\n".join(", ".join(cell.strip() for cell in row if cell.strip()) for row in rows)
+
+    # Get export file
+    def on_get_export(self, arguments: str) -> None:
+        if self.export:
+            self.chat_view.display_message("Rows are written to {}.".format(self.export), "info")
+        else:
+            self.chat_view.display_message("Rows are not written out.", "info")
+
+    # Set export file
+    def on_set_export(self, arguments: str) -> None:
+        path = arguments.split(" ")[0]
+        if path == "" or path == "-":
+            self.chat_view.display_message("Please specify a file.", "error")
+            return
+        self.export = path
+        self.chat_view.display_message(
+            "Rows of table and csv answers are written to {}.".format(path), "success"
+        )
+
+    # Stop exporting
+    def on_stop_export(self, arguments: str) -> None:
+        self.export = None
+        self.chat_view.display_message("Rows are no longer written out.", "success")
+
+    # Images done
+    def on_images_done(self, result) -> None:
+        """Display the result of a background image generation."""
+        if isinstance(result, Exception):
+            self.chat_view.display_message(
+                "Error generating image: {}".format(result), "error"
+            )
+        else:
+            for image_path in result:
+                self.chat_view.display_message(
+                    "Image generated and saved to : {}".format(image_path), "success"
+                )
+
     # Speak
     def speak(self, text):
         """Speak the text."""
@@ -1486,7 +6261,11 @@ class ChatController:
 
 def main():
     # Model
-    chat_model = ChatModel()
+    try:
+        chat_model = ChatModel()
+    except ValueError as e:
+        print("Error: {}".format(e))
+        sys.exit(1)
 
     # View
     chat_view = ChatView()
@@ -0,0 +1,57 @@
+import time
+
+import neuma
+
+
+def test_token_bucket_starts_full():
+    bucket = neuma.TokenBucket(600)
+    start = time.monotonic()
+    bucket.acquire(600)
+    assert time.monotonic() - start < 0.05
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = neuma.TokenBucket(600)  # 10 per second
+    bucket.acquire(600)
+    start = time.monotonic()
+    bucket.acquire(2)
+    assert 0.15 <= time.monotonic() - start < 0.5
+
+
+def test_token_bucket_caps_amounts_and_unlimited():
+    bucket = neuma.TokenBucket(60)
+    start = time.monotonic()
+    bucket.acquire(1000)  # More than the capacity, takes it all
+    neuma.TokenBucket(0).acquire(1000000)
+    assert time.monotonic() - start < 0.05
+
+
+class Stream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_metered_stream_releases_once_when_exhausted():
+    released, recorded = [], []
+    stream = neuma.MeteredStream(Stream(["a", "b"]), recorded.append, lambda: released.append(True))
+    assert list(stream) == ["a", "b"]
+    stream.close()
+    assert released == [True]
+    assert recorded == [None]
+
+
+def test_metered_stream_releases_when_dropped():
+    released = []
+    stream = neuma.MeteredStream(Stream(["a", "b"]), release=lambda: released.append(True))
+    iterator = iter(stream)
+    next(iterator)
+    assert released == []
+    iterator.close()
+    assert released == [True]
@@ -0,0 +1,45 @@
+from langchain.schema import Document
+
+import neuma
+
+
+def test_tables_are_split_by_rows_with_their_header():
+    chunker = neuma.Chunker({"size": 40, "overlap": 0, "unit": "characters"})
+    text = "name,city\n" + "".join("row{},city{}\n".format(i, i) for i in range(10))
+    document = Document(page_content=text, metadata={"source": "people.csv"})
+    chunks = chunker.split_documents([document])
+    assert len(chunks) > 1
+    rows = []
+    for chunk in chunks:
+        assert chunk.page_content.startswith("name,city\n")
+        assert len(chunk.page_content) <= 40
+        assert chunk.metadata["source"] == "people.csv"
+        chunk_rows = chunk.page_content.splitlines(keepends=True)[1:]
+        # The start index points at the first row of the chunk in the document
+        assert text[chunk.metadata["start_index"]:].startswith(chunk_rows[0])
+        rows += chunk_rows
+    assert "".join(rows) == text[len("name,city\n"):]
+
+
+def test_rows_longer_than_the_size_get_their_own_chunk():
+    chunker = neuma.Chunker({"size": 20, "overlap": 0, "unit": "characters"})
+    text = "id,text\n1,short\n2,{}\n3,short\n".format("long " * 10)
+    chunks = chunker.split_table(Document(page_content=text, metadata={}))
+    assert [chunk.page_content.splitlines()[1][:2] for chunk in chunks] == ["1,", "2,", "3,"]
+
+
+def test_header_only_tables_keep_one_chunk():
+    chunker = neuma.Chunker({"size": 20, "unit": "characters"})
+    chunks = chunker.split_table(Document(page_content="id,text\n", metadata={}))
+    assert [chunk.page_content for chunk in chunks] == ["id,text\n"]
+    assert chunker.split_table(Document(page_content="", metadata={})) == []
+
+
+def test_format_of_documents():
+    chunker = neuma.Chunker({})
+    assert chunker.get_format(Document(page_content="", metadata={"source": "data/people.TSV"})) == "table"
+    assert chunker.get_format(Document(page_content="", metadata={"source": "main.py"})) == ".py"
+    assert chunker.get_format(Document(page_content="", metadata={"source": "notes.txt"})) == "text"
+    assert neuma.Chunker({"format_aware": False}).get_format(
+        Document(page_content="", metadata={"source": "people.csv"})
+    ) == "text"
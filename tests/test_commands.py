@@ -0,0 +1,66 @@
+import logging
+import os
+
+import neuma
+
+
+def exit_app(arguments):
+    pass
+
+
+def db(arguments):
+    pass
+
+
+def delete(arguments):
+    pass
+
+
+def mode(arguments):
+    pass
+
+
+def make_registry(context=None):
+    registry = neuma.CommandRegistry(logging.getLogger("test"), context)
+    registry.register("q", exit_app, "Quit")
+    registry.register("d", db, "Set vector db", "[db]")
+    registry.register("dd", delete, "Delete vector db", "[db]")
+    registry.register("m", mode, "Get or set mode", "[mode]", optional=True)
+    return registry
+
+
+def test_bare_commands_match_exactly():
+    registry = make_registry()
+    assert registry.resolve("q") == (exit_app, "")
+    assert registry.resolve("qq") is None
+    assert registry.resolve("q now") is None
+    # A command with arguments needs them, unless they are optional
+    assert registry.resolve("d") is None
+    assert registry.resolve("m") == (mode, "")
+
+
+def test_longest_prefix_wins():
+    registry = make_registry()
+    assert registry.resolve("d docs") == (db, "docs")
+    assert registry.resolve("dd docs") == (delete, "docs")
+    assert registry.resolve("d dd docs") == (db, "dd docs")
+    assert registry.resolve("m table") == (mode, "table")
+    assert registry.resolve("ddocs") is None
+    assert registry.resolve("") is None
+
+
+def test_handlers_are_loaded_on_first_use():
+    registry = make_registry(context="root")
+    registry.register("j", "os.path:join", "Join paths", "[path]")
+    handler, arguments = registry.resolve("j file")
+    assert handler(arguments) == os.path.join("root", "file")
+    assert registry.resolve("j file")[0] is handler
+
+
+def test_help_rows_in_registration_order():
+    assert make_registry().get_help() == [
+        ("q", "Quit"),
+        ("d [db]", "Set vector db"),
+        ("dd [db]", "Delete vector db"),
+        ("m [mode]", "Get or set mode"),
+    ]
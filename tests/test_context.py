@@ -0,0 +1,58 @@
+import pytest
+from langchain.schema import Document
+
+import neuma
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # One token per word, without the tokenizer download
+    monkeypatch.setattr(neuma.Chunker, "count_tokens", staticmethod(lambda text: len(text.split())))
+
+
+def result(text, score, source, start_index=None):
+    metadata = {"source": source}
+    if start_index is not None:
+        metadata["start_index"] = start_index
+    return Document(page_content=text, metadata=metadata), score
+
+
+def test_overlapping_chunks_of_a_source_are_merged():
+    merged = neuma.ContextPacker.merge([
+        result("efgh", 0.5, "a.md", 4),
+        result("abcdef", 0.9, "a.md", 0),
+        result("ijkl", 0.7, "a.md", 8),
+        result("zzzz", 0.3, "a.md", 20),
+        result("abcdef", 0.8, "b.md", 0),
+        result("no position", 0.6, "c.md"),
+    ])
+    merged = {(metadata["source"], text): score for text, metadata, score in merged}
+    assert merged == {
+        ("a.md", "abcdefghijkl"): 0.9,
+        ("a.md", "zzzz"): 0.3,
+        ("b.md", "abcdef"): 0.8,
+        ("c.md", "no position"): 0.6,
+    }
+
+
+def test_packing_prefers_diverse_chunks_and_drops_duplicates():
+    packer = neuma.ContextPacker({"context": {"max_tokens": 100, "mmr_lambda": 0.3, "duplicate_threshold": 0.8}})
+    text, documents = packer.pack([
+        result("alpha beta gamma delta", 1.0, "a.md"),
+        result("alpha beta gamma delta", 0.95, "b.md"),
+        result("alpha beta gamma epsilon", 0.9, "c.md"),
+        result("zeta eta theta", 0.5, "d.md"),
+    ])
+    assert [document.metadata["source"] for document in documents] == ["a.md", "d.md", "c.md"]
+    assert text == "alpha beta gamma delta\n\n---\n\nzeta eta theta\n\n---\n\nalpha beta gamma epsilon"
+
+
+def test_packing_fits_the_token_budget():
+    packer = neuma.ContextPacker({"context": {"max_tokens": 5}})
+    _text, documents = packer.pack([
+        result("one two three", 1.0, "a.md"),
+        result("four five six seven", 0.9, "b.md"),
+        result("eight nine", 0.8, "c.md"),
+    ])
+    assert [document.metadata["source"] for document in documents] == ["a.md", "c.md"]
+    assert packer.pack([]) == ("", [])
@@ -0,0 +1,60 @@
+import pytest
+
+import neuma
+
+
+def make_conversation(turns=3):
+    conversation = neuma.Conversation()
+    conversation.append({"role": "system", "content": "system"})
+    for turn in range(1, turns + 1):
+        conversation.append({"role": "user", "content": "question {}".format(turn)})
+        conversation.append({"role": "assistant", "content": "answer {}".format(turn)})
+    return conversation
+
+
+def test_fork_keeps_whole_turns_and_shares_them():
+    conversation = make_conversation()
+    main_nodes = conversation.get_nodes()
+    conversation.fork("retry", turn=2)
+    assert conversation.branch == "retry"
+    assert [message["content"] for message in conversation] == [
+        "system", "question 1", "answer 1", "question 2", "answer 2",
+    ]
+    # The history is shared, not copied
+    assert conversation.get_nodes()[-1] is main_nodes[4]
+
+    conversation.append({"role": "user", "content": "question 3b"})
+    assert len(conversation) == 6
+    conversation.checkout("main")
+    assert conversation[-1]["content"] == "answer 3"
+    assert conversation.list_branches() == {
+        "main": {"turns": 3, "shared": 3},
+        "retry": {"turns": 3, "shared": 2},
+    }
+
+
+def test_fork_at_the_start_and_of_the_whole_branch():
+    conversation = make_conversation()
+    conversation.fork("empty", turn=0)
+    assert len(conversation) == 0
+    conversation.checkout("main")
+    conversation.fork("copy")
+    assert conversation.get_messages() == make_conversation().get_messages()
+
+
+def test_fork_of_an_unanswered_turn():
+    conversation = make_conversation(turns=1)
+    conversation.append({"role": "user", "content": "question 2"})
+    conversation.fork("pending", turn=2)
+    assert conversation[-1]["content"] == "question 2"
+
+
+def test_fork_errors():
+    conversation = make_conversation()
+    with pytest.raises(ValueError):
+        conversation.fork("main")
+    with pytest.raises(ValueError):
+        conversation.fork("too-far", turn=4)
+    with pytest.raises(ValueError):
+        conversation.checkout("unknown")
+    assert conversation.branch == "main"
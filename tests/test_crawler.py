@@ -0,0 +1,96 @@
+import http.server
+import logging
+import threading
+
+import pytest
+
+import neuma
+
+
+class SiteHandler(http.server.BaseHTTPRequestHandler):
+    # Path -> (status, headers, body), set by the site fixture
+    routes = {}
+
+    def do_GET(self):
+        status, headers, body = self.routes.get(self.path, (404, {}, ""))
+        if "ETag" in headers and self.headers.get("If-None-Match") == headers["ETag"]:
+            status, body = 304, ""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body.encode())))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    routes = {}
+    handler = type("Handler", (SiteHandler,), {"routes": routes})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1]), routes
+    server.shutdown()
+    server.server_close()
+
+
+def html(body, etag=None):
+    headers = {"Content-Type": "text/html"}
+    if etag:
+        headers["ETag"] = etag
+    return 200, headers, "<html><body><article>{}</article></body></html>".format(body)
+
+
+def crawl(seeds, state):
+    logger = logging.getLogger("test")
+    crawler = neuma.WebCrawler({"crawl": {"concurrency": 2}}, logger, neuma.ContentCompactor({}, logger))
+    pages = {}
+    stats = crawler.run(seeds, state, lambda url, text: pages.__setitem__(url, text))
+    return pages, stats
+
+
+def test_changed_pages_are_ingested_again(site):
+    base, routes = site
+    routes["/"] = html('<p>Home page of the site</p><a href="/a">A</a><a href="/b">B</a>')
+    routes["/a"] = html("<p>First version of the page</p>")
+    routes["/b"] = html("<p>Page with a validator</p>", etag='"b1"')
+    state = {}
+    pages, stats = crawl([base + "/"], state)
+    assert sorted(pages) == [base + "/", base + "/a", base + "/b"]
+    assert stats["changed"] == 3
+
+    routes["/a"] = html("<p>Second version of the page</p>")
+    pages, stats = crawl([base + "/"], state)
+    assert list(pages) == [base + "/a"]
+    assert "Second version" in pages[base + "/a"]
+    assert stats["unchanged"] == 1
+    assert stats["not_modified"] == 1
+
+
+def test_redirected_pages_are_keyed_by_final_url(site):
+    base, routes = site
+    routes["/old"] = (301, {"Location": "/new"}, "")
+    routes["/new"] = html("<p>Page that moved here</p>")
+    state = {}
+    pages, _stats = crawl([base + "/old"], state)
+    assert list(pages) == [base + "/new"]
+    assert state[base + "/old"] == {"location": base + "/new"}
+
+    pages, stats = crawl([base + "/old"], state)
+    assert pages == {}
+    assert stats["unchanged"] == 1
+
+
+def test_robots_txt_is_respected(site):
+    base, routes = site
+    routes["/robots.txt"] = (200, {"Content-Type": "text/plain"}, "User-agent: *\nDisallow: /private\n")
+    routes["/"] = html('<p>Home page of the site</p><a href="/private">Private</a><a href="/public">Public</a>')
+    routes["/private"] = html("<p>Private page</p>")
+    routes["/public"] = html("<p>Public page</p>")
+    pages, stats = crawl([base + "/"], {})
+    assert sorted(pages) == [base + "/", base + "/public"]
+    assert stats["skipped"] == 1
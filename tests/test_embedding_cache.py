@@ -0,0 +1,66 @@
+import logging
+import time
+from types import SimpleNamespace
+
+import neuma
+
+
+def make_cache(tmp_path, max_size=512):
+    config = {"embeddings": {"cache_file": str(tmp_path / "embeddings.sqlite"), "cache_max_size": max_size}}
+    return neuma.EmbeddingCache(config, logging.getLogger("test"))
+
+
+class Api:
+    # Embeds each text as its length, counting the embedded texts
+    def __init__(self):
+        self.embedded = []
+        self.client = SimpleNamespace(embeddings=SimpleNamespace(create=self.create))
+
+    def create(self, model, input):
+        self.embedded += input
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(text))] * 8) for text in input])
+
+    def call(self, endpoint, function, *args, tokens=0, units=0, **kwargs):
+        return function(*args, **kwargs)
+
+    @staticmethod
+    def count_tokens(text):
+        return neuma.ApiClient.count_tokens(text)
+
+
+def test_vectors_are_cached_by_model_and_hash(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_many("model", {"a": [1.0] * 8, "b": [2.0] * 8})
+    assert cache.get_many("model", ["a", "b", "c"]) == {"a": [1.0] * 8, "b": [2.0] * 8}
+    assert cache.get_many("other", ["a"]) == {}
+    assert cache.get_size() == 64
+    # Stored again, not counted again
+    cache.put_many("model", {"a": [1.0] * 8})
+    assert cache.get_size() == 64
+    assert make_cache(tmp_path).get_size() == 64
+
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_size=100 / 1024 / 1024)  # Room for 3 vectors of 32 bytes
+    for name in ["a", "b", "c"]:
+        cache.put_many("model", {name: [0.0] * 8})
+        time.sleep(0.01)
+    cache.get_many("model", ["a"])
+    cache.put_many("model", {"d": [0.0] * 8})
+    assert sorted(cache.get_many("model", ["a", "b", "c", "d"])) == ["a", "c", "d"]
+    assert cache.get_size() == 96
+    assert cache.get_stats()["evicted"] == 1
+
+
+def test_embeddings_go_through_the_cache(tmp_path):
+    cache = make_cache(tmp_path)
+    api = Api()
+    embeddings = neuma.ApiEmbeddings(api, "model", batch_size=2, cache=cache)
+    assert embeddings.embed_documents(["one", "three", "one"]) == [[3.0] * 8, [5.0] * 8, [3.0] * 8]
+    assert api.embedded == ["one", "three"]
+    assert embeddings.embed_documents(["three", "four"]) == [[5.0] * 8, [4.0] * 8]
+    assert api.embedded == ["one", "three", "four"]
+    # Queries use the cache without counting in its stats
+    assert embeddings.embed_query("one") == [3.0] * 8
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 3, 3)
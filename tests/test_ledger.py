@@ -0,0 +1,57 @@
+import logging
+
+import pytest
+
+import neuma
+
+
+def make_ledger(tmp_path, **usage_config):
+    config = {"usage": dict({
+        "ledger_file": str(tmp_path / "usage.sqlite"),
+        "prices": {"gpt-4o": {"input": 5, "output": 15}, "gpt-4o-mini": {"input": 0.15, "output": 0.6}},
+    }, **usage_config)}
+    return neuma.UsageLedger(config, logging.getLogger("test"))
+
+
+def test_prices_longest_matching_name(tmp_path):
+    ledger = make_ledger(tmp_path)
+    assert ledger.get_price("gpt-4o-2024-05-13") == {"input": 5, "output": 15}
+    assert ledger.get_price("gpt-4o-mini-2024-07-18") == {"input": 0.15, "output": 0.6}
+    assert ledger.get_cost("gpt-4o", 1000000, 100000, 0) == 5 + 1.5
+    assert ledger.get_cost("unknown", 1000000, 0, 0) == 0
+
+
+def test_usage_is_recorded_with_its_attribution(tmp_path):
+    ledger = make_ledger(tmp_path)
+    assert ledger.get_spent("daily") == {"tokens": 0, "cost": 0.0}
+    with ledger.attribute(persona="coder", mode="code") as tally:
+        ledger.record("chat", "gpt-4o", {"prompt_tokens": 1000, "completion_tokens": 500})
+    ledger.record("embeddings", "text-embedding-3-small", estimate=200)
+    assert tally == {"prompt_tokens": 1000, "completion_tokens": 500, "cost": pytest.approx(0.0125)}
+    assert ledger.get_spent("daily") == {"tokens": 1700, "cost": pytest.approx(0.0125)}
+    assert ledger.get_spent("monthly")["tokens"] == 1700
+    # Running totals match the ledger
+    assert make_ledger(tmp_path).get_spent("daily") == ledger.get_spent("daily")
+    breakdown = ledger.get_report()["breakdown"]["persona"]
+    assert [(row["name"], row["calls"]) for row in breakdown] == [("coder", 1), ("", 1)]
+
+
+def test_budgets_are_enforced(tmp_path):
+    ledger = make_ledger(tmp_path, daily_tokens=1000, downgrade_model="gpt-4o-mini", throttle_at=0.5)
+    ledger.check("chat", "gpt-4o")
+    assert ledger.downgrade("gpt-4o") == "gpt-4o"
+    ledger.record("chat", "gpt-4o", estimate=600)
+    assert ledger.downgrade("gpt-4o") == "gpt-4o-mini"
+    ledger.record("chat", "gpt-4o", estimate=400)
+    with pytest.raises(neuma.BudgetExceededError):
+        ledger.check("chat", "gpt-4o")
+    # Listing models is free
+    ledger.check("models")
+
+
+def test_cost_budgets_need_prices(tmp_path):
+    make_ledger(tmp_path).check("chat", "unknown")
+    ledger = make_ledger(tmp_path, monthly_cost=10)
+    ledger.check("chat", "gpt-4o")
+    with pytest.raises(ValueError):
+        ledger.check("chat", "unknown")
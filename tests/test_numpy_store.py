@@ -0,0 +1,116 @@
+import threading
+import zlib
+
+import numpy as np
+import pytest
+
+import neuma
+
+
+class Embeddings:
+    # A random vector per text, the same for each call
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return np.random.default_rng(zlib.crc32(text.encode())).normal(size=32).tolist()
+
+
+def add_sources(store, sources=3, chunks=20):
+    for source in range(sources):
+        texts = ["chunk {} of source {}".format(chunk, source) for chunk in range(chunks)]
+        store.add_texts(texts, [{"source": "s{}".format(source)} for _ in texts])
+
+
+def make_store(path, quantization="none", **kwargs):
+    return neuma.NumpyVectorStore(
+        str(path), Embeddings(), quantization=quantization, pq_subspaces=8, pq_min_train=40, **kwargs
+    )
+
+
+@pytest.mark.parametrize("quantization", neuma.NumpyVectorStore.QUANTIZATIONS)
+def test_add_search_and_reopen(tmp_path, quantization):
+    store = make_store(tmp_path, quantization)
+    add_sources(store)
+    assert store.count() == 60
+    document, score = store.similarity_search_with_score("chunk 7 of source 1", k=1)[0]
+    assert document.page_content == "chunk 7 of source 1"
+    assert document.metadata == {"source": "s1"}
+    assert score > 0.99
+
+    reopened = make_store(tmp_path, quantization)
+    assert reopened.count() == 60
+    assert reopened.similarity_search("chunk 3 of source 2", k=1)[0].page_content == "chunk 3 of source 2"
+
+
+@pytest.mark.parametrize("quantization", neuma.NumpyVectorStore.QUANTIZATIONS)
+def test_deleted_sources_are_skipped(tmp_path, quantization):
+    store = make_store(tmp_path, quantization)
+    add_sources(store)
+    assert store.delete_source("s1") == 20
+    assert store.delete_source("s1") == 0
+    assert store.get_sources() == {"s0", "s2"}
+    results = store.similarity_search("chunk 7 of source 1", k=60)
+    assert len(results) == 40
+    assert all(document.metadata["source"] != "s1" for document in results)
+
+
+def test_pq_codebooks_are_trained_again_until_enough_vectors(tmp_path):
+    store = make_store(tmp_path, "pq")
+    add_sources(store, sources=1)
+    assert store.get_stats()["pq_trained"] == 20
+    assert (tmp_path / "vectors.npy").exists()
+    add_sources(store, sources=2)
+    assert store.get_stats()["pq_trained"] == 40
+    # Trained on enough vectors, the full precision ones are dropped
+    assert not (tmp_path / "vectors.npy").exists()
+    add_sources(store, sources=1)
+    assert store.get_stats()["pq_trained"] == 40
+    assert store.count() == 80
+
+
+@pytest.mark.parametrize("quantization", ["int8", "pq"])
+def test_keep_full_keeps_vectors_for_rescoring(tmp_path, quantization):
+    store = make_store(tmp_path, quantization, keep_full=True)
+    add_sources(store)
+    stats = store.get_stats()
+    assert stats["keep_full"]
+    assert stats["recall@10"]["rescored"] >= stats["recall@10"]["quantized"]
+    assert store.load()["vectors"].shape == (60, 32)
+
+
+@pytest.mark.parametrize("quantization", neuma.NumpyVectorStore.QUANTIZATIONS)
+def test_compaction_drops_deleted_chunks(tmp_path, quantization):
+    store = make_store(tmp_path, quantization)
+    add_sources(store)
+    store.delete_source("s0")
+    assert store.compact() == 20
+    assert store.compact() == 0
+    reopened = make_store(tmp_path, quantization)
+    assert reopened.count() == 40
+    assert reopened.get_sources() == {"s1", "s2"}
+    assert reopened.similarity_search("chunk 5 of source 2", k=1)[0].page_content == "chunk 5 of source 2"
+
+
+def test_handles_on_a_store_share_writes(tmp_path):
+    store, other = make_store(tmp_path), make_store(tmp_path / ".." / tmp_path.name)
+    assert store.lock is other.lock
+    threads = [
+        threading.Thread(target=add_sources, args=(handle,), kwargs={"sources": 2}) for handle in [store, other] * 2
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert make_store(tmp_path).count() == 160
+
+
+def test_search_snapshot_outlives_compaction(tmp_path):
+    store = make_store(tmp_path)
+    add_sources(store)
+    arrays = store.load()
+    query = np.asarray([Embeddings().embed_query("chunk 1 of source 2")])
+    ids = [i for i, _score in store.search_vectors(query, 3, arrays=arrays)[0]]
+    store.delete_source("s0")
+    store.compact()
+    assert store.get_documents(ids, arrays)[0].page_content == "chunk 1 of source 2"
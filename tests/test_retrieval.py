@@ -0,0 +1,52 @@
+from langchain.schema import Document
+
+import neuma
+
+
+def test_bm25_ranks_rare_terms_first():
+    index = neuma.BM25Index()
+    index.add([
+        "the cat sat on the mat",
+        "the dog sat on the log",
+        "error E1234 in parse_config",
+        "the the the the",
+    ])
+    assert [chunk_id for chunk_id, _score in index.search("E1234 error", k=4)] == [2]
+    ranked = index.search("cat on the mat", k=2)
+    assert ranked[0][0] == 0
+    assert ranked[0][1] > ranked[1][1]
+    assert index.search("unknown") == []
+    assert neuma.BM25Index().search("cat") == []
+
+
+def test_lexical_index_keeps_identifiers_whole(tmp_path):
+    index = neuma.LexicalIndex(str(tmp_path))
+    index.add_documents([
+        Document(page_content="call parse_config first", metadata={"source": "a.md"}),
+        Document(page_content="parse the config", metadata={"source": "b.md"}),
+    ])
+    assert [document.metadata["source"] for document, _score in index.search("parse_config")] == ["a.md"]
+    index.delete_source("a.md")
+    assert index.count() == 1
+    assert index.search("parse_config") == []
+
+
+def document(text, source="a.md", start_index=0):
+    return Document(page_content=text, metadata={"source": source, "start_index": start_index})
+
+
+def test_reciprocal_rank_fusion_adds_up_ranks():
+    vector_results = [(document("one"), 0.9), (document("two"), 0.8), (document("three"), 0.7)]
+    lexical_results = [(document("three"), 12.0), (document("four"), 9.0)]
+    fused = neuma.ChatModel.reciprocal_rank_fusion([vector_results, lexical_results], k=3, rrf_k=60)
+    assert [result.page_content for result, _score in fused] == ["three", "one", "two"]
+    assert fused[0][1] == 1 / 63 + 1 / 61
+    assert fused[1][1] == 1 / 61
+
+
+def test_chunks_are_fused_by_source_and_position():
+    # The same text at two places of a source are two chunks
+    fused = neuma.ChatModel.reciprocal_rank_fusion(
+        [[(document("same", start_index=0), 1.0)], [(document("same", start_index=100), 1.0)]], k=4
+    )
+    assert len(fused) == 2
@@ -0,0 +1,63 @@
+import json
+import logging
+
+import neuma
+
+
+def make_router(tmp_path, **router_config):
+    config = {
+        "openai": {"model": "gpt-4o"},
+        "router": dict({"cache_file": str(tmp_path / "models.json")}, **router_config),
+    }
+    return neuma.ModelRouter(config, logging.getLogger("test"))
+
+
+def test_disabled_router_keeps_the_default_model(tmp_path):
+    router = make_router(tmp_path, rule=[{"mode": "code", "model": "gpt-4"}])
+    messages = [{"role": "user", "content": "Hello"}]
+    assert router.route(messages, "code", "default", False) == "gpt-4o"
+    assert router.route(messages, "code", "default", False, model="gpt-4-turbo") == "gpt-4-turbo"
+
+
+def test_first_matching_rule_wins(tmp_path):
+    router = make_router(tmp_path, enabled=True, rule=[
+        {"mode": ["code", "terminal"], "persona": "default", "model": "gpt-4"},
+        {"rag": True, "max_prompt_tokens": 100, "model": "gpt-3.5-turbo"},
+    ])
+    short = [{"role": "user", "content": "Hello"}]
+    long = [{"role": "user", "content": "word " * 200}]
+    assert router.route(short, "terminal", "default", False) == "gpt-4"
+    assert router.route(short, "normal", "default", True) == "gpt-3.5-turbo"
+    assert router.route(long, "normal", "default", True) == "gpt-4o"
+
+
+def test_context_window_longest_prefix(tmp_path):
+    router = make_router(tmp_path)
+    assert router.get_context_window("gpt-4-32k-0613") == 32768
+    assert router.get_context_window("gpt-4-0613") == 8192
+    assert router.get_context_window("gpt-4o-mini") == 128000
+    assert router.get_context_window("unknown-model") == 4096
+
+
+def test_quick_calls_go_to_the_fastest_adequate_model(tmp_path):
+    router = make_router(tmp_path, enabled=True, fast_models=["gpt-3.5-turbo", "gpt-4o-mini"])
+    messages = [{"role": "user", "content": "Hello"}]
+    # Without latencies, the configured order is kept
+    assert router.route(messages, "normal", "default", False, quick=True) == "gpt-3.5-turbo"
+    router.record_latency("gpt-3.5-turbo", 2.0)
+    router.record_latency("gpt-4o-mini", 1.0)
+    assert router.route(messages, "normal", "default", False, quick=True) == "gpt-4o-mini"
+    # A prompt too long for every fast model goes to the default one
+    long = [{"role": "user", "content": "word " * 600000}]
+    assert router.route(long, "normal", "default", False, quick=True) == "gpt-4o"
+
+
+def test_latencies_are_averaged_and_flushed(tmp_path):
+    router = make_router(tmp_path, save_interval=3600)
+    router.record_latency("gpt-4o", 1.0)
+    router.record_latency("gpt-4o", 2.0)
+    assert router.get_latency("gpt-4o") == 0.8 * 1.0 + 0.2 * 2.0
+    assert not (tmp_path / "models.json").exists()
+    router.flush()
+    with open(tmp_path / "models.json") as f:
+        assert json.load(f)["models"]["gpt-4o"]["latency"] == router.get_latency("gpt-4o")
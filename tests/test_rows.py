@@ -0,0 +1,30 @@
+import neuma
+
+
+def test_csv_quoted_fields():
+    parser = neuma.RowParser("csv", ",")
+    assert parser.parse_line('"Smith, John",Paris,75001') == ["Smith, John", "Paris", "75001"]
+
+
+def test_csv_empty_fields(tmp_path):
+    parser = neuma.RowParser("csv", ",")
+    row = parser.parse_line(",Lyon,")
+    assert row == ["", "Lyon", ""]
+    writer = neuma.RowWriter(str(tmp_path / "rows.csv"), mode="csv")
+    assert writer.clean(row) == ["", "Lyon", ""]
+    writer.close()
+
+
+def test_table_rows(tmp_path):
+    parser = neuma.RowParser("table")
+    rows = parser.feed("| Name | City |\n|:---|---:|\n| Ann | Lyon |\n") + parser.close()
+    writer = neuma.RowWriter(str(tmp_path / "rows.csv"), mode="table")
+    assert [writer.clean(row) for row in rows] == [["Name", "City"], ["Ann", "Lyon"]]
+    writer.close()
+
+
+def test_format_rows_quotes_separators():
+    rows = [["Name", "City"], ["Smith, John", "Paris"]]
+    assert neuma.RowWriter.format_rows(rows) == 'Name,City\n"Smith, John",Paris'
+    assert neuma.RowWriter.format_rows(rows, ";") == "Name;City\nSmith, John;Paris"
+    assert neuma.RowWriter.format_rows(rows, " | ") == "Name | City\nSmith, John | Paris"